@@ -0,0 +1,113 @@
+"""
+Backup throughput on synthetic data, for each archive engine and compressor.
+
+Data folders: backup_data_folders() is run on three synthetic trees (many small
+files, few huge files, a deep hierarchy) with the "tar" and "python" engines and
+each available compressor (gzip, pigz, zstd).
+
+Database dumps: a local command writing synthetic SQL text stands in for
+pg_dump/mysqldump, and its output is saved with save_command_output()
+and each available compressor.
+
+No mount command is run, and all files are created in a temporary folder
+(or below --tmp). SCALE multiplies the size of all synthetic data.
+
+Usage:
+
+    python benchmarks/bench_backup.py [--scale SCALE] [--workers N] [--tmp FOLDER] [--json FILE]
+"""
+from __future__ import print_function
+import os
+import shutil
+import argparse
+import tempfile
+
+from common import configure, available_compressors, timer, TREES, dump_command, Results
+
+from easy_backup.main import backup_data_folders, save_command_output, get_output_format, ARCHIVE_ENGINES
+from easy_backup.scheduler import Scheduler
+from easy_backup.metrics import Metrics
+from easy_backup.utils import ERRORS_LIST
+from easy_backup import utils
+
+# generator arguments, at scale 1.0
+TREE_SIZES = {
+    'small_files': lambda scale: dict(count=max(1, int(20000 * scale))),
+    'huge_files': lambda scale: dict(size=max(1, int(128 * 1024 * 1024 * scale))),
+    'deep_tree': lambda scale: dict(depth=max(1, int(60 * scale))),
+}
+DUMP_SIZE = 256 * 1024 * 1024
+
+
+def bench_data_folders(results, root, compressors, workers):
+    for tree in sorted(TREES.keys()):
+        folder = os.path.join(root, 'source', tree)
+        input_bytes = utils.get_path_size(folder)
+        for engine in ARCHIVE_ENGINES:
+            for compressor in compressors:
+                target_folder = tempfile.mkdtemp(dir=root)
+                configure(target_folder, include=folder, compressor=compressor, engine=engine, max_workers=workers)
+                metrics = Metrics()
+                scheduler = Scheduler(max_workers=workers, metrics=metrics)
+                errors = len(ERRORS_LIST)
+                t0 = timer()
+                backup_data_folders(scheduler, utils.timestamp(), target_folder)
+                scheduler.run()
+                seconds = timer() - t0
+                output_bytes = sum([job.output_bytes or 0 for job in metrics.completed_jobs()])
+                results.add(
+                    'backup_data_folders[%s, %s, %s]' % (tree, engine, compressor), seconds,
+                    tree=tree, engine=engine, compressor=compressor,
+                    input_bytes=input_bytes, output_bytes=output_bytes,
+                    mb_per_second=round(input_bytes / seconds / 1e6, 1),
+                    failed=len(ERRORS_LIST) > errors,
+                )
+                shutil.rmtree(target_folder)
+
+
+def bench_dumps(results, root, compressors, size):
+    command = dump_command(size)
+    for compressor in compressors:
+        target_folder = tempfile.mkdtemp(dir=root)
+        configure(target_folder, compressor=compressor)
+        output_format = get_output_format('postgresql')
+        target_file = utils.output_filepath(target_folder, utils.timestamp(), 'postgresql.synthetic', compressor=output_format)
+        t0 = timer()
+        save_command_output('postgresql', command, target_file, output_format)
+        seconds = timer() - t0
+        results.add(
+            'save_command_output[%s]' % compressor, seconds,
+            compressor=compressor, input_bytes=size,
+            output_bytes=utils.get_path_size(target_file),
+            mb_per_second=round(size / seconds / 1e6, 1),
+        )
+        shutil.rmtree(target_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backup benchmarks on synthetic data')
+    parser.add_argument('--scale', type=float, default=1.0, help="size of the synthetic data (default: 1.0)")
+    parser.add_argument('--workers', type=int, default=1, help="scheduler workers (default: 1)")
+    parser.add_argument('--tmp', default=None, help="folder for the synthetic data and the backups")
+    parser.add_argument('--json', default=None, help="save results as JSON into this file")
+    args = parser.parse_args()
+
+    compressors = available_compressors()
+    results = Results('backup')
+    root = tempfile.mkdtemp(prefix='easy_backup_bench_', dir=args.tmp)
+    try:
+        for tree, make_tree in sorted(TREES.items()):
+            t0 = timer()
+            make_tree(os.path.join(root, 'source', tree), **TREE_SIZES[tree](args.scale))
+            print('Synthetic tree "%s" created in %.1f s' % (tree, timer() - t0))
+        bench_data_folders(results, root, compressors, args.workers)
+        bench_dumps(results, root, compressors, max(1, int(DUMP_SIZE * args.scale)))
+    finally:
+        shutil.rmtree(root)
+
+    if args.json:
+        results.write(args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Filename date parsing throughput, on synthetic backup filenames.
+
+Compares the previous parser (two datetime.strptime() calls per filename)
+with dateparse.FilenameDateParser, both on first use and with cached results.
+
+Usage:
+
+    python benchmarks/bench_dateparse.py [COUNT]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from easy_backup.dateparse import FilenameDateParser, DEFAULT_DATE_FORMATS
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def synthetic_filenames(count, seed=0):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    names = ['postgresql.db%d.gz' % i for i in range(20)] + ['etc.tgz', 'home.www.tar.zst', 'mysql.shop.gz']
+    filenames = []
+    for i in range(count):
+        dt = start + datetime.timedelta(seconds=rnd.randint(0, 10 * 365 * 86400))
+        name = rnd.choice(names)
+        kind = rnd.randint(0, 9)
+        if kind < 6:
+            filename = dt.strftime('%Y-%m-%d_%H-%M-%S__') + name
+        elif kind == 6:
+            filename = datetime.date.today().strftime('%Y-%m-%d_____') + dt.strftime('%Y-%m-%d_%H-%M-%S__') + name
+        elif kind == 7:
+            filename = dt.strftime('%Y-%m-%dT%H:%M:%S_') + name
+        elif kind == 8:
+            filename = '%d_%s_10.5.6-ee_gitlab_backup.tar' % (int(time.mktime(dt.timetuple())), dt.strftime('%Y_%m_%d'))
+        else:
+            filename = name
+        filenames.append(filename)
+    return filenames
+
+
+def legacy_parse(filename):
+    filedate = None
+    try:
+        filedate = datetime.datetime.strptime(filename[:10], "%Y-%m-%d").date()
+    except:
+        pass
+    if filedate is None:
+        try:
+            n = filename.find('_')
+            filedate = datetime.datetime.strptime(filename[n+1:n+1+10], "%Y_%m_%d").date()
+        except:
+            pass
+    return filedate
+
+
+def measure(label, parse, filenames):
+    started = timer()
+    dated = 0
+    for filename in filenames:
+        if parse(filename) is not None:
+            dated += 1
+    elapsed = timer() - started
+    print('%-24s %8.3f s  %10.0f names/s  (%d dated)' % (label, elapsed, len(filenames) / elapsed, dated))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    filenames = synthetic_filenames(count)
+    print('%d synthetic filenames (%d distinct)' % (count, len(set(filenames))))
+
+    measure('strptime (legacy)', legacy_parse, filenames)
+    parser = FilenameDateParser(DEFAULT_DATE_FORMATS)
+    measure('regex, first use', parser.parse, filenames)
+    measure('regex, cached', parser.parse, filenames)
+
+
+if __name__ == '__main__':
+    main()
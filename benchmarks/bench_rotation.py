@@ -0,0 +1,114 @@
+"""
+Rotation performance on a synthetic backup history.
+
+A history of YEARS years of nightly backups of SOURCES sources is created
+in the daily folder of a temporary target root (empty files: rotation only
+looks at names); then the following steps are timed:
+
+- RotationIndex: the scan of the backup tree (formerly collect_dated_files())
+- build_rotation_plan(), with fixed rules and with retention policies
+- rotate_all(), with fixed rules and with retention policies (each on a fresh history)
+- dump_backup_files(), the listing attached to notifications
+
+Usage:
+
+    python benchmarks/bench_rotation.py [--years YEARS] [--sources SOURCES] [--tmp FOLDER] [--json FILE]
+"""
+from __future__ import print_function
+import os
+import shutil
+import argparse
+import datetime
+import tempfile
+
+from common import configure, timer, make_history, Results
+
+from easy_backup.rotate_files import RotationIndex, build_rotation_plan, rotate_all
+from easy_backup.dateparse import get_date_parser, parsers
+from easy_backup.retention import get_retention_policies
+from easy_backup import utils
+
+FOLDERS = ['daily', 'weekly', 'monthly', 'yearly', 'quarantine', ]
+
+RETENTION = [
+    ('keep_last', '3'),
+    ('keep_daily', '7'),
+    ('keep_weekly', '4'),
+    ('keep_monthly', '12'),
+    ('keep_yearly', '3'),
+    ('policy_1', 'postgresql.db00: keep_daily=30'),
+]
+
+
+def setup(root, name, years, sources, retention):
+    target_root = os.path.join(root, name)
+    config = configure(target_root)
+    if retention:
+        for item, value in RETENTION:
+            config.set('rotation', item, value)
+    count = make_history(target_root, years=years, sources=sources)
+    for folder in FOLDERS[1:]:
+        os.makedirs(os.path.join(target_root, folder))
+    return target_root, count
+
+
+def bench_planning(results, target_root, count, retention):
+    label = 'retention' if retention else 'rules'
+    policies = get_retention_policies() if retention else None
+    today = datetime.date.today()
+    original_cwd = os.getcwd()
+    os.chdir(target_root)
+    try:
+        # start with cold date parser caches
+        parsers.clear()
+        t0 = timer()
+        index = RotationIndex(FOLDERS, today, get_date_parser(None))
+        results.add('RotationIndex[%s]' % label, timer() - t0, files=count)
+
+        t0 = timer()
+        plan = build_rotation_plan(index, 'daily', 'weekly', 'monthly', 'yearly', 'quarantine', 7, today, policies)
+        results.add('build_rotation_plan[%s]' % label, timer() - t0, files=count, actions=len(plan.actions))
+    finally:
+        os.chdir(original_cwd)
+
+
+def bench_rotate_all(results, target_root, count, retention):
+    label = 'retention' if retention else 'rules'
+    parsers.clear()
+    t0 = timer()
+    errors = rotate_all(target_root, 'daily', 'weekly', 'monthly', 'yearly', 'quarantine', 7, False,
+        policies=get_retention_policies() if retention else None)
+    results.add('rotate_all[%s]' % label, timer() - t0, files=count, errors=errors)
+
+    t0 = timer()
+    text = utils.dump_backup_files(target_root, *FOLDERS)
+    results.add('dump_backup_files[%s]' % label, timer() - t0, lines=len(text.splitlines()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rotation benchmarks on a synthetic backup history')
+    parser.add_argument('--years', type=int, default=5, help="years of nightly backups (default: 5)")
+    parser.add_argument('--sources', type=int, default=20, help="backup files per night (default: 20)")
+    parser.add_argument('--tmp', default=None, help="folder for the synthetic history")
+    parser.add_argument('--json', default=None, help="save results as JSON into this file")
+    args = parser.parse_args()
+
+    results = Results('rotation')
+    root = tempfile.mkdtemp(prefix='easy_backup_bench_', dir=args.tmp)
+    try:
+        for retention in [False, True, ]:
+            name = 'retention' if retention else 'rules'
+            t0 = timer()
+            target_root, count = setup(root, name, args.years, args.sources, retention)
+            print('Synthetic history "%s" (%d files) created in %.1f s' % (name, count, timer() - t0))
+            bench_planning(results, target_root, count, retention)
+            bench_rotate_all(results, target_root, count, retention)
+    finally:
+        shutil.rmtree(root)
+
+    if args.json:
+        results.write(args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Helpers shared by the benchmarks: easy_backup setup with local stand-ins
+(a temporary target folder, no mount command, no database server), synthetic
+data generators, and results collection as JSON.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import datetime
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from easy_backup.args import set_args
+from easy_backup.configuration import get_config
+from easy_backup.compressors import COMPRESSORS
+from easy_backup import utils
+
+timer = getattr(time, 'perf_counter', time.time)
+
+BASE_CONFIG = """
+[general]
+mount_command=
+umount_command=
+target_root=%(target_root)s
+target_subfolder=daily
+max_workers=%(max_workers)d
+compressor=%(compressor)s
+compression_threads=0
+backend=files
+skip_unchanged=False
+check_free_space=False
+stats=False
+
+[data_folders]
+enabled=True
+engine=%(engine)s
+incremental=False
+include_1=%(include)s
+
+[postgresql]
+enabled=False
+
+[mysql]
+enabled=False
+
+[verify]
+enabled=False
+
+[rotation]
+enabled=True
+daily=daily
+weekly=weekly
+monthly=monthly
+yearly=yearly
+quarantine=quarantine
+quarantine_max_age=7
+"""
+
+
+def configure(target_root, include='', compressor='gzip', engine='tar', max_workers=1):
+    """
+    Replace the global configuration (and arguments) of easy_backup;
+    further items can be added with config.set()
+    """
+    set_args(argparse.Namespace(dry_run=False, verbosity=0, command='backup'))
+    config = get_config()
+    for section in config.sections():
+        config.remove_section(section)
+    config.read_string(BASE_CONFIG % {
+        'target_root': target_root,
+        'include': include,
+        'compressor': compressor,
+        'engine': engine,
+        'max_workers': max_workers,
+    })
+    return config
+
+
+def available_compressors():
+    return sorted([name for name, compressor in COMPRESSORS.items() if utils.find_executable(compressor.program)])
+
+
+################################################################################
+# Synthetic data
+
+TEXT_WORDS = ['backup', 'database', 'folder', 'archive', 'rotation', 'daily', 'weekly', 'select',
+              'insert', 'values', 'null', 'true', 'false', '2018-03-01', '42', 'lorem', 'ipsum', ]
+
+
+def synthetic_bytes(rnd, size, compressible=True):
+    """
+    Text-like (compressible) or random (incompressible) content
+    """
+    if not compressible:
+        return os.urandom(size)
+    line = ' '.join(rnd.choice(TEXT_WORDS) for i in range(12)) + '\n'
+    text = []
+    length = 0
+    while length < size:
+        if rnd.random() < 0.2:
+            line = ' '.join(rnd.choice(TEXT_WORDS) for i in range(12)) + '\n'
+        text.append(line)
+        length += len(line)
+    return ''.join(text).encode('utf-8')[:size]
+
+
+def make_small_files(root, count=20000, min_size=512, max_size=8192, per_folder=200, seed=0):
+    """
+    Many small, compressible files (es: source code or mail folders)
+    """
+    rnd = random.Random(seed)
+    for i in range(count):
+        folder = os.path.join(root, 'd%04d' % (i // per_folder))
+        if i % per_folder == 0:
+            os.makedirs(folder)
+        with open(os.path.join(folder, 'f%06d.txt' % i), 'wb') as f:
+            f.write(synthetic_bytes(rnd, rnd.randint(min_size, max_size)))
+
+
+def make_huge_files(root, count=3, size=128 * 1024 * 1024, seed=0):
+    """
+    Few big files: half compressible, half random (es: media or VM images)
+    """
+    rnd = random.Random(seed)
+    os.makedirs(root)
+    block = 4 * 1024 * 1024
+    for i in range(count):
+        with open(os.path.join(root, 'huge%02d.bin' % i), 'wb') as f:
+            written = 0
+            while written < size:
+                n = min(block, size - written)
+                f.write(synthetic_bytes(rnd, n, compressible=(written // block) % 2 == 0))
+                written += n
+
+
+def make_deep_tree(root, depth=40, breadth=2, files_per_folder=3, seed=0):
+    """
+    A deep hierarchy, with a few small files per folder
+    """
+    rnd = random.Random(seed)
+
+    def fill(folder, level):
+        os.makedirs(folder)
+        for i in range(files_per_folder):
+            with open(os.path.join(folder, 'file%d.cfg' % i), 'wb') as f:
+                f.write(synthetic_bytes(rnd, rnd.randint(100, 2000)))
+        if level < depth:
+            # only the first branch goes deeper, to keep the number of folders linear
+            for b in range(breadth):
+                if b == 0:
+                    fill(os.path.join(folder, 'level%02d_%d' % (level, b)), level + 1)
+                else:
+                    leaf = os.path.join(folder, 'level%02d_%d' % (level, b))
+                    os.makedirs(leaf)
+                    with open(os.path.join(leaf, 'leaf.txt'), 'wb') as f:
+                        f.write(synthetic_bytes(rnd, 1000))
+
+    fill(root, 0)
+
+
+TREES = {
+    'small_files': make_small_files,
+    'huge_files': make_huge_files,
+    'deep_tree': make_deep_tree,
+}
+
+
+def make_history(target_root, years=5, sources=20, runs_per_day=1, today=None):
+    """
+    Years of nightly backups of several sources, all still in the daily folder
+    (as after the first rotation run); files are empty, since rotation only
+    looks at names
+    """
+    today = today or datetime.date.today()
+    daily = os.path.join(target_root, 'daily')
+    os.makedirs(daily)
+    names = ['postgresql.db%02d.gz' % i for i in range(sources - 2)] + ['etc.tgz', 'var.www.tgz', ]
+    count = 0
+    for day in range(years * 365):
+        date = today - datetime.timedelta(days=day)
+        for run in range(runs_per_day):
+            prefix = '%s_%02d-00-00__' % (date.strftime('%Y-%m-%d'), 1 + run)
+            for name in names:
+                open(os.path.join(daily, prefix + name), 'w').close()
+                count += 1
+    return count
+
+
+def dump_command(size):
+    """
+    Database stand-in: a command (list of arguments) writing about size bytes
+    of SQL-like text to stdout
+    """
+    script = (
+        "import sys, random\n"
+        "rnd = random.Random(0)\n"
+        "out = getattr(sys.stdout, 'buffer', sys.stdout)\n"
+        "written = 0\n"
+        "words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta']\n"
+        "while written < %d:\n"
+        "    rows = ''.join(['INSERT INTO t VALUES (%%d, \\'%%s\\', %%f);\\n' %% (written + i, ' '.join(rnd.sample(words, 4)), rnd.random())\n"
+        "                    for i in range(1000)]).encode()\n"
+        "    out.write(rows)\n"
+        "    written += len(rows)\n"
+    ) % size
+    return [sys.executable, '-c', script]
+
+
+################################################################################
+# Results
+
+class Results(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = []
+
+    def add(self, benchmark, seconds, **items):
+        entry = dict(benchmark=benchmark, seconds=round(seconds, 4))
+        entry.update(items)
+        self.entries.append(entry)
+        details = ', '.join(['%s=%s' % (key, value) for key, value in sorted(items.items())])
+        print('%-40s %9.3f s  %s' % (benchmark, seconds, details))
+        sys.stdout.flush()
+        return entry
+
+    def write(self, filepath):
+        data = {
+            'suite': self.name,
+            'date': datetime.datetime.now().isoformat(),
+            'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+            'easy_backup': utils.get_version(),
+            'results': self.entries,
+        }
+        with open(filepath, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        print('Results saved as "%s"' % filepath)
@@ -0,0 +1,291 @@
+"""
+Streaming archiver.
+
+An alternative to shelling out to tar: the entries collected by scanner.scan_folder()
+are written in a single pass as a tar stream (tarfile in "w|" mode), which is compressed
+in-process (gzip) or piped into the external compressor (pigz, zstd), or split into chunks
+by the chunk store.
+
+The sha256 and the size of the output are computed on the fly, so they are available
+without reading the archive again.
+"""
+import os
+import sys
+import time
+import zlib
+import hashlib
+import logging
+import tarfile
+import threading
+
+from .args import get_args
+from .compressors import GzipCompressor
+from .chunkstore import ChunkStore, ChunkWriter
+from .journal import final_filename
+from .process import Pipeline, ProcessError, PIPE, check_result
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+BUFFER_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# same format produced by GNU tar
+TAR_FORMAT = tarfile.GNU_FORMAT
+
+
+class ArchiveResult(object):
+    """
+    Result of Archiver.run():
+    - entries: the number of entries archived (folders included)
+    - input_size: the total size of the files read, in bytes
+    - output_size: the size of the archive (or of the stream, for the chunk store)
+    - checksum: the sha256 of the archive (or of the stream, for the chunk store)
+    - seconds: elapsed time
+    """
+
+    def __init__(self, entries, input_size, output_size, checksum, seconds):
+        self.entries = entries
+        self.input_size = input_size
+        self.output_size = output_size
+        self.checksum = checksum
+        self.seconds = seconds
+
+    def __str__(self):
+        return '%d entries, %s read, %s written in %.1fs (%s/s)' % (
+            self.entries,
+            utils.sizeof_fmt(self.input_size),
+            utils.sizeof_fmt(self.output_size),
+            self.seconds,
+            utils.sizeof_fmt(self.input_size / max(self.seconds, 0.001)),
+        )
+
+
+class HashingOutput(object):
+    """
+    Write data to a file with large buffered writes, counting bytes and updating the sha256;
+    an optional throttle.RateLimiter limits the write rate
+    """
+
+    def __init__(self, filepath, limiter=None):
+        self.file = open(filepath, 'wb', BUFFER_SIZE)
+        self.limiter = limiter
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        self.digest.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        return self.size, self.digest.hexdigest()
+
+    def abort(self):
+        self.file.close()
+
+
+class GzipOutput(HashingOutput):
+    """
+    In-process gzip compression (same output format as "gzip -c")
+    """
+
+    def __init__(self, filepath, level=None, limiter=None):
+        super(GzipOutput, self).__init__(filepath, limiter)
+        # wbits = 16 + MAX_WBITS: write gzip header and trailer
+        self.compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            super(GzipOutput, self).write(compressed)
+
+    def close(self):
+        super(GzipOutput, self).write(self.compressor.flush())
+        return super(GzipOutput, self).close()
+
+
+class ProcessOutput(object):
+    """
+    Pipe data into an external compressor (see process.Pipeline); its output is copied
+    to the target file by a separate thread, which also computes size and checksum
+    """
+
+    def __init__(self, filepath, compressor, limiter=None, timeout=None):
+        self.output = HashingOutput(filepath, limiter)
+        self.pipeline = Pipeline([compressor.command(), ], timeout=timeout).start(stdin=PIPE, stdout=PIPE)
+        self.error = None
+        self.thread = threading.Thread(target=self.copy_output)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def copy_output(self):
+        try:
+            while True:
+                data = self.pipeline.stdout.read(READ_SIZE)
+                if not data:
+                    break
+                self.output.write(data)
+        except Exception as e:
+            self.error = e
+
+    def write(self, data):
+        self.pipeline.stdin.write(data)
+
+    def close(self):
+        self.pipeline.stdin.close()
+        self.thread.join()
+        result = check_result(self.pipeline.wait(), False)
+        output = self.output.close()
+        if self.error is not None:
+            raise self.error
+        if not result.ok:
+            error = ProcessError(result)
+            logger.error(str(error))
+            raise error
+        return output
+
+    def abort(self):
+        self.pipeline.kill()
+        self.pipeline.wait()
+        self.output.close()
+
+
+class ChunkOutput(object):
+    """
+    Save the stream in the chunk store; the checksum refers to the uncompressed stream
+    """
+
+    def __init__(self, filepath, store):
+        self.writer = ChunkWriter(store, filepath, final_filename(filepath))
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.writer.write(data)
+
+    def close(self):
+        manifest = self.writer.close()
+        return manifest['size'], self.digest.hexdigest()
+
+    def abort(self):
+        # chunks already saved will be garbage-collected, unless referenced by other manifests
+        pass
+
+
+def open_output(filepath, output_format, limiter=None, timeout=None):
+    if isinstance(output_format, ChunkStore):
+        # the chunk store has its own limiter
+        return ChunkOutput(filepath, output_format)
+    if type(output_format) is GzipCompressor:
+        return GzipOutput(filepath, output_format.level, limiter)
+    return ProcessOutput(filepath, output_format, limiter, timeout)
+
+
+class PaddedFile(object):
+    """
+    Read exactly size bytes from a file, padding with zeros if it shrank
+    in the meantime (as GNU tar does), so that the tar stream stays consistent
+    """
+
+    def __init__(self, fileobj, size, path):
+        self.fileobj = fileobj
+        self.remaining = size
+        self.path = path
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        if len(data) < size:
+            logger.warning('File shrank by %d bytes; padding with zeros: "%s"' % (self.remaining - len(data), self.path))
+            data += b'\0' * (size - len(data))
+        self.remaining -= len(data)
+        return data
+
+
+class Archiver(object):
+    """
+    Write a tar archive of a folder scan (see scanner.scan_folder()) to target_file;
+    timeout limits the duration of the external compressor, if any
+    """
+
+    def __init__(self, scan, target_file, output_format, limiter=None, timeout=None):
+        self.scan = scan
+        self.target_file = target_file
+        self.output_format = output_format
+        self.limiter = limiter
+        self.timeout = timeout
+        self.parent_folder = os.path.dirname(scan.folder)
+
+    def run(self):
+        if get_args().dry_run:
+            message = 'Archiving "%s" into "%s" (%d entries)' % (self.scan.folder, self.target_file, len(self.scan.entries))
+            sys.stderr.write("\x1b[1;37;40m" + message + "\x1b[0m\n")
+            return None
+
+        started = time.time()
+        output = open_output(self.target_file, self.output_format, self.limiter, self.timeout)
+        entries = 0
+        input_size = 0
+        try:
+            archive = tarfile.open(fileobj=output, mode='w|', bufsize=BUFFER_SIZE,
+                format=TAR_FORMAT, dereference=True)
+            for entry in self.scan.entries:
+                size = self.add(archive, entry)
+                if size is not None:
+                    entries += 1
+                    input_size += size
+            archive.close()
+            output_size, checksum = output.close()
+        except:
+            output.abort()
+            if os.path.exists(self.target_file):
+                os.unlink(self.target_file)
+            raise
+
+        result = ArchiveResult(entries, input_size, output_size, checksum, time.time() - started)
+        logger.info('Archived "%s": %s' % (self.scan.folder, result))
+        logger.debug('sha256 %s  %s' % (result.checksum, os.path.basename(self.target_file)))
+        return result
+
+    def add(self, archive, entry):
+        """
+        Add a single entry (not recursively); returns the number of bytes read,
+        or None when the entry has been skipped
+        """
+        path = os.path.join(self.parent_folder, entry.path)
+        started = time.time()
+        try:
+            info = archive.gettarinfo(path, arcname=entry.path)
+        except OSError as e:
+            logger.warning('Unable to archive "%s": %s' % (path, str(e)))
+            return None
+        if info is None:
+            # sockets are not supported by tar
+            logger.debug('Skipped: "%s"' % path)
+            return None
+
+        if not info.isreg():
+            archive.addfile(info)
+            return 0
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError) as e:
+            logger.warning('Unable to read "%s": %s' % (path, str(e)))
+            return None
+        with f:
+            archive.addfile(info, PaddedFile(f, info.size, path))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            seconds = time.time() - started
+            logger.debug('%s: %s in %.3fs (%s/s)' % (
+                entry.path,
+                utils.sizeof_fmt(info.size),
+                seconds,
+                utils.sizeof_fmt(info.size / max(seconds, 0.001)),
+            ))
+        return info.size
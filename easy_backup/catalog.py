@@ -0,0 +1,233 @@
+import logging
+
+from .configuration import get_config
+from .process import get_timeout
+from . import process
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+
+class Database(object):
+    """
+    A database as listed by the server catalog:
+    - size: in bytes
+    - last_modified: most recent table update time (MySQL only; None when not available)
+    - changes: number of rows inserted, updated or deleted since statistics reset (PostgreSQL only)
+    """
+
+    def __init__(self, name, size=0, last_modified=None, changes=None):
+        self.name = name
+        self.size = size
+        self.last_modified = last_modified
+        self.changes = changes
+
+    def __str__(self):
+        return '%s (%s)' % (self.name, utils.sizeof_fmt(self.size))
+
+
+def run_query(command, section):
+    """
+    Run a catalog query (in dry-run mode too) within the timeout of section,
+    and return its output as text
+    """
+    result = process.run([command, ], timeout=get_timeout(section), force=True, capture=True)
+    return result.stdout.decode('utf-8')
+
+
+################################################################################
+
+POSTGRESQL_DATABASES_QUERY = """
+SELECT
+    d.datname,
+    pg_database_size(d.oid),
+    COALESCE(s.tup_inserted + s.tup_updated + s.tup_deleted, 0)
+FROM pg_database d
+LEFT JOIN pg_stat_database s ON s.datid = d.oid
+WHERE d.datallowconn
+ORDER BY d.datname
+"""
+
+
+def postgresql_command(command):
+    return ['sudo', '-u', get_config().get_item('postgresql', 'root_user'), ] + command
+
+
+def query_postgresql(sql, columns, database=None):
+    """
+    Run a query with psql; returns the list of rows, each being a list of values.
+
+    Output is unaligned and tuples-only, with both fields and records terminated by
+    zero bytes, so that any value (spaces included) is correctly parsed.
+    """
+    command = postgresql_command(['psql', '-X', '-q', '-A', '-t', '-z', '-0', '-v', 'ON_ERROR_STOP=1', ])
+    if database is not None:
+        command += ['-d', database]
+    output = run_query(command + ['-c', ' '.join(sql.split())], 'postgresql')
+    if output.endswith('\0'):
+        output = output[:-1]
+    if not output:
+        return []
+    values = output.split('\0')
+    if len(values) % columns != 0:
+        raise Exception('Unexpected query output: %d values for %d columns' % (len(values), columns))
+    return [values[i:i + columns] for i in range(0, len(values), columns)]
+
+
+def list_postgresql_databases():
+    """
+    Returns the connectable postgresql databases (hence template0 is skipped)
+    """
+    return [
+        Database(name, size=int(size), changes=int(changes))
+        for name, size, changes in query_postgresql(POSTGRESQL_DATABASES_QUERY, 3)
+    ]
+
+
+# Activity counters and their availability (track_counts), statistics reset and server
+# start times (counters restart from zero after a crash), the storage of each table
+# (relfilenode changes on TRUNCATE, which is not counted), the values of all sequences
+# (nextval() and setval() are not counted either), and a signature of the schema
+# (tables, columns and functions).
+POSTGRESQL_FINGERPRINT_QUERY = """
+SELECT
+    current_setting('track_counts'),
+    (SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables),
+    (SELECT COALESCE(stats_reset::text, '') FROM pg_stat_database WHERE datname = current_database()),
+    pg_postmaster_start_time()::text,
+    (SELECT md5(COALESCE(string_agg(c.oid::text || ':' || c.relfilenode::text, ',' ORDER BY c.oid), ''))
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'm') AND n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg_toast%'),
+    (SELECT md5(COALESCE(string_agg(schemaname || '.' || sequencename || ':' || COALESCE(last_value::text, ''), ','
+        ORDER BY schemaname, sequencename), ''))
+        FROM pg_sequences),
+    (SELECT md5(COALESCE(string_agg(c.oid::text || ':' || c.relname || ':' || a.attname || ':' || a.atttypid::text, ','
+        ORDER BY c.oid, a.attnum), ''))
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid
+        WHERE n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg_toast%'),
+    (SELECT md5(COALESCE(string_agg(p.oid::text || ':' || p.proname || ':' || p.prosrc, ',' ORDER BY p.oid), ''))
+        FROM pg_proc p
+        JOIN pg_namespace n ON n.oid = p.pronamespace
+        WHERE n.nspname NOT IN ('pg_catalog', 'information_schema'))
+"""
+
+
+def postgresql_fingerprint(database):
+    """
+    Returns a string which changes whenever data or schema of database change
+    (PostgreSQL 10 or later, for pg_sequences).
+
+    Activity counters are cumulative, and are updated when transactions end
+    (including rolled back ones): so computing the fingerprint before dumping
+    may cause an unneeded dump the next time, but never a missed one.
+
+    Returns None, so that the database is always dumped, when changes can't be
+    detected: counters are not collected (track_counts is off), or are all zero
+    and have never been reset (es: statistics lost in a crash, or never collected).
+    """
+    row = query_postgresql(POSTGRESQL_FINGERPRINT_QUERY, 8, database=database)[0]
+    track_counts, changes, stats_reset = row[:3]
+    if track_counts != 'on':
+        return None
+    if int(changes) == 0 and not stats_reset:
+        return None
+    return '|'.join(row[1:])
+
+
+################################################################################
+
+MYSQL_DATABASES_QUERY = """
+SELECT
+    s.SCHEMA_NAME,
+    COALESCE(SUM(t.DATA_LENGTH + t.INDEX_LENGTH), 0),
+    MAX(t.UPDATE_TIME)
+FROM information_schema.SCHEMATA s
+LEFT JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = s.SCHEMA_NAME
+GROUP BY s.SCHEMA_NAME
+ORDER BY s.SCHEMA_NAME
+"""
+
+MYSQL_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', '\\': '\\', }
+
+
+def mysql_command(command):
+    return [
+        command,
+        '--host', 'localhost',
+        '--user', get_config().get_item('mysql', 'root_user'),
+        '--password=%s' % get_config().get_item('mysql', 'root_password'),
+    ]
+
+
+def mysql_unescape(value):
+    """
+    Decode a value printed by mysql in batch mode
+    """
+    if value == 'NULL':
+        return None
+    if '\\' not in value:
+        return value
+    chars = []
+    i = 0
+    while i < len(value):
+        if value[i] == '\\' and i + 1 < len(value):
+            chars.append(MYSQL_ESCAPES.get(value[i + 1], value[i + 1]))
+            i += 2
+        else:
+            chars.append(value[i])
+            i += 1
+    return ''.join(chars)
+
+
+def query_mysql(sql):
+    """
+    Run a query with mysql; returns the list of rows, each being a list of values.
+
+    In batch mode (-B), values are separated by tabs and special characters
+    are escaped; -N skips the column names.
+    """
+    output = run_query(mysql_command('mysql') + ['-N', '-B', '-e', ' '.join(sql.split())], 'mysql')
+    return [
+        [mysql_unescape(value) for value in line.split('\t')]
+        for line in output.split('\n') if line
+    ]
+
+
+MYSQL_FINGERPRINT_QUERY = """
+SELECT
+    COUNT(*),
+    SUM(UPDATE_TIME IS NULL AND ENGINE IS NOT NULL),
+    COALESCE(MAX(UPDATE_TIME), ''),
+    COALESCE(MAX(CREATE_TIME), ''),
+    COALESCE(SUM(DATA_LENGTH + INDEX_LENGTH), 0),
+    COALESCE(MAX(UPDATE_TIME) >= NOW() - INTERVAL 5 SECOND, 0)
+FROM information_schema.TABLES
+WHERE TABLE_SCHEMA = '%s'
+"""
+
+
+def mysql_fingerprint(database):
+    """
+    Returns a string which changes whenever data or schema of database change,
+    based on the tables' update and create times.
+
+    Returns None when some table has no update time (this is the case for InnoDB
+    tables after a server restart), since changes can't be detected;
+    and also when some table has just been updated, since update times have
+    a resolution of one second.
+    """
+    name = database.replace('\\', '\\\\').replace("'", "\\'")
+    tables, unknown, update_time, create_time, size, recent = query_mysql(MYSQL_FINGERPRINT_QUERY % name)[0]
+    if int(unknown or 0) > 0 or int(recent):
+        return None
+    return '|'.join([tables, update_time, create_time, size])
+
+
+def list_mysql_databases():
+    return [
+        Database(name, size=int(size), last_modified=last_modified)
+        for name, size, last_modified in query_mysql(MYSQL_DATABASES_QUERY)
+    ]
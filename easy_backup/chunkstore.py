@@ -0,0 +1,321 @@
+"""
+Content-addressed chunk store.
+
+Archive and dump streams are split into content-defined chunks, and each chunk
+is saved (zlib-compressed) only once, in <target_root>/<chunk_store>/<id[:2]>/<id>,
+where id is the sha256 of the chunk contents.
+
+Each backup is represented by a small json manifest listing its chunks;
+manifests are named as usual ("TIMESTAMP__name.chunks") and are rotated as any other
+backup file; chunks no longer referenced by any manifest are garbage-collected
+after rotation.
+
+Usage (restore):
+
+    python -m easy_backup.chunkstore MANIFEST [OUTPUT_FILE]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import zlib
+import hashlib
+import logging
+import argparse
+import threading
+
+from .args import get_args
+from .configuration import get_config
+from .throttle import get_rate_limiter
+from .metrics import record_exit_code, record_output_size
+from .journal import final_filename
+from .process import Pipeline, ProcessError, PIPE, format_pipeline
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+MANIFEST_FORMAT = 1
+READ_SIZE = 8 * 1024 * 1024
+
+
+class Chunker(object):
+    """
+    Split a stream into content-defined chunks.
+
+    Cut points are only considered at line boundaries (after a b'\\n' byte),
+    which are quickly located with bytes.find(); a line terminates a chunk when
+    the crc32 of its content falls below a threshold proportional to its length,
+    so that the expected chunk size does not depend on the average line length.
+    Since each decision depends on the line contents only, boundaries resynchronize
+    soon after an insertion or deletion, and unchanged regions produce the same chunks.
+    Chunks are never smaller than min_size (unless at the end of stream)
+    nor larger than max_size.
+    """
+
+    def __init__(self, min_size, avg_size, max_size):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.threshold = float(2 ** 32) / max(1, avg_size - min_size)
+        self.buffer = bytearray()
+        self.scan = 0
+
+    def feed(self, data):
+        """
+        Append data to the stream; returns the list of completed chunks
+        """
+        chunks = []
+        buffer = self.buffer
+        buffer += data
+        start = 0
+        pos = self.scan
+        while True:
+            n = buffer.find(b'\n', pos)
+            if n < 0:
+                while len(buffer) - start >= self.max_size:
+                    chunks.append(bytes(buffer[start:start + self.max_size]))
+                    start += self.max_size
+                pos = max(pos, start)
+                break
+            end = n + 1
+            size = end - start
+            if size >= self.max_size:
+                while end - start >= self.max_size:
+                    chunks.append(bytes(buffer[start:start + self.max_size]))
+                    start += self.max_size
+            elif size >= self.min_size and zlib.crc32(bytes(buffer[pos:end])) & 0xffffffff < (end - pos) * self.threshold:
+                chunks.append(bytes(buffer[start:end]))
+                start = end
+            pos = end
+        del buffer[:start]
+        self.scan = pos - start
+        return chunks
+
+    def finish(self):
+        """
+        Returns the last chunk, if any
+        """
+        chunks = [bytes(self.buffer)] if self.buffer else []
+        self.buffer = bytearray()
+        self.scan = 0
+        return chunks
+
+
+class ChunkWriter(object):
+    """
+    File-like object: data written is split into chunks and saved in the store;
+    the manifest is written on close()
+    """
+
+    def __init__(self, store, manifest_file, name):
+        self.store = store
+        self.manifest_file = manifest_file
+        self.name = name
+        self.chunker = Chunker(store.min_size, store.avg_size, store.max_size)
+        self.chunks = []
+        self.total_size = 0
+        self.written_size = 0
+
+    def save(self, data_chunks):
+        for data in data_chunks:
+            chunk_id, written = self.store.put(data)
+            self.chunks.append([chunk_id, len(data)])
+            if written:
+                self.written_size += len(data)
+
+    def write(self, data):
+        self.total_size += len(data)
+        self.save(self.chunker.feed(data))
+
+    def close(self):
+        self.save(self.chunker.finish())
+        manifest = {
+            'format': MANIFEST_FORMAT,
+            'name': self.name,
+            'size': self.total_size,
+            'chunks': self.chunks,
+        }
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_file, self.manifest_file)
+
+        # the job's output is the new data only
+        record_output_size(self.written_size)
+        logger.info('Stored "%s": %d chunks, %s, %s new' % (
+            os.path.basename(self.manifest_file),
+            len(self.chunks),
+            utils.sizeof_fmt(self.total_size),
+            utils.sizeof_fmt(self.written_size),
+        ))
+        return manifest
+
+
+class ChunkStore(object):
+
+    extension = '.chunks'
+    archive_extension = '.tar.chunks'
+
+    def __init__(self, folder, min_size=256 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024, level=6, limiter=None):
+        self.folder = folder
+        # optional throttle.RateLimiter for chunk writes
+        self.limiter = limiter
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.level = level
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.folder, chunk_id[:2], chunk_id)
+
+    def put(self, data):
+        """
+        Save a chunk unless already available; returns (chunk_id, written)
+        """
+        chunk_id = hashlib.sha256(data).hexdigest()
+        filepath = self.chunk_path(chunk_id)
+        if os.path.exists(filepath):
+            return chunk_id, False
+        folder = os.path.dirname(filepath)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created in the meantime by a concurrent job
+                pass
+        tmp_filepath = '%s.%d.%d.tmp' % (filepath, os.getpid(), threading.current_thread().ident)
+        compressed = zlib.compress(data, self.level)
+        if self.limiter is not None:
+            self.limiter.consume(len(compressed))
+        with open(tmp_filepath, 'wb') as f:
+            f.write(compressed)
+            # chunks must be on disk before any manifest referring to them
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filepath, filepath)
+        return chunk_id, True
+
+    def get(self, chunk_id):
+        with open(self.chunk_path(chunk_id), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != chunk_id:
+            raise Exception('Chunk "%s" is corrupted' % chunk_id)
+        return data
+
+    def store_stream(self, stream, manifest_file, name):
+        """
+        Split stream into chunks, save new chunks, and write the manifest
+        """
+        writer = ChunkWriter(self, manifest_file, name)
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            writer.write(data)
+        return writer.close()
+
+    def backup(self, stages, manifest_file, timeout=None):
+        """
+        Run a pipeline (see process.Pipeline), and save its output in the store
+        """
+        command = format_pipeline(stages)
+        if get_args().dry_run:
+            sys.stderr.write("\x1b[1;37;40m" + command + " > [chunks] " + manifest_file + "\x1b[0m\n")
+            return
+        logger.debug('Run command: "' + command + '" > [chunks]')
+        pipeline = Pipeline(stages, timeout=timeout).start(stdout=PIPE)
+        try:
+            self.store_stream(pipeline.stdout, manifest_file, final_filename(manifest_file))
+        except:
+            pipeline.kill()
+            pipeline.wait()
+            raise
+        result = pipeline.wait()
+        record_exit_code(result.returncode)
+        if not result.ok:
+            if os.path.exists(manifest_file):
+                os.unlink(manifest_file)
+            error = ProcessError(result)
+            logger.error(str(error))
+            raise error
+
+    def restore(self, manifest_file, output):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        for chunk_id, size in manifest['chunks']:
+            output.write(self.get(chunk_id))
+
+    def collect_garbage(self, manifest_folders, dry_run):
+        """
+        Remove all chunks not referenced by any manifest in the given folders
+        """
+        referenced = set()
+        for folder in manifest_folders:
+            if not os.path.isdir(folder):
+                continue
+            for filename in os.listdir(folder):
+                if filename.endswith(self.extension):
+                    with open(os.path.join(folder, filename)) as f:
+                        manifest = json.load(f)
+                    referenced.update([chunk_id for chunk_id, size in manifest['chunks']])
+
+        removed = 0
+        removed_size = 0
+        for subfolder in sorted(os.listdir(self.folder)):
+            folder = os.path.join(self.folder, subfolder)
+            if not os.path.isdir(folder):
+                continue
+            for filename in os.listdir(folder):
+                if filename in referenced:
+                    continue
+                filepath = os.path.join(folder, filename)
+                if dry_run:
+                    sys.stderr.write("\x1b[1;37;40m" + 'Erasing chunk "%s"' % filepath + "\x1b[0m\n")
+                else:
+                    removed_size += os.path.getsize(filepath)
+                    os.unlink(filepath)
+                removed += 1
+        logger.info('Chunk store garbage collection: %d chunks removed (%s)' % (removed, utils.sizeof_fmt(removed_size)))
+
+
+def get_chunk_store_folder():
+    return os.path.join(
+        utils.get_target_folder(include_target_subfolder=False),
+        get_config().get_item('general', 'chunk_store', default='chunks'),
+    )
+
+
+def get_chunk_store(section):
+    """
+    Returns the chunk store when the "chunks" backend has been selected
+    for the given section (or globally); otherwise, returns None
+    """
+    config = get_config()
+    backend = config.get_item(section, 'backend', default=config.get_item('general', 'backend', default='files'))
+    if backend == 'files':
+        return None
+    if backend != 'chunks':
+        raise Exception('Unknown backend "%s" in section "%s"; valid values are: files, chunks' % (backend, section))
+    return ChunkStore(get_chunk_store_folder(), limiter=get_rate_limiter(section))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Restore a backup saved in the chunk store')
+    parser.add_argument('manifest', help="manifest file")
+    parser.add_argument('output', nargs='?', help="output file (default: stdout)")
+    parser.add_argument('--store', help="chunk store folder (default: the \"chunks\" folder next to manifest's folder)")
+    args = parser.parse_args()
+
+    manifest = os.path.abspath(args.manifest)
+    folder = args.store or os.path.join(os.path.dirname(os.path.dirname(manifest)), 'chunks')
+    store = ChunkStore(folder)
+    if args.output:
+        with open(args.output, 'wb') as output:
+            store.restore(manifest, output)
+    else:
+        output = getattr(sys.stdout, 'buffer', sys.stdout)
+        store.restore(manifest, output)
+        output.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import logging
+
+from .configuration import get_config
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+
+class Compressor(object):
+    """
+    An external compression program, reading from stdin and writing to stdout
+    """
+
+    name = None
+    program = None
+    extension = None
+    archive_extension = None
+
+    def __init__(self, threads=0, level=None):
+        self.threads = threads
+        self.level = level
+
+    def __str__(self):
+        return utils.command_line(self.command())
+
+    def command(self):
+        """
+        Returns the compression command as a list of arguments
+        """
+        raise NotImplementedError()
+
+    def check(self):
+        if not utils.find_executable(self.program):
+            raise Exception('Compressor "%s" not available: "%s" not found' % (self.name, self.program))
+
+
+class GzipCompressor(Compressor):
+
+    name = 'gzip'
+    program = 'gzip'
+    extension = '.gz'
+    archive_extension = '.tgz'
+
+    def command(self):
+        command = [self.program, ]
+        if self.level is not None:
+            command.append('-%d' % self.level)
+        return command
+
+
+class PigzCompressor(GzipCompressor):
+    """
+    Parallel gzip; output is fully gzip-compatible
+    """
+
+    name = 'pigz'
+    program = 'pigz'
+
+    def command(self):
+        command = super(PigzCompressor, self).command()
+        if self.threads > 0:
+            command += ['-p', str(self.threads)]
+        return command
+
+
+class ZstdCompressor(Compressor):
+
+    name = 'zstd'
+    program = 'zstd'
+    extension = '.zst'
+    archive_extension = '.tar.zst'
+
+    def command(self):
+        # -T0 = use all available cores
+        command = [self.program, '-q', '-T%d' % self.threads]
+        if self.level is not None:
+            command.append('-%d' % self.level)
+        return command
+
+
+COMPRESSORS = dict([(c.name, c) for c in [GzipCompressor, PigzCompressor, ZstdCompressor, ]])
+
+
+def get_compressor(section):
+    """
+    Build the compressor for the given config section;
+    each item not specified in the section is taken from the "general" section.
+    """
+    config = get_config()
+
+    def get_item(item, default=''):
+        return config.get_item(section, item, default=config.get_item('general', item, default=default))
+
+    name = get_item('compressor', default='gzip').lower()
+    if name not in COMPRESSORS:
+        raise Exception('Unknown compressor "%s" in section "%s"; valid values are: %s' % (
+            name, section, ', '.join(sorted(COMPRESSORS.keys()))
+        ))
+    threads = get_item('compression_threads')
+    level = get_item('compression_level')
+    return COMPRESSORS[name](
+        threads=int(threads) if threads else 0,
+        level=int(level) if level else None,
+    )
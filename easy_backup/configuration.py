@@ -38,7 +38,7 @@ class Configuration(ConfigParser):
         return value
 
     def get_item_as_bool(self, section, item, default=False):
-        item = self.get_item(section, item, default='False')
+        item = self.get_item(section, item, default=str(default))
         valid = {
             "true": True,
             "y": True,
@@ -49,6 +49,12 @@ class Configuration(ConfigParser):
         }
         return valid[item.lower()]
 
+    def get_item_as_int(self, section, item, default=0):
+        value = self.get_item(section, item, default='')
+        if value == '':
+            return default
+        return int(value)
+
     def read_config_file(self, config_filename):
         """
         Parse the config file if exists;
@@ -116,6 +122,36 @@ umount_command=umount /mnt/backup
 report_backup_files_list=False
 target_root=/mnt/backup/backups/{hostname}
 target_subfolder=daily
+# Number of backup jobs (folders and database dumps) run in parallel
+max_workers=1
+# Number of concurrent jobs compressing data ("cpu") or writing into the target folder ("disk"); 0: no limit
+#max_cpu_jobs=0
+#max_disk_jobs=0
+# Compressor: gzip, pigz (parallel gzip) or zstd; can be overridden in each section
+compressor=gzip
+#compression_threads=0
+#compression_level=
+# Backend: "files" (a compressed file for each backup) or "chunks" (deduplicated chunk store);
+# can be overridden in each section
+backend=files
+#chunk_store=chunks
+# Link the previous backup instead of producing a new one when the source is unchanged;
+# can be overridden in each section
+skip_unchanged=False
+# Throttling: niceness increment, ionice class ("idle", "best-effort" or "best-effort:0" .. "best-effort:7"),
+# and maximum write rate of each job (can be overridden in each section)
+#cpu_nice=10
+#io_priority=idle
+#max_write_mb_per_s=0
+# Before each job, fail if the free space is less than the size of the previous backup of the same source
+check_free_space=True
+# Per-job metrics of the last run are saved in "<target_root>/easy_backup.metrics.json";
+# optionally, also for the Prometheus node_exporter textfile collector
+#prometheus_textfile=/var/lib/prometheus/node-exporter/easy_backup.prom
+# Record each run in "<target_root>/easy_backup.sqlite3" (see "easy_backup stats")
+stats=True
+# Maximum duration (in seconds) of each command (0: no limit); can be overridden in each section
+#timeout=0
 
 [run_before]
 enabled=False
@@ -130,16 +166,36 @@ enabled=False
 [data_folders]
 # Suggested system folders to backup: /etc /srv /root /usr/local /var/mail /var/local /var/opt /var/log
 enabled=False
+#max_workers=2
+# Archiver: "tar" (the default) or "python" (in-process, no incremental backups)
+#engine=tar
+# Incremental backups: level-0 archives on the "full_backup" schedule (daily, weekly or monthly),
+# level-1 archives on other days
+incremental=False
+#full_backup=monthly
+#snapshots=snapshots
 include_1=/home/*/www/
 include_2=/home/*/public/media
 include_3=/home/*/protected
 include_4=/home/*/private
 exclude_1=/home/baduser/public/media
+#exclude_2=node_modules
 
 [postgresql]
 enabled=True
 root_user=postgres
 vacuumdb=True
+# VACUUM ANALYZE runs on a pool of its own ("vacuum_workers" concurrent jobs), either after each dump
+# ("after_dump") or when all dumps have been completed ("deferred"); "vacuum_jobs" > 1: vacuumdb --jobs
+#vacuum_schedule=after_dump
+#vacuum_workers=1
+#vacuum_jobs=1
+#max_workers=4
+# Number of concurrent jobs on the database server (0: no limit)
+#max_server_jobs=0
+# Dump format: plain, custom or directory; "jobs" applies to the directory format only
+format=plain
+#jobs=4
 exclude_1=template0
 exclude_2=db_wrong_2
 
@@ -147,6 +203,14 @@ exclude_2=db_wrong_2
 enabled=False
 root_user=root
 root_password=
+#max_workers=2
+#max_server_jobs=0
+
+[verify]
+# Verify each new backup file (compressed stream, tar index, "pg_restore --list") while the next
+# jobs are running, and save its sha256 into "<backup file>.sha256"
+enabled=False
+#max_workers=1
 
 [rotation]
 enabled=False
@@ -156,4 +220,20 @@ monthly=monthly
 yearly=yearly
 quarantine=quarantine
 quarantine_max_age=7
+# Formats used to deduct the date of each file from its name, tried in order
+# (builtin: quarantine, date, iso, iso_basic, gitlab, epoch; or patterns such as "%%Y%%m%%d")
+#date_formats=quarantine, date, iso, iso_basic, gitlab
+# Retention policy: when any "keep_" item is given, the number of files to be retained
+# for each backup source replaces the fixed age rules; "policy_" items override
+# the counts for sources with the given name prefix
+#keep_last=3
+#keep_daily=7
+#keep_weekly=4
+#keep_monthly=12
+#keep_yearly=3
+#policy_1=postgresql.main: keep_daily=30
+#policy_2=var.log: keep_daily=3, keep_weekly=0, keep_monthly=0, keep_yearly=0
+# Storage budget for all backup folders (es: 500G); after rotation, quarantined files
+# and then the oldest backups are removed until it is met
+#max_total_size=
 """
@@ -0,0 +1,135 @@
+"""
+Filename date parser.
+
+The date of each backup file is deducted from its name, according to a list of formats
+tried in order; each format is either the name of a builtin format, or a pattern
+matched at the beginning of the filename, using the following directives:
+
+    %Y  year (4 digits)
+    %m  month (2 digits)
+    %d  day (2 digits)
+    %H, %M, %S  hours, minutes, seconds (2 digits; not used to compute the date)
+    %s  epoch (seconds since 1970-01-01; 9 or 10 digits)
+    %*  any text not containing "_"
+
+Patterns are translated into regular expressions once, and results are cached
+for each filename.
+"""
+import re
+import datetime
+
+BUILTIN_DATE_FORMATS = {
+    # "2018-03-22_____2018-03-01_01-00-00__etc.tgz" (files moved to quarantine)
+    'quarantine': '%Y-%m-%d_____',
+    # "2018-03-24_01.02.57_nexterbox3.media.tar.gz"
+    'date': '%Y-%m-%d',
+    # "2018-03-24T01:02:57_db.sql.gz", "20180324T010257_db.sql.gz"
+    'iso': '%Y-%m-%dT%H:%M:%S',
+    'iso_basic': '%Y%m%dT%H%M%S',
+    # "1521766816_2018_03_23_10.5.6-ee_gitlab_backup.tar"
+    'gitlab': '%*_%Y_%m_%d',
+    # "1521766816_db.sql.gz"
+    'epoch': '%s',
+}
+
+DEFAULT_DATE_FORMATS = ['quarantine', 'date', 'iso', 'iso_basic', 'gitlab', ]
+
+DIRECTIVES = {
+    'Y': r'(?P<Y>\d{4})',
+    'm': r'(?P<m>\d{2})',
+    'd': r'(?P<d>\d{2})',
+    'H': r'\d{2}',
+    'M': r'\d{2}',
+    'S': r'\d{2}',
+    's': r'(?P<s>\d{9,10})(?!\d)',
+    '*': r'[^_]*',
+}
+
+
+def compile_date_format(date_format):
+    """
+    Translate a builtin format name or a pattern into a compiled regular expression
+    """
+    pattern = BUILTIN_DATE_FORMATS.get(date_format, date_format)
+    if '%' not in pattern:
+        raise Exception('Invalid date format "%s"; valid values are a pattern or any of: %s' % (
+            date_format, ', '.join(sorted(BUILTIN_DATE_FORMATS.keys()))
+        ))
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '%' and i + 1 < len(pattern):
+            directive = pattern[i + 1]
+            if directive == '%':
+                regex += '%'
+            elif directive in DIRECTIVES:
+                if DIRECTIVES[directive].startswith('(?P') and DIRECTIVES[directive] in regex:
+                    raise Exception('Invalid date format "%s": repeated "%%%s"' % (date_format, directive))
+                regex += DIRECTIVES[directive]
+            else:
+                raise Exception('Invalid date format "%s": unknown directive "%%%s"' % (date_format, directive))
+            i += 2
+        else:
+            regex += re.escape(c)
+            i += 1
+    compiled = re.compile(regex)
+    groups = set(compiled.groupindex.keys())
+    if 's' not in groups and not groups.issuperset(['Y', 'm', 'd']):
+        raise Exception('Invalid date format "%s": either "%%s" or "%%Y", "%%m" and "%%d" are required' % date_format)
+    return compiled
+
+
+class FilenameDateParser(object):
+
+    def __init__(self, date_formats=None):
+        self.date_formats = list(date_formats or DEFAULT_DATE_FORMATS)
+        self.regexes = [compile_date_format(f) for f in self.date_formats]
+        self.cache = {}
+
+    def parse(self, filename):
+        """
+        Returns the date of filename, or None when no format matches
+        """
+        try:
+            return self.cache[filename]
+        except KeyError:
+            pass
+        filedate = None
+        for regex in self.regexes:
+            match = regex.match(filename)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            try:
+                if groups.get('Y') is not None:
+                    filedate = datetime.date(int(groups['Y']), int(groups['m']), int(groups['d']))
+                else:
+                    filedate = datetime.date.fromtimestamp(int(groups['s']))
+            except (ValueError, OverflowError, OSError):
+                continue
+            break
+        self.cache[filename] = filedate
+        return filedate
+
+
+parsers = {}
+
+
+def get_date_parser(date_formats=None):
+    """
+    Returns a (shared) parser for the given list of formats
+    """
+    key = tuple(date_formats or DEFAULT_DATE_FORMATS)
+    parser = parsers.get(key)
+    if parser is None:
+        parser = parsers[key] = FilenameDateParser(key)
+    return parser
+
+
+def parse_date_formats(value):
+    """
+    Split a comma-separated list of formats (es: the "date_formats" config item)
+    """
+    formats = [f.strip() for f in value.split(',') if f.strip()] if value else []
+    return formats or DEFAULT_DATE_FORMATS
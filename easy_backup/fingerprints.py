@@ -0,0 +1,167 @@
+"""
+Change fingerprints.
+
+A fingerprint is a short string which changes whenever the contents of a database
+or folder change. Fingerprints of the last successfull backups are kept in
+<target_root>/fingerprints.json; when the current fingerprint of a source matches
+the cached one, the previous backup file is hard-linked (or copied, when hard links
+are not supported) under the new timestamp, instead of producing a new one;
+as any other job output, the link (or copy) is written under a partial name first
+(see journal.partial_output()).
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import threading
+
+from .args import get_args
+from .configuration import get_config
+from .verify import copy_sidecar
+from .journal import partial_output
+from .metrics import record_status
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+FINGERPRINTS_FILENAME = 'fingerprints.json'
+
+
+class FingerprintCache(object):
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.items = {}
+        if os.path.exists(filepath):
+            try:
+                with open(filepath) as f:
+                    self.items = json.load(f)
+            except Exception as e:
+                logger.warning('Unable to read fingerprints from "%s": %s' % (filepath, str(e)))
+
+    def lookup(self, key, fingerprint):
+        """
+        Returns the filename of the previous backup with the same fingerprint, if any
+        """
+        with self.lock:
+            item = self.items.get(key)
+        if item is not None and item['fingerprint'] == fingerprint:
+            return item['filename']
+        return None
+
+    def update(self, key, fingerprint, filename):
+        if get_args().dry_run:
+            return
+        with self.lock:
+            self.items[key] = {
+                'fingerprint': fingerprint,
+                'filename': filename,
+            }
+            tmp_filepath = self.filepath + '.tmp'
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self.items, f, indent=1, sort_keys=True)
+            os.rename(tmp_filepath, self.filepath)
+
+
+cache_singleton = None
+cache_lock = threading.Lock()
+
+
+def get_fingerprint_cache():
+    global cache_singleton
+    with cache_lock:
+        if cache_singleton is None:
+            cache_singleton = FingerprintCache(os.path.join(
+                utils.get_target_folder(include_target_subfolder=False),
+                FINGERPRINTS_FILENAME,
+            ))
+    return cache_singleton
+
+
+def get_fingerprint(section, compute):
+    """
+    Returns the fingerprint computed by compute(), or None when "skip_unchanged"
+    is not enabled for section or when the fingerprint is not available
+    """
+    config = get_config()
+    if not config.get_item_as_bool(section, 'skip_unchanged', default=config.get_item_as_bool('general', 'skip_unchanged')):
+        return None
+    try:
+        fingerprint = compute()
+    except Exception as e:
+        logger.warning('Unable to compute fingerprint: %s' % str(e))
+        return None
+    logger.debug('Fingerprint: %s' % fingerprint)
+    return fingerprint
+
+
+def backup_key(target_file):
+    """
+    Cache key: the target filename without the timestamp prefix
+    (es: "postgresql.demo1.gz")
+    """
+    return os.path.basename(target_file).split('__', 1)[-1]
+
+
+def reuse_previous_backup(fingerprint, target_file):
+    """
+    If the previous backup has the same fingerprint, link it as target_file
+    and return True; otherwise, return False
+    """
+    if fingerprint is None:
+        return False
+    filename = get_fingerprint_cache().lookup(backup_key(target_file), fingerprint)
+    if filename is None:
+        return False
+    previous_file = utils.find_backup_file(filename)
+    if previous_file is None:
+        return False
+
+    message = 'Unchanged since "%s"; linking as "%s"' % (filename, os.path.basename(target_file))
+    record_status('unchanged')
+    if get_args().dry_run:
+        sys.stderr.write("\x1b[1;37;40m" + message + "\x1b[0m\n")
+        return True
+    logger.info(message)
+    with partial_output(target_file) as partial_file:
+        link_path(previous_file, partial_file)
+    copy_sidecar(previous_file, target_file)
+    get_fingerprint_cache().update(backup_key(target_file), fingerprint, os.path.basename(target_file))
+    return True
+
+
+def save_fingerprint(fingerprint, target_file):
+    if fingerprint is not None:
+        get_fingerprint_cache().update(backup_key(target_file), fingerprint, os.path.basename(target_file))
+
+
+def link_path(source, target):
+    """
+    Hard-link a file (or all files in a folder); fallback to copy
+    when hard links are not supported by the file system
+    """
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    if os.path.isdir(source):
+        shutil.copytree(source, target, copy_function=link_or_copy)
+    else:
+        link_or_copy(source, target)
+
+
+def folder_fingerprint(scan):
+    """
+    Hash of the names, sizes, modification times and modes of all entries
+    of a folder scan (see scanner.scan_folder())
+    """
+    digest = hashlib.sha1()
+    for entry in scan.entries:
+        info = '%s\0%d\0%d\0%o\n' % (entry.path, entry.size, entry.mtime_ns, entry.mode)
+        digest.update(info.encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
@@ -0,0 +1,118 @@
+import os
+import re
+import shutil
+import logging
+
+from .args import get_args
+from .configuration import get_config
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+# es: "2018-03-01_01-00-00__etc.level0.tgz"
+LEVEL_FILENAME_REGEX = re.compile(r'^(?P<timestamp>.+?)__(?P<name>.+)\.level(?P<level>[01])(\.[^.]+)+$')
+
+FULL_BACKUP_SCHEDULES = {
+    'daily': lambda date: True,
+    'weekly': lambda date: date.weekday() == 0,
+    'monthly': lambda date: date.day == 1,
+}
+
+
+def get_snapshots_folder():
+    """
+    Snapshot files live next to the target folder, in <target_root>/<snapshots>
+    """
+    return os.path.join(
+        utils.get_target_folder(include_target_subfolder=False),
+        get_config().get_item('data_folders', 'snapshots', default='snapshots'),
+    )
+
+
+def is_full_backup_day(timestamp):
+    schedule = get_config().get_item('data_folders', 'full_backup', default='monthly').lower()
+    if schedule not in FULL_BACKUP_SCHEDULES:
+        raise Exception('Invalid "full_backup" value "%s"; valid values are: %s' % (
+            schedule, ', '.join(sorted(FULL_BACKUP_SCHEDULES.keys()))
+        ))
+    return FULL_BACKUP_SCHEDULES[schedule](timestamp.date())
+
+
+class IncrementalBackup(object):
+    """
+    Keeps track of the tar snapshot file for a data folder.
+
+    A level-0 (full) archive is produced on the scheduled days, or whenever the
+    previous level-0 archive is not available anymore; on other days, a level-1
+    archive with the changes since the last level-0 archive is produced.
+    Hence each chain consists of a level-0 archive plus any one of its level-1 archives.
+    """
+
+    def __init__(self, name, timestamp):
+        self.name = name
+        self.snapshots_folder = get_snapshots_folder()
+        self.snapshot_file = os.path.join(self.snapshots_folder, name + '.snar')
+        self.base_file = os.path.join(self.snapshots_folder, name + '.base')
+        self.working_file = self.snapshot_file + '.tmp'
+        self.level = 0 if is_full_backup_day(timestamp) or not self.has_base() else 1
+
+    def has_base(self):
+        if not os.path.exists(self.snapshot_file) or not os.path.exists(self.base_file):
+            return False
+        with open(self.base_file) as f:
+            base = f.read().strip()
+        if utils.find_backup_file(base) is None:
+            logger.info('Level 0 archive "%s" not found; a new full backup is required' % base)
+            return False
+        return True
+
+    def begin(self):
+        """
+        Prepare the working snapshot file to be supplied to tar
+        """
+        if get_args().dry_run:
+            return
+        utils.assure_path_exists(self.snapshots_folder)
+        if os.path.exists(self.working_file):
+            os.unlink(self.working_file)
+        if self.level > 0:
+            shutil.copyfile(self.snapshot_file, self.working_file)
+
+    def commit(self, target_file):
+        """
+        After a successfull level-0 backup, the working snapshot becomes the new reference;
+        level-1 snapshots are discarded, so that all level-1 archives refer to the same level-0
+        """
+        if get_args().dry_run:
+            return
+        if self.level == 0:
+            os.rename(self.working_file, self.snapshot_file)
+            with open(self.base_file, 'w') as f:
+                f.write(os.path.basename(target_file))
+        else:
+            os.unlink(self.working_file)
+
+    def abort(self):
+        if os.path.exists(self.working_file):
+            os.unlink(self.working_file)
+
+
+def find_chain_bases(filenames):
+    """
+    Returns the names of the level-0 archives (among filenames) still required
+    to restore any of the level-1 archives listed in filenames
+    """
+    levels = ([], [])
+    for filename in filenames:
+        match = LEVEL_FILENAME_REGEX.match(filename)
+        if match:
+            levels[int(match.group('level'))].append(
+                (match.group('name'), match.group('timestamp'), filename)
+            )
+
+    bases = set()
+    for name, timestamp, filename in levels[1]:
+        candidates = [c for c in levels[0] if c[0] == name and c[1] <= timestamp]
+        if candidates:
+            bases.add(max(candidates)[2])
+    return bases
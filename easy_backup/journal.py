@@ -0,0 +1,201 @@
+"""
+Run journal and partial outputs.
+
+While backup jobs are running, their state ("pending", "running", "done" or "failed")
+is recorded in <target_root>/easy_backup.journal.json, together with the timestamp
+of the run; the journal is removed when all jobs have been completed.
+
+"easy_backup --resume" reloads the journal left by an interrupted run, and runs
+again only the jobs which were not completed, under the original timestamp.
+
+Each job writes its output under a temporary name (TARGET.partial), which is
+flushed to disk and renamed to the final name on success; so partial outputs
+of interrupted jobs are never mistaken for complete backups, and are not rotated.
+Partial and temporary files left by interrupted runs are removed at the start
+of each backup run.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import threading
+import contextlib
+
+from .args import get_args
+from .configuration import get_config
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+JOURNAL_FILENAME = 'easy_backup.journal.json'
+PARTIAL_EXTENSION = '.partial'
+TMP_EXTENSION = '.tmp'
+
+
+class RunJournal(object):
+
+    def __init__(self, filepath, timestamp, jobs=None):
+        self.filepath = filepath
+        self.timestamp = timestamp
+        # job key ("section: name") -> {"state", "output", "updated"}
+        self.jobs = jobs or {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath) as f:
+            data = json.load(f)
+        timestamp = datetime.datetime.strptime(data['timestamp'], '%Y-%m-%d_%H-%M-%S')
+        return cls(filepath, timestamp, data['jobs'])
+
+    def add(self, key):
+        """
+        Register a job; jobs already known (when resuming) keep their state
+        """
+        with self.lock:
+            if key in self.jobs:
+                return
+            self.jobs[key] = {'state': 'pending', 'output': None, 'updated': time.time()}
+            self.save()
+
+    def is_done(self, key):
+        """
+        Whether the job has been completed, and its output (if any) is still there
+        """
+        with self.lock:
+            item = self.jobs.get(key)
+        if item is None or item['state'] != 'done':
+            return False
+        return item['output'] is None or os.path.exists(item['output'])
+
+    def output(self, key):
+        with self.lock:
+            item = self.jobs.get(key)
+        return item['output'] if item is not None else None
+
+    def update(self, key, state, output=None):
+        with self.lock:
+            self.jobs[key] = {'state': state, 'output': output, 'updated': time.time()}
+            self.save()
+
+    def unfinished(self):
+        with self.lock:
+            return sorted([key for key, item in self.jobs.items() if item['state'] != 'done'])
+
+    def save(self):
+        # called with the lock held
+        if get_args().dry_run:
+            return
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump({
+                'timestamp': utils.timestamp_to_string(self.timestamp),
+                'jobs': self.jobs,
+            }, f, indent=1, sort_keys=True)
+        os.rename(tmp_filepath, self.filepath)
+
+    def finish(self):
+        """
+        Remove the journal when all jobs have been completed; otherwise, keep it
+        for a later "--resume"
+        """
+        unfinished = self.unfinished()
+        if unfinished:
+            logger.warning('%d job(s) not completed; run again with "--resume" to retry them: %s' % (
+                len(unfinished), ', '.join(['"%s"' % key for key in unfinished])))
+            return False
+        if not get_args().dry_run and os.path.exists(self.filepath):
+            os.unlink(self.filepath)
+        return True
+
+
+def get_journal_filepath():
+    return os.path.join(utils.get_target_folder(include_target_subfolder=False), JOURNAL_FILENAME)
+
+
+def start_journal(timestamp):
+    """
+    A new journal for the current run (replacing the journal of any previous run)
+    """
+    journal = RunJournal(get_journal_filepath(), timestamp)
+    with journal.lock:
+        journal.save()
+    return journal
+
+
+def resume_journal():
+    """
+    The journal left by the interrupted run
+    """
+    filepath = get_journal_filepath()
+    if not os.path.exists(filepath):
+        raise Exception('No interrupted run to resume ("%s" not found)' % filepath)
+    journal = RunJournal.load(filepath)
+    logger.info('Resuming run "%s": %d job(s) not completed' % (
+        utils.timestamp_to_string(journal.timestamp), len(journal.unfinished())))
+    return journal
+
+
+def partial_filepath(target_file):
+    return target_file + PARTIAL_EXTENSION
+
+
+def final_filename(filepath):
+    """
+    The name of the output being written into filepath (without the partial extension)
+    """
+    filename = os.path.basename(filepath)
+    if filename.endswith(PARTIAL_EXTENSION):
+        filename = filename[:-len(PARTIAL_EXTENSION)]
+    return filename
+
+
+@contextlib.contextmanager
+def partial_output(target_file):
+    """
+    Yield the temporary path where target_file has to be written;
+    on success, it is flushed to disk and renamed as target_file,
+    otherwise it is removed
+    """
+    partial_file = partial_filepath(target_file)
+    if get_args().dry_run:
+        yield partial_file
+        sys.stderr.write("\x1b[1;37;40m" + 'Renaming "%s" as "%s"' % (partial_file, os.path.basename(target_file)) + "\x1b[0m\n")
+        return
+    # leftover of an interrupted run
+    utils.remove_path(partial_file)
+    try:
+        yield partial_file
+    except:
+        utils.remove_path(partial_file)
+        raise
+    utils.fsync_path(partial_file)
+    os.rename(partial_file, target_file)
+    utils.fsync_folder(os.path.dirname(target_file))
+
+
+def cleanup_orphans():
+    """
+    Remove the partial and temporary files left by interrupted runs
+    from the target root and the backup folders
+    """
+    config = get_config()
+    target_root = utils.get_target_folder(include_target_subfolder=False)
+    folders = [target_root, ] + utils.get_backup_folders()
+    quarantine = config.get_item('rotation', 'quarantine') if config.has_section('rotation') else ''
+    if quarantine:
+        folders.append(os.path.join(target_root, quarantine))
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith(PARTIAL_EXTENSION) and not filename.endswith(TMP_EXTENSION):
+                continue
+            filepath = os.path.join(folder, filename)
+            if get_args().dry_run:
+                sys.stderr.write("\x1b[1;37;40m" + 'Removing orphaned file "%s"' % filepath + "\x1b[0m\n")
+                continue
+            logger.warning('Removing orphaned file "%s"' % filepath)
+            utils.remove_path(filepath)
@@ -8,14 +8,35 @@ import os
 import logging
 import argparse
 import glob
-import subprocess
 import traceback
 import datetime
+import pwd
+import time
+import tempfile
 
 from .args import get_args, set_args
 from .configuration import get_config
 from .rotate_files import rotate_all
+from .dateparse import parse_date_formats
+from .retention import get_retention_policies
+from .scheduler import build_scheduler, ALL
+from .compressors import get_compressor
+from .incremental import IncrementalBackup
+from .fingerprints import get_fingerprint, folder_fingerprint, reuse_previous_backup, save_fingerprint
+from .scanner import ExcludeMatcher, scan_folder
+from .chunkstore import ChunkStore, get_chunk_store, get_chunk_store_folder
+from .archiver import Archiver
+from .throttle import apply_process_priority, get_rate_limiter, limit_command
+from .quota import check_free_space
+from .verify import verify_backup, verify_backup_folders
+from .metrics import METRICS, METRICS_FILENAME, record_input_size, record_output
+from .stats import check_deviations, record_run, show_stats
+from .maintenance import submit_maintenance, get_vacuum_workers
+from .journal import start_journal, resume_journal, partial_output, cleanup_orphans
+from .process import get_timeout
 from . import utils
+from . import process
+from . import catalog
 from . import notify
 from .utils import ERRORS_LIST
 
@@ -25,7 +46,7 @@ logger = logging.getLogger("easy_backup")
 
 ################################################################################
 
-def backup_data_folders(timestamp, target_folder):
+def backup_data_folders(scheduler, timestamp, target_folder):
 
     logger.info('*** backup_data_folders() begin ...')
 
@@ -39,20 +60,16 @@ def backup_data_folders(timestamp, target_folder):
     logger.debug('include_patterns: %s' % str(include_patterns))
     logger.debug('exclude_patterns: %s' % str(exclude_patterns))
 
-    excluded_folders = []
-    for p in exclude_patterns:
-        excluded_folders += glob.glob(p)
+    # excludes are matched at any depth while scanning each folder
+    matcher = ExcludeMatcher(exclude_patterns)
 
-    # remove duplicates
-    excluded_folders = [x for x in set(excluded_folders)]
-
-    included_folders = []
+    included_folders = set()
     for p in include_patterns:
         for f in glob.glob(p):
-            if f not in included_folders and f not in excluded_folders:
-                included_folders.append(f)
+            if not matcher.match(f):
+                included_folders.add(f)
 
-    included_folders.sort()
+    included_folders = sorted(included_folders)
 
     for folder in included_folders:
         logger.debug('data folder: "%s"' % folder)
@@ -62,157 +79,356 @@ def backup_data_folders(timestamp, target_folder):
     #
 
     for folder in included_folders:
+        scheduler.submit('data_folders', folder, backup_data_folder, folder, matcher, timestamp, target_folder)
 
-        target_file = utils.output_filepath(target_folder, timestamp,
-            folder.replace('/', '.').strip('.').lower()
-        ) + '.tgz'
-        logger.info('Backing up data folder "%s"' % folder)
-        logger.debug('Target file: "%s"' % target_file)
+    logger.info('*** backup_data_folders() end')
 
-        # split folder into parent_folder + subfolder;
-        # Example:
-        #   '/Users/morlandi/Downloads/tmp/user/due/' --> ['/Users/morlandi/Downloads/tmp/user', 'due']
-        # but also:
-        #   '/etc/' --> ['/', 'etc']
-        path = folder.strip(os.sep)
-        parent_folder = os.sep
-        n = path.rfind(os.sep)
-        if n >= 0:
-            parent_folder += path[:n]
-        subfolder = path[n+1:]
-
-        # backup with tar; -h option = follow links
-        command = 'tar chz -C %s -f %s %s' % (parent_folder, target_file, subfolder)
-        utils.run_command(command)
 
-    logger.info('*** backup_data_folders() end')
+def get_output_format(section):
+    """
+    Returns the chunk store when the "chunks" backend has been selected for section;
+    otherwise, returns the compressor
+    """
+    store = get_chunk_store(section)
+    if store is not None:
+        return store
+    compressor = get_compressor(section)
+    compressor.check()
+    return compressor
+
+
+def limit_output(section, stages):
+    """
+    Append the write rate limiting stage to a pipeline, when required
+    """
+    limit = limit_command(section)
+    return stages + [limit, ] if limit else stages
+
+
+def save_command_output(section, command, target_file, output_format):
+    """
+    Run command (a list of arguments), and save its output into target_file
+    either compressed or in the chunk store
+    """
+    with partial_output(target_file) as partial_file:
+        if isinstance(output_format, ChunkStore):
+            output_format.backup([command, ], partial_file, timeout=get_timeout(section))
+        else:
+            stages = limit_output(section, [command, output_format.command()])
+            process.run(stages, partial_file, timeout=get_timeout(section))
+
+
+ARCHIVE_ENGINES = ['tar', 'python', ]
+
+
+def backup_data_folder(folder, matcher, timestamp, target_folder):
+
+    output_format = get_output_format('data_folders')
+    name = folder.replace('/', '.').strip('.').lower()
+
+    engine = get_config().get_item('data_folders', 'engine', default='tar').lower()
+    if engine not in ARCHIVE_ENGINES:
+        raise Exception('Invalid data_folders "engine" value "%s"; valid values are: %s' % (
+            engine, ', '.join(ARCHIVE_ENGINES)
+        ))
+
+    incremental = None
+    if get_config().get_item_as_bool('data_folders', 'incremental'):
+        if engine != 'tar':
+            raise Exception('Incremental data folder backups require the "tar" engine')
+        incremental = IncrementalBackup(name, timestamp)
+        # es: "/target_path/2017-01-01_01-01-01__etc.level0.tgz"
+        name += '.level%d' % incremental.level
+
+    target_file = utils.output_filepath(target_folder, timestamp, name,
+        compressor=output_format,
+        archive=True,
+    )
+    logger.info('Backing up data folder "%s"' % folder)
+    logger.debug('Target file: "%s"' % target_file)
+
+    # Collect files to be archived in a single pass, skipping excluded subtrees
+    scan = scan_folder(folder, matcher)
+    logger.debug('%d entries, %s, %d excluded' % (len(scan.entries), utils.sizeof_fmt(scan.total_size), len(scan.excluded)))
+    record_input_size(scan.total_size)
+
+    # level-0 archives are always produced from scratch
+    fingerprint = None
+    if incremental is None or incremental.level > 0:
+        fingerprint = get_fingerprint('data_folders', lambda: folder_fingerprint(scan))
+    if reuse_previous_backup(fingerprint, target_file):
+        return
+    check_free_space(target_file)
+
+    if engine == 'python':
+        # archive the scanned entries in-process, without running tar
+        with partial_output(target_file) as partial_file:
+            Archiver(scan, partial_file, output_format, limiter=get_rate_limiter('data_folders'),
+                     timeout=get_timeout('data_folders')).run()
+        save_fingerprint(fingerprint, target_file)
+        record_output(target_file)
+        return target_file
+
+    # The list of files is supplied to tar, which won't recurse folders by itself.
+    # In incremental mode, tar needs to scan folders to detect deleted files;
+    # so we list folders only, and explicitly exclude the excluded files.
+    list_file = write_temp_file(lambda filepath: scan.write_list(filepath, directories_only=incremental is not None))
+    exclude_file = write_temp_file(scan.write_excluded)
+
+    # backup with tar, writing the archive to stdout; -h option = follow links
+    arguments = ['tar', 'ch', ]
+    if incremental is not None:
+        arguments += ['--listed-incremental=%s' % incremental.working_file, '--no-check-device', ]
+    arguments += [
+        '-f', '-',
+        '-C', os.path.dirname(scan.folder),
+        '--null', '--anchored', '--no-wildcards', '--exclude-from=%s' % exclude_file,
+        '--no-recursion', '-T', list_file,
+    ]
+
+    if incremental is not None:
+        incremental.begin()
+    try:
+        save_command_output('data_folders', arguments, target_file, output_format)
+    except:
+        if incremental is not None:
+            incremental.abort()
+        raise
+    finally:
+        os.unlink(list_file)
+        os.unlink(exclude_file)
+    if incremental is not None:
+        incremental.commit(target_file)
+    save_fingerprint(fingerprint, target_file)
+    record_output(target_file)
+    return target_file
+
+
+def write_temp_file(write):
+    """
+    Create a temporary file, and fill it with write(filepath);
+    returns the file path
+    """
+    handle, filepath = tempfile.mkstemp(prefix='easy_backup.')
+    os.close(handle)
+    write(filepath)
+    return filepath
 
 
 ################################################################################
 
-def backup_postgresql_databases(timestamp, target_folder):
+def build_postgresql_command(arguments):
+    return ['sudo', '-u', get_config().get_item('postgresql', 'root_user'), ] + arguments
+
+
+def collect_databases(section, list_databases):
+    """
+    List databases from the server catalog, skipping the excluded ones;
+    the biggest databases come first, so that they are dumped first
+    """
+    try:
+        databases = list_databases()
+    except Exception as e:
+        logger.error(str(e))
+        ERRORS_LIST.append({
+            'message': str(e),
+            'traceback': traceback.format_exc(),
+        })
+        return []
+    if len(databases) <= 0:
+        logger.error('empty database list')
+
+    excluded = [value for key, value in get_config().items(section) if key.startswith('exclude_')]
+    databases = [d for d in databases if d.name not in excluded]
+    databases.sort(key=lambda d: d.size, reverse=True)
+    for database in databases:
+        logger.debug('%s database: %s' % (section, database))
+    return databases
 
-    def build_postgresql_command(command):
-        return 'sudo -u %s %s' % (
-            get_config().get_item('postgresql', 'root_user'),
-            command,
-        )
 
-    def list_postgresql_databases():
-        try:
-            #command = 'sudo -u %s psql -c "SELECT datname FROM pg_database" 2>/dev/null | sed -n 3,/\eof/p | grep -v "rows)"' % POSTGRESQL_USER
-            #command = 'sudo -u %s psql -c "SELECT datname FROM pg_database"' % POSTGRESQL_USER
-            command = build_postgresql_command('psql')
-            output = subprocess.check_output(command.split() + ['-c', "SELECT datname FROM pg_database"])
-            # fix for Python3: convert bytes to str
-            output = str(output.decode('utf-8'))
-            logger.debug(output)
-            # sample output:
-            # '  datname  \n-----------\n template1\n template0\n postgres\n(3 rows)\n\n'
-            try:
-                names = [str(name.decode("utf-8")) for name in output.split()]
-            except:
-                names = output.split()
-            databases = [
-                name for name in names
-                if name != 'datname' and '---' not in name and '(' not in name and ')' not in name
-            ]
-        except:
-            databases = []
-        if len(databases) <= 0:
-            logger.error('empty database list')
-        return databases
+def backup_postgresql_databases(scheduler, timestamp, target_folder):
 
     logger.info('*** backup_postgresql_databases() begin ...')
 
     # list databases
-    databases = list_postgresql_databases()
-    excluded = [value for key, value in get_config().items("postgresql") if key.startswith('exclude_')]
-    databases = [d for d in databases if d not in excluded]
+    databases = collect_databases('postgresql', catalog.list_postgresql_databases)
 
     # dump databases
-    dump_command = build_postgresql_command('pg_dump')
-    vacuum_command = build_postgresql_command('vacuumdb -z')
     for database in databases:
+        job = scheduler.submit('postgresql', database.name, backup_postgresql_database, database.name, timestamp, target_folder)
+        job.metrics.input_bytes = database.size
+
+    logger.info('*** backup_postgresql_databases() end')
+
+
+POSTGRESQL_FORMATS = ['plain', 'custom', 'directory', ]
+
+
+def backup_postgresql_database(database, timestamp, target_folder):
 
-        logger.debug(database)
+    logger.debug(database)
 
+    config = get_config()
+    dump_format = config.get_item('postgresql', 'format', default='plain').lower()
+    if dump_format not in POSTGRESQL_FORMATS:
+        raise Exception('Invalid postgresql "format" value "%s"; valid values are: %s' % (
+            dump_format, ', '.join(POSTGRESQL_FORMATS)
+        ))
+    dump_command = build_postgresql_command(['pg_dump', ])
+    name = 'postgresql.' + database.lower()
+
+    logger.info('Backing up postgresql database "%s"' % database)
+    fingerprint = get_fingerprint('postgresql', lambda: catalog.postgresql_fingerprint(database))
+
+    if dump_format == 'plain':
         # es: "/target_path/2017-01-01_01-01-01__postgresql.demo1.gz"
-        target_file = utils.output_filepath(
-            target_folder,
-            timestamp,
-            'postgresql.' + database.lower() + '.gz'
-        )
-        logger.info('Backing up postgresql database "%s"' % database)
+        output_format = get_output_format('postgresql')
+        target_file = utils.output_filepath(target_folder, timestamp, name, compressor=output_format)
         logger.debug('Target file: "%s"' % target_file)
+        if reuse_previous_backup(fingerprint, target_file):
+            return
+        check_free_space(target_file)
+        save_command_output('postgresql', dump_command + [database, ], target_file, output_format)
+
+    elif dump_format == 'custom':
+        # es: "/target_path/2017-01-01_01-01-01__postgresql.demo1.dump"
+        store = get_chunk_store('postgresql')
+        target_file = utils.output_filepath(target_folder, timestamp, name + '.dump', compressor=store)
+        logger.debug('Target file: "%s"' % target_file)
+        if reuse_previous_backup(fingerprint, target_file):
+            return
+        check_free_space(target_file)
+        with partial_output(target_file) as partial_file:
+            if store is not None:
+                # leave compression to the chunk store, so that unchanged data can be deduplicated
+                store.backup([dump_command + ['-Fc', '-Z0', database, ], ], partial_file, timeout=get_timeout('postgresql'))
+            else:
+                level = config.get_item('postgresql', 'compression_level')
+                command = dump_command + ['-Fc', ] + (['-Z', int(level), ] if level else []) + [database, ]
+                process.run(limit_output('postgresql', [command, ]), partial_file, timeout=get_timeout('postgresql'))
 
-        command = '%s %s | gzip > "%s"' % (dump_command, database, target_file)
-        utils.run_command(command)
-        # vacuum
-        if get_config().get_item_as_bool('postgresql', 'vacuumdb'):
-            utils.run_command('%s %s' % (vacuum_command, database))
-
-    logger.info('*** backup_postgresql_databases() end')
+    else:
+        # es: "/target_path/2017-01-01_01-01-01__postgresql.demo1.dir/"
+        if get_chunk_store('postgresql') is not None:
+            raise Exception('The "directory" postgresql format is not supported by the "chunks" backend')
+        target_file = utils.output_filepath(target_folder, timestamp, name + '.dir')
+        logger.debug('Target folder: "%s"' % target_file)
+        if reuse_previous_backup(fingerprint, target_file):
+            return
+        check_free_space(target_file)
+        if limit_command('postgresql'):
+            logger.warning('"max_write_mb_per_s" is not supported by the "directory" postgresql format')
+        with partial_output(target_file) as partial_file:
+            prepare_postgresql_output_folder(partial_file)
+            jobs = config.get_item_as_int('postgresql', 'jobs', 1)
+            level = config.get_item('postgresql', 'compression_level')
+            command = dump_command + ['-Fd', '-j', jobs, ] + (['-Z', int(level), ] if level else []) + ['-f', partial_file, database, ]
+            process.run([command, ], timeout=get_timeout('postgresql'))
+
+    save_fingerprint(fingerprint, target_file)
+    record_output(target_file)
+    # vacuum is run by a separate maintenance job (see maintenance.py)
+    return target_file
+
+
+def prepare_postgresql_output_folder(folder):
+    """
+    pg_dump, running as root_user, writes directly into the output folder;
+    so we create an empty folder owned by root_user in advance
+    """
+    if get_args().dry_run:
+        return
+    os.makedirs(folder)
+    try:
+        user = pwd.getpwnam(get_config().get_item('postgresql', 'root_user'))
+        os.chown(folder, user.pw_uid, user.pw_gid)
+    except Exception as e:
+        logger.debug('Unable to change owner of "%s": %s' % (folder, str(e)))
 
 
 ################################################################################
 
-def backup_mysql_databases(timestamp, target_folder):
+def build_mysql_command(arguments):
+    return arguments + [
+        '--host', 'localhost',
+        '--user', get_config().get_item('mysql', 'root_user'),
+        '--password=%s' % get_config().get_item('mysql', 'root_password'),
+    ]
 
-    def build_mysql_command(command):
-        return '%s --host localhost --user %s --password="%s"' % (
-            command,
-            get_config().get_item('mysql', 'root_user'),
-            get_config().get_item('mysql', 'root_password'),
-        )
 
-    def list_mysql_databases():
-        try:
-            mysql_command = build_mysql_command('mysql')
-            output = subprocess.check_output(mysql_command.split() + ['-e', "show databases"])
-            # fix for Python3: convert bytes to str
-            output = str(output.decode('utf-8'))
-            logger.debug(output)
-            # sample output:
-            # 'Database\ninformation_schema\ndemo1\ndemo2\nmysql\nperformance_schema\nsys\n'
-            databases = output.split()[1:]
-        except:
-            databases = []
-        if len(databases) <= 0:
-            logger.error('empty database list')
-        return databases
+def backup_mysql_databases(scheduler, timestamp, target_folder):
 
     logger.info('*** backup_mysql_databases() begin ...')
 
     # list databases
-    databases = list_mysql_databases()
-    excluded = [value for key, value in get_config().items("mysql") if key.startswith('exclude_')]
-    databases = [d for d in databases if d not in excluded]
+    databases = collect_databases('mysql', catalog.list_mysql_databases)
 
     # dump databases
-    dump_command = build_mysql_command('mysqldump')
     for database in databases:
+        job = scheduler.submit('mysql', database.name, backup_mysql_database, database.name, timestamp, target_folder)
+        job.metrics.input_bytes = database.size
 
-        logger.debug(database)
+    logger.info('*** backup_mysql_databases() end')
 
-        # es: "/target_path/2017-01-01_01-01-01__mysql.demo1.gz"
-        target_file = utils.output_filepath(
-            target_folder,
-            timestamp,
-            'mysql.' + database.lower() + '.gz'
-        )
 
-        logger.info('Backing up mysql database "%s"' % database)
-        logger.debug('Target file: "%s"' % target_file)
+def backup_mysql_database(database, timestamp, target_folder):
 
-        command = '%s %s | gzip > "%s"' % (dump_command, database, target_file)
-        utils.run_command(command)
+    logger.debug(database)
 
-    logger.info('*** backup_mysql_databases() end')
+    # es: "/target_path/2017-01-01_01-01-01__mysql.demo1.gz"
+    output_format = get_output_format('mysql')
+    target_file = utils.output_filepath(
+        target_folder,
+        timestamp,
+        'mysql.' + database.lower(),
+        compressor=output_format,
+    )
+
+    logger.info('Backing up mysql database "%s"' % database)
+    logger.debug('Target file: "%s"' % target_file)
+
+    fingerprint = get_fingerprint('mysql', lambda: catalog.mysql_fingerprint(database))
+    if reuse_previous_backup(fingerprint, target_file):
+        return
+    check_free_space(target_file)
+
+    dump_command = build_mysql_command(['mysqldump', ])
+    save_command_output('mysql', dump_command + [database, ], target_file, output_format)
+    save_fingerprint(fingerprint, target_file)
+    record_output(target_file)
+    return target_file
+
+
+################################################################################
+
+BACKUP_SECTIONS = ['data_folders', 'postgresql', 'mysql', ]
+
+# Shared resources used by the jobs of each section (see scheduler.RESOURCE_LIMITS)
+JOB_RESOURCES = {
+    'data_folders': ['cpu', 'disk', ],
+    'postgresql': ['cpu', 'disk', 'postgresql server', ],
+    'mysql': ['cpu', 'disk', 'mysql server', ],
+    'verify': ['disk', ],
+    'maintenance': ['postgresql server', ],
+}
+
+
+def submit_verification(scheduler, job):
+    """
+    Follow-up of each backup job: verify the new file (if any) while the next
+    backup jobs are running
+    """
+    if job.result:
+        scheduler.submit_first('verify', job.name, verify_backup, job.result)
 
 
 ################################################################################
 
+def get_max_total_size():
+    value = get_config().get_item('rotation', 'max_total_size')
+    return utils.parse_size(value) if value else None
+
+
 def rotate_backups(dry_run):
     logger.info('*** rotate_backups() begin ...')
     rotate_all(
@@ -224,7 +440,19 @@ def rotate_backups(dry_run):
         quarantine=get_config().get_item('rotation', 'quarantine'),
         quarantine_max_age=int(get_config().get_item('rotation', 'quarantine_max_age', '7')),
         dry_run=dry_run,
+        date_formats=parse_date_formats(get_config().get_item('rotation', 'date_formats')),
+        policies=get_retention_policies(),
+        max_total_size=get_max_total_size(),
     )
+    # Remove chunks no longer referenced by any manifest
+    chunk_store_folder = get_chunk_store_folder()
+    if os.path.isdir(chunk_store_folder):
+        target_root = utils.get_target_folder(include_target_subfolder=False)
+        ChunkStore(chunk_store_folder).collect_garbage(
+            [os.path.join(target_root, get_config().get_item('rotation', item))
+                for item in ['daily', 'weekly', 'monthly', 'yearly', 'quarantine', ]],
+            dry_run,
+        )
     logger.info('*** rotate_backups() end')
 
 
@@ -249,8 +477,121 @@ class CommandLineParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
-def run_script(script):
+async def run_script(section, script):
     logger.info('Running script: "%s"' % script)
+    await process.run_async(process.shell(script), timeout=get_timeout(section), label=script)
+
+
+def submit_scripts(scheduler, section, after):
+    """
+    Submit the scripts of section ("run_before" or "run_after"), to be run
+    one after another when all items in after have been completed
+    """
+    config = get_config()
+    if not config.has_section(section) or not config.get_item_as_bool(section, 'enabled'):
+        return
+    scripts = [value for key, value in config.items(section) if key.startswith('script_')]
+    for script in scripts:
+        job = scheduler.submit_after(after, section, script, run_script, section, script)
+        after = [job, ]
+
+
+def save_metrics(started):
+    """
+    Save the JSON report in the target root (outside the rotated folders), record the run in the stats database
+    and, when "prometheus_textfile" is given, save the Prometheus textfile-collector file
+    """
+    started = time.mktime(started.timetuple())
+    completed = time.time()
+    try:
+        report = METRICS.report(started, completed, len(ERRORS_LIST))
+        target_root = utils.get_target_folder(include_target_subfolder=False)
+        METRICS.write_report(os.path.join(target_root, METRICS_FILENAME), report)
+        record_run(report)
+        prometheus_textfile = get_config().get_item('general', 'prometheus_textfile')
+        if prometheus_textfile:
+            METRICS.write_prometheus(prometheus_textfile, started, completed, len(ERRORS_LIST))
+    except Exception as e:
+        logger.error('Unable to save metrics: %s' % str(e))
+
+
+def timing_details(warnings):
+    """
+    The timing table for notifications, followed by the deviations (if any)
+    """
+    text = METRICS.table()
+    if warnings:
+        text += "\n\nDeviations from the moving average:\n"
+        text += "\n".join(warnings)
+    return text
+
+
+def submit_backup(scheduler, timestamp, target_folder):
+    """
+    Submit the jobs of a backup run, as a graph of tasks:
+    run_before scripts -> removal of orphaned files -> collection of folders and databases
+    -> archives and dumps (each one followed by its verification) -> rotation -> run_after scripts;
+    vacuum jobs (if any) are run aside, on the maintenance pool
+    """
+
+    config = get_config()
+
+    # Run actions before backup
+    submit_scripts(scheduler, 'run_before', [])
+
+    # Remove the partial outputs of interrupted runs
+    cleanup = scheduler.submit_after(['run_before', ], 'general', 'cleanup', cleanup_orphans)
+
+    # Backup data and databases;
+    # jobs are submitted by the collection of folders and databases
+    if config.get_item_as_bool('verify', 'enabled', False):
+        scheduler.follow(BACKUP_SECTIONS, lambda job: submit_verification(scheduler, job))
+
+    # Vacuum databases on the maintenance pool, after each dump or after all of them
+    submit_maintenance(scheduler, ['collect', 'postgresql', ])
+
+    if config.get_item_as_bool('data_folders', 'enabled', False):
+        scheduler.submit_after([cleanup, ], 'collect', 'data_folders', backup_data_folders, scheduler, timestamp, target_folder)
+
+    if config.get_item_as_bool('postgresql', 'enabled', False):
+        scheduler.submit_after([cleanup, ], 'collect', 'postgresql', backup_postgresql_databases, scheduler, timestamp, target_folder)
+
+    if config.get_item_as_bool('mysql', 'enabled', False):
+        scheduler.submit_after([cleanup, ], 'collect', 'mysql', backup_mysql_databases, scheduler, timestamp, target_folder)
+
+    backups = [cleanup, 'collect', ] + BACKUP_SECTIONS + ['verify', ]
+
+    # Rotate backups
+    if config.get_item_as_bool('rotation', 'enabled', False):
+        scheduler.submit_after(backups, 'rotation', 'rotate_backups', rotate_backups, get_args().dry_run)
+
+    # Run actions after backup
+    submit_scripts(scheduler, 'run_after', backups + ['rotation', ])
+
+
+def send_notification(started, command):
+    """
+    Notify the outcome of the run (command: "backup" or "verify")
+    """
+    report_backup_files_list = get_config().get_item_as_bool("general", "report_backup_files_list", default=False)
+    if report_backup_files_list:
+        backup_file_list = list_backup_files()
+    else:
+        backup_file_list = None
+
+    # Compare durations and sizes with the previous runs
+    warnings = check_deviations(METRICS) if command == 'backup' else []
+
+    if len(ERRORS_LIST) <= 0:
+        # Notify success
+        command = get_config().get_item("general", "on_success", default='')
+        if command:
+            notify.notify_success(started, command, backup_file_list, timing_details(warnings))
+    else:
+        # Notify errors
+        command = get_config().get_item("general", "on_errors", default='')
+        if command:
+            notify.notify_errors(started, command, backup_file_list, timing_details(warnings))
 
 
 def work(started):
@@ -267,10 +608,17 @@ def work(started):
         description='Creates a timestamped backups for local databases and data folders, and optionally rotate previous backups',
         formatter_class=argparse.RawTextHelpFormatter,
     )
+    parser.add_argument('command', nargs='?', choices=['backup', 'verify', 'stats', ], default='backup',
+        help="backup: run backups and rotation (default)\n"
+             "verify: check all backup files against the folder manifests\n"
+             "stats: show durations, sizes and trends of the previous runs")
     parser.add_argument('-c', '--config', metavar='config_filename', default=default_config_filename,
         help="config. filename (default = \"%s\")" % default_config_filename)
     parser.add_argument('-v', '--verbosity', type=int, choices=[0, 1, 2, 3], default=1, help="Verbosity level. (default: 2)")
     parser.add_argument('--dry-run', '-d', action='store_true', help="simulate actions")
+    parser.add_argument('--resume', '-r', action='store_true', help="backup: resume the interrupted run, under its original timestamp,\nskipping the jobs already completed")
+    parser.add_argument('--quick', '-q', action='store_true', help="verify: skip files whose size and mtime are unchanged since the last verification")
+    parser.add_argument('--days', type=int, default=30, help="stats: number of days to be shown (default: 30)")
     parser.add_argument('--version', action='version', version='%(prog)s ' + utils.get_version())
 
     set_args(parser.parse_args())
@@ -289,67 +637,55 @@ def work(started):
 
     # Since we're not interested in reporting this umount error, here
     # we reset the list of errors
-    ERRORS_LIST = []
+    del ERRORS_LIST[:]
 
     # Mount backup unit
-    utils.mount(fail_silently=False)
+    with METRICS.job('general', 'mount'):
+        utils.mount(fail_silently=False)
 
-    # Retrieve timestamp and target folder
-    timestamp = utils.timestamp()
-    logger.info('Timestamp: "%s"' % utils.timestamp_to_string(timestamp))
+    # Retrieve target folder and timestamp;
+    # when resuming, the timestamp of the interrupted run is used
     target_folder = utils.get_target_folder(include_target_subfolder=True)
     if not utils.assure_path_exists(target_folder):
         raise Exception('Target folder "%s" not found' % target_folder)
     logger.info('Target folder: "%s"' % target_folder)
+    journal = None
+    if args.command == 'backup':
+        journal = resume_journal() if args.resume else start_journal(utils.timestamp())
+        timestamp = journal.timestamp
+    else:
+        timestamp = utils.timestamp()
+    logger.info('Timestamp: "%s"' % utils.timestamp_to_string(timestamp))
 
     config = get_config()
 
-    # Run actions before backup
-    if config.has_section('run_before') and config.get_item_as_bool('run_before', 'enabled'):
-        scripts = [value for key, value in get_config().items("run_before") if key.startswith('script_')]
-        for script in scripts:
-            logger.info('Running script: "%s"' % script)
-            utils.run_command(script)
-
-    # Backup data and databases
-    if config.get_item_as_bool('data_folders', 'enabled', False):
-        backup_data_folders(timestamp, target_folder)
-
-    if config.get_item_as_bool('postgresql', 'enabled', False):
-        backup_postgresql_databases(timestamp, target_folder)
-
-    if config.get_item_as_bool('mysql', 'enabled', False):
-        backup_mysql_databases(timestamp, target_folder)
+    # Lower cpu and I/O priority, if requested, before any job is started
+    apply_process_priority()
 
-    # Rotate backups
-    if config.get_item_as_bool('rotation', 'enabled', False):
-        rotate_backups(get_args().dry_run)
+    if args.command == 'stats':
+        # Show the run history, and leave
+        show_stats(args.days)
+        utils.umount(fail_silently=False)
+        return
 
-    # Run actions after backup
-    if config.has_section('run_after') and config.get_item_as_bool('run_after', 'enabled'):
-        scripts = [value for key, value in get_config().items("run_after") if key.startswith('script_')]
-        for script in scripts:
-            logger.info('Running script: "%s"' % script)
-            utils.run_command(script)
+    # All jobs, from the "run_before" scripts to the notification, are run by the scheduler
+    scheduler = build_scheduler(BACKUP_SECTIONS + ['verify', ], journal, JOB_RESOURCES, {'maintenance': get_vacuum_workers()})
+    if args.command == 'verify':
+        # Check historical backups against the folder manifests
+        scheduler.submit('verify', 'backup folders', verify_backup_folders, quick=args.quick)
+    else:
+        submit_backup(scheduler, timestamp, target_folder)
 
     # Send nofitication about activities
-    report_backup_files_list = get_config().get_item_as_bool("general", "report_backup_files_list", default=False)
-    if report_backup_files_list:
-        backup_file_list = list_backup_files()
-    else:
-        backup_file_list = None
+    scheduler.submit_after([ALL, ], 'general', 'notification', send_notification, started, args.command)
 
-    target_root = get_config().get_item("general", "target_root")
-    if len(ERRORS_LIST) <= 0:
-        # Notify success
-        command = get_config().get_item("general", "on_success", default='')
-        if command:
-            notify.notify_success(started, command, backup_file_list)
-    else:
-        # Notify errors
-        command = get_config().get_item("general", "on_errors", default='')
-        if command:
-            notify.notify_errors(started, command, backup_file_list)
+    scheduler.run()
+    if journal is not None:
+        journal.finish()
+
+    # Save per-job metrics
+    if args.command == 'backup':
+        save_metrics(started)
 
     # Unmount backup unit
     utils.umount(fail_silently=False)
@@ -0,0 +1,109 @@
+"""
+Database maintenance, off the backup critical path.
+
+When "vacuumdb=True" is given in the "postgresql" section, VACUUM ANALYZE is run
+for each successfully dumped database (unchanged databases, whose previous backup
+has been linked, included) by a separate "maintenance" job, on a pool of its own
+("vacuum_workers" concurrent jobs, default: 1) which doesn't take backup workers:
+
+- "vacuum_schedule=after_dump" (default): as soon as the database has been dumped,
+  while the next dumps are running
+- "vacuum_schedule=deferred": when all dumps have been completed
+
+With "vacuum_jobs" greater than 1, each vacuumdb processes the tables of its database
+on that many connections ("--jobs", when supported by vacuumdb: PostgreSQL 9.5 or later;
+support is checked by the first vacuum job, and assumed in dry-run mode).
+
+Maintenance jobs fail with a MaintenanceError, which the scheduler collects
+in MAINTENANCE_ERRORS_LIST (reported separately from backup errors); failed jobs
+are run again by "--resume".
+"""
+import logging
+
+from .args import get_args
+from .configuration import get_config
+from .process import get_timeout
+from .utils import MaintenanceError
+from . import process
+from . import catalog
+
+logger = logging.getLogger("easy_backup")
+
+VACUUM_SCHEDULES = ['after_dump', 'deferred', ]
+
+# vacuumdb options supported by the installed client: option -> bool
+vacuumdb_options = {}
+
+
+def is_vacuum_enabled():
+    config = get_config()
+    return config.get_item_as_bool('postgresql', 'enabled', False) and config.get_item_as_bool('postgresql', 'vacuumdb', False)
+
+
+def get_vacuum_workers():
+    return max(1, get_config().get_item_as_int('postgresql', 'vacuum_workers', 1))
+
+
+def get_vacuum_schedule():
+    schedule = get_config().get_item('postgresql', 'vacuum_schedule', default='after_dump').lower()
+    if schedule not in VACUUM_SCHEDULES:
+        raise Exception('Invalid postgresql "vacuum_schedule" value "%s"; valid values are: %s' % (
+            schedule, ', '.join(VACUUM_SCHEDULES)
+        ))
+    return schedule
+
+
+async def vacuumdb_supports(option):
+    """
+    Whether option is listed by "vacuumdb --help" (checked once, and never in dry-run mode)
+    """
+    if get_args().dry_run:
+        return True
+    if option not in vacuumdb_options:
+        try:
+            command = catalog.postgresql_command(['vacuumdb', '--help', ])
+            result = await process.run_async([command, ], timeout=get_timeout('postgresql'), check=False, capture=True)
+            supported = result.ok and option.encode() in result.stdout
+        except Exception as e:
+            logger.warning('Unable to run "vacuumdb --help": %s' % str(e))
+            supported = False
+        if not supported:
+            logger.warning('vacuumdb does not support "%s"' % option)
+        vacuumdb_options[option] = supported
+    return vacuumdb_options[option]
+
+
+async def get_vacuum_command(database):
+    arguments = ['vacuumdb', '-z', ]
+    jobs = get_config().get_item_as_int('postgresql', 'vacuum_jobs', 1)
+    if jobs > 1 and await vacuumdb_supports('--jobs'):
+        arguments += ['--jobs', jobs, ]
+    return catalog.postgresql_command(arguments + [database, ])
+
+
+async def vacuum_database(database):
+    """
+    Maintenance job: failures are raised as MaintenanceError
+    """
+    logger.info('Vacuuming postgresql database "%s"' % database)
+    try:
+        command = await get_vacuum_command(database)
+        await process.run_async([command, ], timeout=get_timeout('postgresql'))
+    except Exception as e:
+        raise MaintenanceError('Vacuum of postgresql database "%s" failed: %s' % (database, str(e)))
+
+
+def submit_maintenance(scheduler, dumps):
+    """
+    Submit a vacuum job after each successful postgresql dump (or link of the previous
+    backup, for unchanged databases, which still need ANALYZE and freezing);
+    with the "deferred" schedule, vacuum jobs wait for all jobs of the dumps sections
+    """
+    if not is_vacuum_enabled():
+        return
+    after = dumps if get_vacuum_schedule() == 'deferred' else []
+
+    def submit_vacuum(job):
+        scheduler.submit_after(after, 'maintenance', 'vacuum %s' % job.name, vacuum_database, job.name)
+
+    scheduler.follow(['postgresql', ], submit_vacuum)
@@ -0,0 +1,183 @@
+"""
+Checksum manifests.
+
+Each backup folder may contain a manifest (".easy_backup_manifest.json") recording,
+for each backup file: size, mtime, a fast hash (BLAKE2b) and the date of the last
+successful verification. Manifests are built and checked by "easy_backup verify",
+and kept up to date by the rotation, which moves entries along with their files.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger("easy_backup")
+
+MANIFEST_FILENAME = '.easy_backup_manifest.json'
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# BLAKE2b is faster than sha256 on 64-bit platforms; not available before Python 3.6
+HASH_ALGORITHM = 'blake2b' if hasattr(hashlib, 'blake2b') else 'sha256'
+
+
+def stat_path(path):
+    """
+    Returns (size, mtime) of a file, or of all files in a folder
+    (total size, most recent mtime)
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, int(st.st_mtime)
+    size = 0
+    mtime = int(os.stat(path).st_mtime)
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            st = os.stat(os.path.join(root, filename))
+            size += st.st_size
+            mtime = max(mtime, int(st.st_mtime))
+    return size, mtime
+
+
+def hash_path(path, algorithms):
+    """
+    Read path once, with large buffered reads, and compute all the given hash algorithms;
+    folders (es: PostgreSQL directory format dumps) are hashed as the sequence of
+    their files' relative paths and contents.
+    Returns a dict: algorithm -> hex digest
+    """
+    digests = dict([(algorithm, hashlib.new(algorithm)) for algorithm in algorithms])
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    def update(data):
+        for digest in digests.values():
+            digest.update(data)
+
+    def hash_file(filepath):
+        with open(filepath, 'rb', 0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                update(view[:n])
+
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                filepath = os.path.join(root, filename)
+                update(os.path.relpath(filepath, path).encode('utf-8') + b'\0')
+                hash_file(filepath)
+    else:
+        hash_file(path)
+    return dict([(algorithm, digest.hexdigest()) for algorithm, digest in digests.items()])
+
+
+class FolderManifest(object):
+    """
+    The manifest of a single folder: filename -> {"size", "mtime", "hash", "verified"}
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.filepath = os.path.join(folder, MANIFEST_FILENAME)
+        self.algorithm = HASH_ALGORITHM
+        self.entries = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        try:
+            with open(self.filepath) as f:
+                data = json.load(f)
+            self.algorithm = data.get('algorithm', HASH_ALGORITHM)
+            self.entries = data.get('files', {})
+        except (IOError, OSError):
+            pass
+        except ValueError as e:
+            logger.warning('Invalid manifest "%s" (%s); rebuilding it' % (self.filepath, str(e)))
+            self.changed = True
+
+    def get(self, filename):
+        with self.lock:
+            return self.entries.get(filename)
+
+    def update(self, filename, size, mtime, hexdigest):
+        with self.lock:
+            self.entries[filename] = {
+                'size': size,
+                'mtime': mtime,
+                'hash': hexdigest,
+                'verified': int(time.time()),
+            }
+            self.changed = True
+
+    def put(self, filename, entry):
+        with self.lock:
+            self.entries[filename] = entry
+            self.changed = True
+
+    def pop(self, filename):
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.changed = True
+            return entry
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_file = self.filepath + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                'algorithm': self.algorithm,
+                'files': self.entries,
+            }, f, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.filepath)
+        self.changed = False
+
+
+class Manifests(object):
+    """
+    Manifests of several folders, loaded on first use
+    """
+
+    def __init__(self):
+        self.manifests = {}
+
+    def find(self, folder):
+        """
+        Returns the manifest of folder, or None if folder has no manifest
+        """
+        if folder not in self.manifests:
+            exists = os.path.exists(os.path.join(folder, MANIFEST_FILENAME))
+            self.manifests[folder] = FolderManifest(folder) if exists else None
+        return self.manifests[folder]
+
+    def get(self, folder):
+        """
+        Returns the manifest of folder, creating it if required
+        """
+        manifest = self.find(folder)
+        if manifest is None:
+            manifest = self.manifests[folder] = FolderManifest(folder)
+        return manifest
+
+    def move(self, source_folder, filename, target_folder, target_filename):
+        """
+        Follow a file moved by the rotation (size, mtime and hash are unchanged by rename)
+        """
+        manifest = self.find(source_folder)
+        entry = manifest.pop(filename) if manifest is not None else None
+        if entry is not None:
+            self.get(target_folder).put(target_filename, entry)
+
+    def delete(self, folder, filename):
+        manifest = self.find(folder)
+        if manifest is not None:
+            manifest.pop(filename)
+
+    def save(self):
+        for manifest in self.manifests.values():
+            if manifest is not None:
+                manifest.save()
@@ -0,0 +1,266 @@
+"""
+Per-job metrics.
+
+For each job (mount, data folder archives, database dumps, vacuum, rotation,
+notification ...) the following items are recorded: start and end time, duration,
+input and output bytes, compression ratio, and the exit code of the last command run.
+
+At the end of the run, metrics are saved as a JSON report in the target root
+("easy_backup.metrics.json", outside the rotated folders; replaced by each run,
+while the history is kept in the stats database) and, optionally, as a Prometheus
+textfile-collector file ("prometheus_textfile" in the "general" section);
+the notification details include a timing table.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import contextlib
+import contextvars
+
+from .args import get_args
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+METRICS_FILENAME = 'easy_backup.metrics.json'
+
+# metrics of the jobs running in the current thread or asyncio task (innermost last)
+_jobs = contextvars.ContextVar('easy_backup_jobs', default=())
+
+
+class JobMetrics(object):
+
+    def __init__(self, section, name):
+        self.section = section
+        self.name = name
+        self.started = None
+        self.completed = None
+        self.status = 'pending'
+        self.input_bytes = None
+        self.output_file = None
+        self.output_bytes = None
+        self.exit_code = None
+        self.error = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.completed is None:
+            return None
+        return self.completed - self.started
+
+    @property
+    def ratio(self):
+        if not self.input_bytes or not self.output_bytes:
+            return None
+        return float(self.input_bytes) / self.output_bytes
+
+    def to_dict(self):
+        return {
+            'section': self.section,
+            'name': self.name,
+            'status': self.status,
+            'started': self.started,
+            'completed': self.completed,
+            'duration': self.duration,
+            'input_bytes': self.input_bytes,
+            'output_file': self.output_file,
+            'output_bytes': self.output_bytes,
+            'ratio': self.ratio,
+            'exit_code': self.exit_code,
+            'error': self.error,
+        }
+
+
+@contextlib.contextmanager
+def measure(job_metrics):
+    """
+    Record start and end time of the enclosed block, and whether it failed;
+    commands run in the meantime by the same thread (or asyncio task) are accounted to job_metrics
+    """
+    token = _jobs.set(_jobs.get() + (job_metrics, ))
+    job_metrics.started = time.time()
+    job_metrics.status = 'running'
+    try:
+        yield job_metrics
+    except Exception as e:
+        job_metrics.status = 'failed'
+        job_metrics.error = str(e)
+        raise
+    finally:
+        job_metrics.completed = time.time()
+        if job_metrics.status == 'running':
+            job_metrics.status = 'ok'
+        _jobs.reset(token)
+
+
+def current():
+    """
+    The metrics of the innermost job running in the current thread (or asyncio task), or None
+    """
+    stack = _jobs.get()
+    return stack[-1] if stack else None
+
+
+def record_exit_code(rc):
+    job_metrics = current()
+    if job_metrics is not None:
+        job_metrics.exit_code = rc
+
+
+def record_status(status):
+    """
+    Replace the default "ok" status (es: "unchanged" for linked backups)
+    """
+    job_metrics = current()
+    if job_metrics is not None:
+        job_metrics.status = status
+
+
+def record_input_size(size):
+    job_metrics = current()
+    if job_metrics is not None:
+        job_metrics.input_bytes = size
+
+
+def record_output_size(size):
+    job_metrics = current()
+    if job_metrics is not None:
+        job_metrics.output_bytes = size
+
+
+def record_output(filepath):
+    """
+    Record the file produced by the current job, and its size (unless already known)
+    """
+    job_metrics = current()
+    if job_metrics is None:
+        return
+    job_metrics.output_file = filepath
+    if job_metrics.output_bytes is None and os.path.exists(filepath):
+        job_metrics.output_bytes = utils.get_path_size(filepath)
+
+
+def format_table(rows):
+    """
+    Align rows of strings in columns; the first column is left-aligned, the others right-aligned
+    """
+    widths = [max([len(row[i]) for row in rows]) for i in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        lines.append('  '.join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]))
+    return '\n'.join(lines)
+
+
+class Metrics(object):
+    """
+    All jobs of the current run
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def add(self, job_metrics):
+        with self.lock:
+            self.jobs.append(job_metrics)
+        return job_metrics
+
+    def job(self, section, name):
+        """
+        Context manager measuring a job which is not run by the scheduler;
+        es: with METRICS.job('general', 'mount'): ...
+        """
+        return measure(self.add(JobMetrics(section, name)))
+
+    def completed_jobs(self):
+        with self.lock:
+            return [job for job in self.jobs if job.completed is not None]
+
+    def table(self):
+        """
+        Timing table of completed jobs, in order of start time
+        """
+        rows = [('job', 'status', 'duration', 'output', 'ratio', 'rc', ), ]
+        for job in sorted(self.completed_jobs(), key=lambda job: job.started):
+            rows.append((
+                '%s: %s' % (job.section, job.name),
+                job.status,
+                '%.1fs' % job.duration,
+                utils.sizeof_fmt(job.output_bytes) if job.output_bytes is not None else '-',
+                '%.1f' % job.ratio if job.ratio is not None else '-',
+                str(job.exit_code) if job.exit_code is not None else '-',
+            ))
+        return format_table(rows)
+
+    def report(self, started, completed, errors):
+        jobs = self.completed_jobs()
+        return {
+            'hostname': socket.gethostname(),
+            'version': utils.get_version(),
+            'started': started,
+            'completed': completed,
+            'duration': completed - started,
+            'errors': errors,
+            'output_bytes': sum([job.output_bytes or 0 for job in jobs]),
+            'jobs': [job.to_dict() for job in sorted(jobs, key=lambda job: job.started)],
+        }
+
+    def write_report(self, filepath, report):
+        if get_args().dry_run:
+            sys.stderr.write("\x1b[1;37;40m" + 'Metrics report: "%s"' % filepath + "\x1b[0m\n")
+            return
+        tmp_file = filepath + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        os.rename(tmp_file, filepath)
+        logger.info('Metrics report saved as "%s"' % filepath)
+
+    def write_prometheus(self, filepath, started, completed, errors):
+        """
+        Save metrics in the Prometheus text format (for node_exporter's textfile collector)
+        """
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = [
+            '# HELP easy_backup_last_run_timestamp_seconds Completion time of the last run.',
+            '# TYPE easy_backup_last_run_timestamp_seconds gauge',
+            'easy_backup_last_run_timestamp_seconds %d' % completed,
+            '# HELP easy_backup_run_duration_seconds Duration of the last run.',
+            '# TYPE easy_backup_run_duration_seconds gauge',
+            'easy_backup_run_duration_seconds %.3f' % (completed - started),
+            '# HELP easy_backup_errors Number of errors in the last run.',
+            '# TYPE easy_backup_errors gauge',
+            'easy_backup_errors %d' % errors,
+        ]
+        series = [
+            ('job_duration_seconds', 'Duration of each job.', lambda job: job.duration),
+            ('job_success', 'Whether each job succeeded.', lambda job: 0 if job.status == 'failed' else 1),
+            ('job_input_bytes', 'Input size of each job.', lambda job: job.input_bytes),
+            ('job_output_bytes', 'Output size of each job.', lambda job: job.output_bytes),
+            ('job_exit_code', 'Exit code of the last command run by each job.', lambda job: job.exit_code),
+        ]
+        jobs = self.completed_jobs()
+        for name, description, value in series:
+            lines.append('# HELP easy_backup_%s %s' % (name, description))
+            lines.append('# TYPE easy_backup_%s gauge' % name)
+            for job in jobs:
+                if value(job) is not None:
+                    lines.append('easy_backup_%s{section="%s",job="%s"} %s' % (
+                        name, escape(job.section), escape(job.name), value(job)))
+
+        if get_args().dry_run:
+            sys.stderr.write("\x1b[1;37;40m" + 'Prometheus metrics: "%s"' % filepath + "\x1b[0m\n")
+            return
+        tmp_file = filepath + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_file, filepath)
+        logger.debug('Prometheus metrics saved as "%s"' % filepath)
+
+
+METRICS = Metrics()
@@ -2,8 +2,9 @@ import traceback
 import socket
 import datetime
 import os
+from .process import get_timeout
 from . import utils
-from .utils import ERRORS_LIST
+from .utils import ERRORS_LIST, MAINTENANCE_ERRORS_LIST
 
 
 def mk_title(title):
@@ -23,41 +24,107 @@ def mk_header(started, completed):
     return header
 
 
-def escape(text):
-    return text.replace('"', '\"')
+def escape(text, quote):
+    """
+    Escape text for the shell, to be placed within the given quotes ('"', "'" or None)
+    """
+    if quote == '"':
+        for char in '\\"$`':
+            text = text.replace(char, '\\' + char)
+        return text
+    if quote == "'":
+        return text.replace("'", "'\\''")
+    return utils.quote(text)
 
 
-def notify_errors(started, command, backup_file_list):
+def format_command(command, **values):
+    """
+    Replace the "{name}" placeholders of command with values, each escaped
+    according to the quotes surrounding the placeholder
+    (es: echo "{details}" | mail -s'{title}' ...)
+    """
+    result = []
+    quote = None
+    i = 0
+    while i < len(command):
+        char = command[i]
+        if char == '{':
+            end = command.find('}', i)
+            if end > 0 and command[i + 1:end] in values:
+                result.append(escape(values[command[i + 1:end]], quote))
+                i = end + 1
+                continue
+        if char == '\\' and quote != "'":
+            result.append(command[i:i + 2])
+            i += 2
+            continue
+        if char in '"\'':
+            if quote is None:
+                quote = char
+            elif quote == char:
+                quote = None
+        result.append(char)
+        i += 1
+    return ''.join(result)
+
+
+def format_errors(errors):
+    details = ''
+    for error in errors:
+        details += error['message'] + "\n"
+        details += error['traceback'] + "\n"
+    return details
+
+
+def maintenance_errors():
+    """
+    Maintenance errors (es: vacuum), reported separately from backup errors
+    """
+    if not MAINTENANCE_ERRORS_LIST:
+        return ''
+    return "\n\nMAINTENANCE ERRORS:\n" + format_errors(MAINTENANCE_ERRORS_LIST)
+
+
+def run_notification(command, title, details):
+    command = format_command(command, title=title, details=details)
+    utils.run_command(command, force=True, timeout=get_timeout('general'))
+
+
+def notify_errors(started, command, backup_file_list, timing_table=None):
 
     title = mk_title('*** easy_backup failed with errors ***')
     details = "%s\n\nERRORS:\n" % (
         mk_header(started, datetime.datetime.now()),
     )
-    for error in ERRORS_LIST:
-        details += error['message'] + "\n"
-        details += error['traceback'] + "\n"
+    details += format_errors(ERRORS_LIST)
+    details += maintenance_errors()
+
+    if timing_table is not None:
+        details += "\n\nJobs:\n"
+        details += timing_table
 
     if backup_file_list is not None:
         details += "\n\nAvailable backup files:\n"
         details += backup_file_list
 
-    command = command.format(
-        title=escape(title),
-        details=escape(details)
-    )
-    utils.run_command(command, force=True)
+    run_notification(command, title, details)
 
 
-def notify_success(started, command, backup_file_list):
-    title = mk_title('easy_backup completed with no errors')
-    details = "%s\n\nNo errors" % mk_header(started, datetime.datetime.now())
+def notify_success(started, command, backup_file_list, timing_table=None):
+    if MAINTENANCE_ERRORS_LIST:
+        title = mk_title('easy_backup completed with maintenance errors')
+        details = "%s\n\nNo backup errors" % mk_header(started, datetime.datetime.now())
+        details += maintenance_errors()
+    else:
+        title = mk_title('easy_backup completed with no errors')
+        details = "%s\n\nNo errors" % mk_header(started, datetime.datetime.now())
+
+    if timing_table is not None:
+        details += "\n\nJobs:\n"
+        details += timing_table
 
     if backup_file_list is not None:
         details += "\n\nAvailable backup files:\n"
         details += backup_file_list
 
-    command = command.format(
-        title=escape(title),
-        details=escape(details)
-    )
-    utils.run_command(command, force=True)
+    run_notification(command, title, details)
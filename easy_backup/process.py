@@ -0,0 +1,467 @@
+"""
+Managed subprocess runner.
+
+Commands are given as lists of arguments, and pipelines as lists of commands
+(stages): the stdout of each stage is connected to the stdin of the next one
+with an OS pipe, and the last stage writes directly into the output file, if any;
+no shell is involved, and data never flows through easy_backup itself.
+
+For each run:
+- the stderr of each stage is captured; only the last STDERR_TAIL_SIZE bytes are kept,
+  and reported when the run fails
+- an optional timeout is enforced: all stages receive SIGTERM and, if still running
+  after KILL_DELAY seconds, SIGKILL
+- a ProcessResult collects the exit code of each stage, the duration and the output size
+- the output of the last stage can be captured instead (es: the result of a query)
+
+A pipeline fails when any of its stages fails (as with the shell "pipefail" option).
+
+Pipelines are run either by blocking calls (run(), from the scheduler worker threads),
+or as asyncio subprocesses (run_async(), from jobs running on the scheduler event loop).
+
+The "timeout" item (in seconds) of each section, or of the "general" section,
+limits the duration of each command run by that section's jobs.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import threading
+import subprocess
+
+from .args import get_args
+from .configuration import get_config
+from .metrics import record_exit_code
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+STDERR_TAIL_SIZE = 4096
+KILL_DELAY = 10.0
+PIPE = subprocess.PIPE
+
+
+def format_pipeline(stages, output=None):
+    """
+    The pipeline as a shell command line (for logging)
+    """
+    text = ' | '.join([utils.command_line(arguments) for arguments in stages])
+    if output is not None:
+        text += ' > ' + utils.quote(output)
+    return text
+
+
+def shell(command):
+    """
+    A single stage pipeline running command with the shell (for user-supplied
+    command lines: scripts, mount and notification commands)
+    """
+    return [utils.shell_arguments(command), ]
+
+
+def get_timeout(section):
+    """
+    The "timeout" of section (or of the "general" section), in seconds; None when not given
+    """
+    config = get_config()
+    value = config.get_item(section, 'timeout', default=config.get_item('general', 'timeout'))
+    return float(value) if value and float(value) > 0 else None
+
+
+class ProcessResult(object):
+
+    def __init__(self, stages, output=None, label=None):
+        self.stages = stages
+        self.output = output
+        # shown instead of the pipeline (es: the original command line for shell commands)
+        self.label = label
+        self.returncodes = []
+        self.stderr = ''
+        self.started = None
+        self.completed = None
+        self.output_bytes = None
+        # the output of the last stage, when captured
+        self.stdout = None
+        self.timed_out = False
+
+    def __str__(self):
+        return self.label or format_pipeline(self.stages, self.output)
+
+    @property
+    def returncode(self):
+        """
+        The exit code of the first failing stage, or 0
+        """
+        for rc in self.returncodes:
+            if rc != 0:
+                return rc
+        return 0
+
+    @property
+    def ok(self):
+        return not self.timed_out and self.returncode == 0
+
+    @property
+    def duration(self):
+        if self.started is None or self.completed is None:
+            return None
+        return self.completed - self.started
+
+
+class ProcessError(Exception):
+
+    def __init__(self, result):
+        message = 'COMMAND FAILED: "%s"' % result
+        if result.timed_out:
+            message += ' (timed out after %.1fs)' % result.duration
+        message += ' (exit codes: %s)' % ', '.join([str(rc) for rc in result.returncodes])
+        if result.stderr:
+            message += '\n' + result.stderr
+        super(ProcessError, self).__init__(message)
+        self.result = result
+
+
+class StderrTail(threading.Thread):
+    """
+    Read a stream until EOF, keeping its last bytes only
+    """
+
+    def __init__(self, stream, size=STDERR_TAIL_SIZE):
+        super(StderrTail, self).__init__(name='stderr')
+        self.daemon = True
+        self.stream = stream
+        self.size = size
+        self.data = b''
+
+    def run(self):
+        while True:
+            data = self.stream.read1(65536) if hasattr(self.stream, 'read1') else self.stream.read(65536)
+            if not data:
+                break
+            self.data = (self.data + data)[-self.size:]
+        self.stream.close()
+
+    def text(self):
+        return self.data.decode('utf-8', 'replace').strip()
+
+
+class Pipeline(object):
+    """
+    A running pipeline; use start(), then wait()
+    """
+
+    def __init__(self, stages, output=None, timeout=None, label=None):
+        self.stages = [[str(argument) for argument in arguments] for arguments in stages]
+        self.output = output
+        self.timeout = timeout
+        self.processes = []
+        self.tails = []
+        self.stdin = None
+        self.stdout = None
+        self.timer = None
+        self.lock = threading.Lock()
+        self.result = ProcessResult(self.stages, output, label)
+
+    def start(self, stdin=None, stdout=None):
+        """
+        Start all stages; the output of the last stage goes to the output file given
+        to the constructor or, when stdout is PIPE, can be read from self.stdout
+        (otherwise, it is inherited); when stdin is PIPE, the input of the first stage
+        can be written to self.stdin
+        """
+        self.result.started = time.time()
+        output_file = open(self.output, 'wb') if self.output is not None else None
+        try:
+            for i, arguments in enumerate(self.stages):
+                if i < len(self.stages) - 1:
+                    target = PIPE
+                else:
+                    target = output_file if output_file is not None else stdout
+                previous = self.processes[-1] if self.processes else None
+                try:
+                    process = subprocess.Popen(
+                        arguments,
+                        stdin=previous.stdout if previous is not None else stdin,
+                        stdout=target,
+                        stderr=PIPE,
+                    )
+                except OSError as e:
+                    raise Exception('COMMAND FAILED: "%s": %s' % (self.result, str(e)))
+                if previous is not None:
+                    # from now on, the pipe is held by the two stages only
+                    previous.stdout.close()
+                self.processes.append(process)
+                tail = StderrTail(process.stderr)
+                tail.start()
+                self.tails.append(tail)
+        except:
+            self.kill()
+            self.wait()
+            raise
+        finally:
+            if output_file is not None:
+                output_file.close()
+        if stdin == PIPE:
+            self.stdin = self.processes[0].stdin
+        if stdout == PIPE:
+            self.stdout = self.processes[-1].stdout
+        if self.timeout:
+            self.timer = threading.Timer(self.timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def expire(self):
+        with self.lock:
+            self.result.timed_out = True
+        logger.error('Timeout (%.0fs) expired: "%s"' % (self.timeout, self.result))
+        self.terminate()
+
+    def send_signal(self, signum):
+        for process in self.processes:
+            if process.poll() is None:
+                try:
+                    process.send_signal(signum)
+                except OSError:
+                    pass
+
+    def terminate(self):
+        """
+        SIGTERM to all stages; then SIGKILL to those still running after KILL_DELAY seconds
+        """
+        self.send_signal(signal.SIGTERM)
+        deadline = time.time() + KILL_DELAY
+        while time.time() < deadline:
+            if all([process.poll() is not None for process in self.processes]):
+                return
+            time.sleep(0.1)
+        self.send_signal(signal.SIGKILL)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def wait(self):
+        """
+        Wait for all stages, and return the ProcessResult
+        """
+        if self.stdin is not None:
+            try:
+                self.stdin.close()
+            except OSError:
+                # broken pipe: the first stage has already exited
+                pass
+        if self.stdout is not None:
+            self.stdout.close()
+        self.result.returncodes = [process.wait() for process in self.processes]
+        if self.timer is not None:
+            self.timer.cancel()
+        for tail in self.tails:
+            # after a timeout, orphaned children of a killed stage may still hold its stderr
+            tail.join(KILL_DELAY if self.result.timed_out else None)
+        self.result.completed = time.time()
+        self.result.stderr = '\n'.join([
+            '[%s] %s' % (os.path.basename(arguments[0]), tail.text())
+            for arguments, tail in zip(self.stages, self.tails) if tail.text()
+        ])
+        if self.output is not None and os.path.exists(self.output):
+            self.result.output_bytes = os.path.getsize(self.output)
+        return self.result
+
+
+async def read_pipe(fd, size=None):
+    """
+    Read the pipe fd until EOF, and return its contents (only the last size bytes, if given)
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, protocol = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+    data = b''
+    try:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            data = data + chunk if size is None else (data + chunk)[-size:]
+    finally:
+        transport.close()
+    return data
+
+
+async def read_tail(fd, size=STDERR_TAIL_SIZE):
+    """
+    Read the pipe fd until EOF, and return its last bytes as text
+    """
+    data = await read_pipe(fd, size)
+    return data.decode('utf-8', 'replace').strip()
+
+
+class AsyncPipeline(object):
+    """
+    Same as Pipeline, with asyncio subprocesses; use "await pipeline.run()";
+    when capture is set, the output of the last stage is collected in result.stdout
+    """
+
+    def __init__(self, stages, output=None, timeout=None, label=None, capture=False):
+        self.stages = [[str(argument) for argument in arguments] for arguments in stages]
+        self.output = output
+        self.timeout = timeout
+        self.capture = capture
+        self.processes = []
+        self.tails = []
+        self.reader = None
+        self.result = ProcessResult(self.stages, output, label)
+
+    async def start(self):
+        output_file = open(self.output, 'wb') if self.output is not None else None
+        stdin = None
+        try:
+            for i, arguments in enumerate(self.stages):
+                stdout_reader = None
+                if i < len(self.stages) - 1:
+                    next_stdin, stdout = os.pipe()
+                elif self.capture:
+                    next_stdin = None
+                    stdout_reader, stdout = os.pipe()
+                else:
+                    next_stdin, stdout = None, output_file
+                # stderr is read through a pipe of our own: asyncio would not report
+                # the exit of a stage until all its pipes are closed, which orphaned
+                # children may delay after a timeout
+                stderr, stderr_writer = os.pipe()
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        *arguments,
+                        stdin=stdin,
+                        stdout=stdout,
+                        stderr=stderr_writer
+                    )
+                except OSError as e:
+                    for fd in [next_stdin, stdout_reader, stderr, ]:
+                        if fd is not None:
+                            os.close(fd)
+                    raise Exception('COMMAND FAILED: "%s": %s' % (self.result, str(e)))
+                finally:
+                    # from now on, the pipes are held by the stages only
+                    os.close(stderr_writer)
+                    if stdin is not None:
+                        os.close(stdin)
+                    if next_stdin is not None or stdout_reader is not None:
+                        os.close(stdout)
+                stdin = next_stdin
+                self.processes.append(process)
+                self.tails.append(asyncio.ensure_future(read_tail(stderr)))
+                if stdout_reader is not None:
+                    self.reader = asyncio.ensure_future(read_pipe(stdout_reader))
+        except:
+            self.send_signal(signal.SIGKILL)
+            await self.wait_all()
+            for tail in self.tails + ([self.reader, ] if self.reader is not None else []):
+                tail.cancel()
+            raise
+        finally:
+            if output_file is not None:
+                output_file.close()
+
+    def send_signal(self, signum):
+        for process in self.processes:
+            if process.returncode is None:
+                try:
+                    process.send_signal(signum)
+                except ProcessLookupError:
+                    pass
+
+    async def wait_all(self):
+        return [await process.wait() for process in self.processes]
+
+    async def terminate(self):
+        """
+        SIGTERM to all stages; then SIGKILL to those still running after KILL_DELAY seconds
+        """
+        self.send_signal(signal.SIGTERM)
+        try:
+            return await asyncio.wait_for(self.wait_all(), KILL_DELAY)
+        except asyncio.TimeoutError:
+            self.send_signal(signal.SIGKILL)
+            return await self.wait_all()
+
+    async def run(self):
+        """
+        Start all stages, wait for them, and return the ProcessResult
+        """
+        self.result.started = time.time()
+        await self.start()
+        try:
+            self.result.returncodes = await asyncio.wait_for(self.wait_all(), self.timeout)
+        except asyncio.TimeoutError:
+            self.result.timed_out = True
+            logger.error('Timeout (%.0fs) expired: "%s"' % (self.timeout, self.result))
+            self.result.returncodes = await self.terminate()
+        # after a timeout, orphaned children of a killed stage may still hold its stderr
+        readers = self.tails + ([self.reader, ] if self.reader is not None else [])
+        done, pending = await asyncio.wait(readers, timeout=KILL_DELAY if self.result.timed_out else None)
+        for tail in pending:
+            tail.cancel()
+        self.result.completed = time.time()
+        if self.reader in done:
+            self.result.stdout = self.reader.result()
+        self.result.stderr = '\n'.join([
+            '[%s] %s' % (os.path.basename(arguments[0]), tail.result())
+            for arguments, tail in zip(self.stages, self.tails) if tail in done and tail.result()
+        ])
+        if self.output is not None and os.path.exists(self.output):
+            self.result.output_bytes = os.path.getsize(self.output)
+        return self.result
+
+
+def run(stages, output=None, timeout=None, force=False, check=True, label=None, capture=False):
+    """
+    Run a pipeline (see Pipeline), writing the output of the last stage into output (if given),
+    or collecting it in result.stdout when capture is set;
+    raises ProcessError when check is set and any stage fails.
+    In dry-run mode, the command is only shown (unless force is set), and None is returned
+    """
+    command = label or format_pipeline(stages, output)
+    if get_args().dry_run and not force:
+        sys.stderr.write("\x1b[1;37;40m" + command + "\x1b[0m\n")
+        return None
+    logger.debug('Run command: "' + command + '"')
+    pipeline = Pipeline(stages, output, timeout, label).start(stdout=PIPE if capture else None)
+    if capture:
+        try:
+            pipeline.result.stdout = pipeline.stdout.read()
+        except:
+            pipeline.kill()
+            pipeline.wait()
+            raise
+    return check_result(pipeline.wait(), check)
+
+
+async def run_async(stages, output=None, timeout=None, force=False, check=True, label=None, capture=False):
+    """
+    Same as run(), with asyncio subprocesses (see AsyncPipeline)
+    """
+    command = label or format_pipeline(stages, output)
+    if get_args().dry_run and not force:
+        sys.stderr.write("\x1b[1;37;40m" + command + "\x1b[0m\n")
+        return None
+    logger.debug('Run command: "' + command + '"')
+    result = await AsyncPipeline(stages, output, timeout, label, capture).run()
+    return check_result(result, check)
+
+
+def check_result(result, check):
+    """
+    Record the exit code of a completed pipeline, and raise ProcessError
+    when check is set and any stage failed
+    """
+    record_exit_code(result.returncode)
+    if result.stderr and result.ok:
+        logger.debug(result.stderr)
+    if check and not result.ok:
+        error = ProcessError(result)
+        logger.error(str(error))
+        raise error
+    return result
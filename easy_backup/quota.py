@@ -0,0 +1,91 @@
+"""
+Free space check.
+
+Before each job, the free space in the target folder is compared with the size
+of the previous backup of the same source, used as an estimate of the new one;
+the job fails early, instead of filling up the target unit halfway.
+"""
+import os
+import sys
+import logging
+import threading
+
+from .args import get_args
+from .configuration import get_config
+from .retention import series_name
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+
+class PreviousBackups(object):
+    """
+    The most recent backup file of each source, found by listing the backup folders
+    once (on first use)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = None
+
+    def collect(self):
+        latest = {}
+        for folder in utils.get_backup_folders():
+            if not os.path.isdir(folder):
+                continue
+            for filename in os.listdir(folder):
+                if '__' not in filename:
+                    continue
+                name = series_name(filename)
+                if name not in latest or filename > os.path.basename(latest[name]):
+                    latest[name] = os.path.join(folder, filename)
+        return latest
+
+    def find(self, target_file):
+        """
+        Returns the path of the previous backup of the same source as target_file, if any
+        """
+        with self.lock:
+            if self.latest is None:
+                self.latest = self.collect()
+        return self.latest.get(series_name(os.path.basename(target_file)))
+
+
+previous_backups = PreviousBackups()
+
+
+def get_free_space(folder):
+    st = os.statvfs(folder)
+    return st.f_bavail * st.f_frsize
+
+
+def check_free_space(target_file):
+    """
+    Raise an exception when the free space in target_file's folder is less than
+    the size of the previous backup of the same source
+    (disabled by "check_free_space=False" in the "general" section)
+    """
+    if not get_config().get_item_as_bool('general', 'check_free_space', default=True):
+        return
+    previous_file = previous_backups.find(target_file)
+    if previous_file is None:
+        return
+    try:
+        estimate = utils.get_path_size(previous_file)
+        free_space = get_free_space(os.path.dirname(target_file))
+    except OSError as e:
+        logger.warning('Unable to check free space for "%s": %s' % (target_file, str(e)))
+        return
+    logger.debug('Free space: %s; estimated size (from "%s"): %s' % (
+        utils.sizeof_fmt(free_space), os.path.basename(previous_file), utils.sizeof_fmt(estimate)))
+    if estimate > free_space:
+        message = 'Not enough free space for "%s": %s available, %s estimated from "%s"' % (
+            os.path.basename(target_file),
+            utils.sizeof_fmt(free_space),
+            utils.sizeof_fmt(estimate),
+            os.path.basename(previous_file),
+        )
+        if get_args().dry_run:
+            sys.stderr.write("\x1b[1;37;40m" + message + "\x1b[0m\n")
+            return
+        raise Exception(message)
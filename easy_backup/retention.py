@@ -0,0 +1,162 @@
+"""
+Retention policies (grandfather-father-son, based on counts).
+
+Backup files are grouped into series (all backups of the same source, es: "postgresql.demo1.gz"),
+and for each series the following files are retained:
+
+- keep_last: the most recent files
+- keep_daily, keep_weekly, keep_monthly, keep_yearly: the most recent file of each
+  of the last days, weeks, months and years having backups
+
+The most recent file of each series is always retained.
+
+Policies for specific series are selected by the longest matching prefix
+of the series name; counts not specified are taken from the default policy.
+"""
+import re
+import logging
+
+from .configuration import get_config
+
+logger = logging.getLogger("easy_backup")
+
+# rules, from the finest to the coarsest
+RULES = ['last', 'daily', 'weekly', 'monthly', 'yearly', ]
+
+PERIODS = {
+    'daily': lambda date: date,
+    'weekly': lambda date: date.isocalendar()[:2],
+    'monthly': lambda date: (date.year, date.month),
+    'yearly': lambda date: date.year,
+}
+
+# "2018-03-24_01.02.57_", "1521766816_2018_03_23_10.5.6-", "2018-03-24T01:02:57_"
+DATE_PREFIX_REGEX = re.compile(r'^[\d_.:-]+(T[\d_.:-]+)?')
+
+
+def series_name(filename):
+    """
+    The name of the backup source, es: "postgresql.demo1.gz" for
+    "2018-03-24_01-00-00__postgresql.demo1.gz"
+    """
+    if '__' in filename:
+        return filename.split('__', 1)[1]
+    return DATE_PREFIX_REGEX.sub('', filename)
+
+
+class RetentionPolicy(object):
+
+    def __init__(self, counts):
+        # counts: rule -> number of files to be retained
+        self.counts = dict([(rule, counts.get(rule, 0)) for rule in RULES])
+
+    def __str__(self):
+        return ', '.join(['keep_%s=%d' % (rule, self.counts[rule]) for rule in RULES])
+
+    def select(self, files):
+        """
+        Returns a dict: retained file -> the finest rule which retains it
+        (files must belong to the same series, sorted from the most recent).
+        """
+        retained = {}
+        used = dict([(rule, 0) for rule in RULES])
+        last_period = {}
+        for position, file_obj in enumerate(files):
+            reason = 'last' if position == 0 else None
+            for rule in RULES:
+                if used[rule] >= self.counts[rule]:
+                    continue
+                period = position if rule == 'last' else PERIODS[rule](file_obj.filedate)
+                if last_period.get(rule) == period:
+                    continue
+                last_period[rule] = period
+                used[rule] += 1
+                if reason is None:
+                    reason = rule
+            if reason is not None:
+                retained[file_obj] = reason
+        return retained
+
+
+class RetentionPolicies(object):
+    """
+    The default policy, plus policies for specific series prefixes
+    """
+
+    def __init__(self, default, prefixes=None):
+        self.default = default
+        # longest prefixes first
+        self.prefixes = sorted(prefixes or [], key=lambda item: len(item[0]), reverse=True)
+
+    def policy_for(self, name):
+        for prefix, policy in self.prefixes:
+            if name.startswith(prefix):
+                return policy
+        return self.default
+
+    def select(self, files):
+        """
+        Single pass over files (any folder, any series): returns a dict:
+        retained file -> the finest rule which retains it
+        """
+        series = {}
+        for file_obj in files:
+            series.setdefault(series_name(file_obj.filename), []).append(file_obj)
+        retained = {}
+        for name, items in series.items():
+            items.sort(key=lambda f: (f.filedate, f.filename), reverse=True)
+            retained.update(self.policy_for(name).select(items))
+        return retained
+
+
+def parse_counts(text, context):
+    """
+    Parse "keep_daily=30, keep_weekly=4"
+    """
+    counts = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if not key.startswith('keep_') or key[5:] not in RULES:
+            raise Exception('Invalid retention item "%s" in %s' % (key, context))
+        try:
+            counts[key[5:]] = int(value)
+        except ValueError:
+            raise Exception('Invalid value "%s" for "%s" in %s' % (value.strip(), key, context))
+    return counts
+
+
+def get_retention_policies():
+    """
+    Build the retention policies from the "rotation" section; returns None when
+    no "keep_" item has been specified (fixed age rotation)
+    """
+    config = get_config()
+    if not config.has_section('rotation'):
+        return None
+    items = dict(config.items('rotation'))
+    counts = {}
+    for rule in RULES:
+        value = items.get('keep_' + rule, '').strip()
+        if value:
+            counts[rule] = int(value)
+    if not counts:
+        return None
+
+    prefixes = []
+    for key, value in sorted(items.items()):
+        if key.startswith('policy_'):
+            prefix, separator, text = value.partition(':')
+            if not separator or not prefix.strip():
+                raise Exception('Invalid retention policy "%s"; expected "prefix: keep_daily=N, ..."' % key)
+            policy_counts = dict(counts)
+            policy_counts.update(parse_counts(text, '"%s"' % key))
+            prefixes.append((prefix.strip(), RetentionPolicy(policy_counts)))
+
+    policies = RetentionPolicies(RetentionPolicy(counts), prefixes)
+    logger.debug('Retention policy: %s' % policies.default)
+    for prefix, policy in policies.prefixes:
+        logger.debug('Retention policy for "%s": %s' % (prefix, policy))
+    return policies
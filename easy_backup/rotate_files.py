@@ -3,36 +3,54 @@ import os
 import logging
 import datetime
 import sys
+import shutil
+import stat
+
+from .incremental import find_chain_bases
+from .dateparse import get_date_parser
+from .retention import series_name
+from .verify import SIDECAR_EXTENSION
+from .journal import PARTIAL_EXTENSION
+from .manifest import Manifests
+from . import utils
 
 logger = logging.getLogger("easy_backup")
 
 
+# DatedFile flags
+FDOW = 1  # first day of week (monday)
+FDOM = 2  # first day of month
+FDOY = 4  # first day of year
+
+
 class DatedFile(object):
+    """
+    A backup file and its date; only dated files are collected for rotation.
+    Age and flags are computed once, on construction.
+    """
 
-    filename = None
-    filedate = None
-    age = None
+    __slots__ = ['filename', 'filedate', 'age', 'flags', 'size', 'inode', ]
 
-    def __init__(self, filename):
+    def __init__(self, filename, today, parser):
+        """
+        today is computed once by the caller (es: once per rotation run);
+        parser is a dateparse.FilenameDateParser
+        """
         self.filename = filename
-        self.parse_filedate()
-        if self.filedate is not None:
-            self.age = (datetime.date.today() - self.filedate).days
-
-    def parse_filedate(self):
-        if self.filedate is None:
-            # try "2018-03-22_..."
-            try:
-                self.filedate = datetime.datetime.strptime(self.filename[:10], "%Y-%m-%d").date()
-            except:
-                pass
-        if self.filedate is None:
-            # try "1521766816_2018_03_23_..."
-            try:
-                n = self.filename.find('_')
-                self.filedate = datetime.datetime.strptime(self.filename[n+1:n+1+10], "%Y_%m_%d").date()
-            except:
-                pass
+        # size and inode are only collected when required (see RotationIndex)
+        self.size = 0
+        self.inode = None
+        self.filedate = filedate = parser.parse(filename)
+        if filedate is None:
+            self.age = None
+            self.flags = 0
+        else:
+            self.age = (today - filedate).days
+            self.flags = (
+                (FDOW if filedate.weekday() == 0 else 0) |
+                (FDOM if filedate.day == 1 else 0) |
+                (FDOY if filedate.day == 1 and filedate.month == 1 else 0)
+            )
 
     def __str__(self):
         if self.filedate is None:
@@ -40,10 +58,10 @@ class DatedFile(object):
         return '%s [dated:%s, age=%d, fdow=%d, fdom=%d, fdoy=%d]' % (
             self.filename,
             self.filedate,
-            int(self.age),
-            int(self.fdow),
-            int(self.fdom),
-            int(self.fdoy),
+            self.age,
+            self.fdow,
+            self.fdom,
+            self.fdoy,
         )
 
     def is_dated(self):
@@ -54,149 +72,423 @@ class DatedFile(object):
         """
         First day of week ?
         """
-        if self.filedate is None:
-            return False
-        return self.filedate.weekday() == 0
+        return bool(self.flags & FDOW)
 
     @property
     def fdom(self):
         """
         First day of month ?
         """
-        if self.filedate is None:
-            return False
-        return self.filedate.day == 1
+        return bool(self.flags & FDOM)
 
     @property
     def fdoy(self):
         """
         First day of year ?
         """
-        if self.filedate is None:
-            return False
-        return self.filedate.month == 1 and self.filedate.day == 1
+        return bool(self.flags & FDOY)
 
-    def dry_run_message(self, message):
-        sys.stderr.write("\x1b[1;37;40m" + message + "\x1b[0m\n")
 
-    def move_to(self, source_folder, target_folder, dry_run):
+class RotationIndex(object):
+    """
+    In-memory index of the backup tree, built by listing each folder only once:
+    - files: for each folder, the list of dated files
+    - filenames: all filenames found, dated or not
+    - undated_size: the total size of undated files (only when with_sizes is set)
+    - sidecars: paths of the checksum files (see verify.py), which follow their
+      backup file and are not rotated by themselves
+    Partial outputs (see journal.py) are ignored.
+    Planning stages update the index as files are (virtually) moved between folders.
+
+    When with_sizes is set, the size and inode of each file are collected too
+    (which requires an additional stat() call per file).
+    """
+
+    def __init__(self, folders, today, parser, with_sizes=False):
+        self.today = today
+        self.files = {}
+        self.filenames = []
+        self.undated_size = 0
+        self.sidecars = set()
+        self.bases = None
+        for folder in folders:
+            if not folder or folder in self.files:
+                continue
+            files = []
+            filenames = os.listdir(folder) if os.path.isdir(folder) else []
+            listed = set(filenames)
+            for filename in filenames:
+                if filename.endswith(PARTIAL_EXTENSION):
+                    # output of a running or interrupted job
+                    continue
+                if filename.endswith(SIDECAR_EXTENSION) and filename[:-len(SIDECAR_EXTENSION)] in listed:
+                    self.sidecars.add(os.path.join(folder, filename))
+                    if with_sizes:
+                        self.undated_size += os.lstat(os.path.join(folder, filename)).st_size
+                    continue
+                self.filenames.append(filename)
+                file_obj = DatedFile(filename, today, parser)
+                if with_sizes:
+                    filepath = os.path.join(folder, filename)
+                    st = os.lstat(filepath)
+                    file_obj.inode = (st.st_dev, st.st_ino)
+                    file_obj.size = utils.get_path_size(filepath) if stat.S_ISDIR(st.st_mode) else st.st_size
+                    if not file_obj.is_dated():
+                        self.undated_size += file_obj.size
+                if file_obj.is_dated():
+                    files.append(file_obj)
+            self.files[folder] = files
+
+    def chain_bases(self):
         """
-        Move dated file from source to target folder
+        Level-0 archives required by some level-1 archive (computed once)
         """
-        assert(self.is_dated())
-        message = 'Moving file "%s" from "%s" to "%s"' % (self.filename, source_folder, target_folder)
-        if dry_run:
-            self.dry_run_message(message)
-        else:
-            logger.info('File "%s" ...' % self.filename)
-            logger.debug(message)
-            os.rename(os.path.join(source_folder, self.filename), os.path.join(target_folder, self.filename))
+        if self.bases is None:
+            self.bases = find_chain_bases(self.filenames)
+        return self.bases
 
-    def to_quarantine(self, source_folder, quarantine_folder, dry_run):
+    def by_date(self):
         """
-        Move dated file to quarantine.
-        Target filename will be prepended with current date,
-        so we always know when this happened.
-
-        If no quarantine folder has been configured, just delete the file.
+        Returns a dict: date -> list of (folder, dated file)
         """
-        assert(self.is_dated())
-        if quarantine_folder:
-            target_filename = "%s_____%s" % (datetime.date.today().strftime('%Y-%m-%d'), self.filename)
-            message = 'Moving file "%s" from "%s" to "%s"' % (self.filename, source_folder, quarantine_folder)
-            if dry_run:
-                self.dry_run_message(message)
-            else:
-                logger.info('File "%s" ...' % self.filename)
-                logger.debug(message)
-                os.rename(os.path.join(source_folder, self.filename), os.path.join(quarantine_folder, target_filename))
-        else:
-            self.destroy(source_folder, dry_run)
+        index = {}
+        for folder, files in self.files.items():
+            for file_obj in files:
+                index.setdefault(file_obj.filedate, []).append((folder, file_obj))
+        return index
 
-    def destroy(self, source_folder, dry_run):
+    def select(self, folder, min_age, promote_flags, protected=()):
         """
-        Remove the file.
+        Evaluate the rotation predicates for all files of folder at once:
+        among files at least min_age days old, those having any of promote_flags
+        are promoted, and the others are discarded, unless protected.
+
+        Promoted and discarded files are removed from folder's list;
+        returns (promoted, discarded).
         """
-        message = 'Erasing file "%s" from "%s"' % (self.filename, source_folder)
-        if dry_run:
-            self.dry_run_message(message)
-        else:
-            logger.info(message)
-            os.unlink(os.path.join(source_folder, self.filename))
+        remaining = []
+        promoted = []
+        discarded = []
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for file_obj in self.files.get(folder, []):
+            if file_obj.age < min_age:
+                remaining.append(file_obj)
+                continue
+            if debug:
+                logger.debug(file_obj)
+            if file_obj.flags & promote_flags:
+                promoted.append(file_obj)
+            elif file_obj.filename in protected:
+                logger.info('File "%s" kept in "%s": required by incremental archives' % (file_obj.filename, folder))
+                remaining.append(file_obj)
+            else:
+                discarded.append(file_obj)
+        self.files[folder] = remaining
+        return promoted, discarded
+
+    def add(self, files, folder):
+        self.files.setdefault(folder, []).extend(files)
 
 
-def collect_dated_files(source_folder, min_age):
+class RotationAction(object):
     """
+    A single step of the rotation plan:
+    - "move": rename from source_folder to target_folder
+    - "quarantine": rename from source_folder to target_folder, prepending the current date
+    - "delete": remove from source_folder
     """
-    files = []
-    filenames = os.listdir(source_folder)
-    for filename in filenames:
-        file_obj = DatedFile(filename)
-        if file_obj.is_dated() and file_obj.age >= min_age:
-            files.append(file_obj)
-    return files
 
+    def __init__(self, kind, filename, source_folder, target_folder=None, target_filename=None):
+        self.kind = kind
+        self.filename = filename
+        self.source_folder = source_folder
+        self.target_folder = target_folder
+        self.target_filename = target_filename or filename
 
-def rotate_daily(DAILY, WEEKLY, QUARANTINE, dry_run):
-    logger.info('* Rotating daily files ...')
-    files = collect_dated_files(DAILY, 7)
-    errors = 0
-    for file_obj in files:
-        logger.debug(file_obj)
-        try:
-            if file_obj.fdow or file_obj.fdom:
-                file_obj.move_to(DAILY, WEEKLY, dry_run)
+    def __str__(self):
+        if self.kind == 'delete':
+            return 'Erasing file "%s" from "%s"' % (self.filename, self.source_folder)
+        return 'Moving file "%s" from "%s" to "%s"' % (self.filename, self.source_folder, self.target_folder)
+
+    def execute(self, with_sidecar=False):
+        source = os.path.join(self.source_folder, self.filename)
+        if self.kind == 'delete':
+            if os.path.isdir(source):
+                shutil.rmtree(source)
             else:
-                file_obj.to_quarantine(DAILY, QUARANTINE, dry_run)
-        except Exception as e:
-            logger.error(str(e), exc_info=True)
-            errors += 1
-    return errors
+                os.unlink(source)
+            if with_sidecar:
+                os.unlink(source + SIDECAR_EXTENSION)
+        elif self.kind in ['move', 'quarantine', ]:
+            target = os.path.join(self.target_folder, self.target_filename)
+            os.rename(source, target)
+            if with_sidecar:
+                os.rename(source + SIDECAR_EXTENSION, target + SIDECAR_EXTENSION)
 
 
-def rotate_weekly(WEEKLY, MONTHLY, QUARANTINE, dry_run):
-    logger.info('* Rotating weekly files ...')
-    files = collect_dated_files(WEEKLY, 31)
-    errors = 0
-    for file_obj in files:
-        logger.debug(file_obj)
-        try:
-            if file_obj.fdom:
-                file_obj.move_to(WEEKLY, MONTHLY, dry_run)
-            else:
-                file_obj.to_quarantine(WEEKLY, QUARANTINE, dry_run)
-        except Exception as e:
-            logger.error(str(e), exc_info=True)
-            errors += 1
-    return errors
+class RotationPlan(object):
+    """
+    The list of actions computed by the planning stages.
 
+    A file can be moved more than once while planning (es: from daily to weekly, and then
+    from weekly to monthly); only the final destination is retained, so that each file
+    is renamed at most once.
+    """
 
-def rotate_monthly(MONTHLY, YEARLY, QUARANTINE, dry_run):
-    logger.info('* Rotating monthly files ...')
-    files = collect_dated_files(MONTHLY, 365)
-    errors = 0
-    for file_obj in files:
-        logger.debug(file_obj)
-        try:
-            if file_obj.fdoy:
-                file_obj.move_to(MONTHLY, YEARLY, dry_run)
+    def __init__(self):
+        self.actions = []
+        self.pending = {}
+
+    def add(self, kind, file_obj, source_folder, target_folder=None, target_filename=None):
+        previous = self.pending.get(file_obj)
+        if previous is not None:
+            # update the destination of a file already planned to be moved
+            previous.kind = kind
+            previous.target_folder = target_folder
+            previous.target_filename = target_filename or previous.filename
+            return previous
+        action = RotationAction(kind, file_obj.filename, source_folder, target_folder, target_filename)
+        self.actions.append(action)
+        self.pending[file_obj] = action
+        return action
+
+    def move(self, files, source_folder, target_folder):
+        for file_obj in files:
+            self.add('move', file_obj, source_folder, target_folder)
+
+    def quarantine(self, files, source_folder, quarantine_folder, today):
+        """
+        Files moved to quarantine are prepended with the current date,
+        so we always know when this happened.
+        If no quarantine folder has been configured, just delete the files.
+        """
+        prefix = today.strftime('%Y-%m-%d')
+        for file_obj in files:
+            if quarantine_folder:
+                target_filename = "%s_____%s" % (prefix, file_obj.filename)
+                self.add('quarantine', file_obj, source_folder, quarantine_folder, target_filename)
             else:
-                file_obj.to_quarantine(MONTHLY, QUARANTINE, dry_run)
-        except Exception as e:
-            logger.error(str(e), exc_info=True)
-            errors += 1
-    return errors
+                self.add('delete', file_obj, source_folder)
+
+    def delete(self, files, source_folder):
+        for file_obj in files:
+            self.add('delete', file_obj, source_folder)
+
+    def batches(self):
+        """
+        Group actions by kind, source and target folder, preserving order
+        """
+        batches = []
+        keys = {}
+        for action in self.actions:
+            key = (action.kind, action.source_folder, action.target_folder)
+            if key not in keys:
+                keys[key] = len(batches)
+                batches.append((key, []))
+            batches[keys[key]][1].append(action)
+        return batches
+
+
+def dry_run_message(message):
+    sys.stderr.write("\x1b[1;37;40m" + message + "\x1b[0m\n")
+
 
+def rotate_folder(plan, index, source_folder, target_folder, quarantine_folder, today, min_age, promote_flags, protected):
+    promoted, discarded = index.select(source_folder, min_age, promote_flags, protected)
+    plan.move(promoted, source_folder, target_folder)
+    index.add(promoted, target_folder)
+    plan.quarantine(discarded, source_folder, quarantine_folder, today)
 
-def cleanup_quarantine(QUARANTINE, quarantine_max_age, dry_run):
+
+def rotate_daily(plan, index, DAILY, WEEKLY, QUARANTINE, today, protected=()):
+    rotate_folder(plan, index, DAILY, WEEKLY, QUARANTINE, today, 7, FDOW | FDOM, protected)
+
+
+def rotate_weekly(plan, index, WEEKLY, MONTHLY, QUARANTINE, today, protected=()):
+    rotate_folder(plan, index, WEEKLY, MONTHLY, QUARANTINE, today, 31, FDOM, protected)
+
+
+def rotate_monthly(plan, index, MONTHLY, YEARLY, QUARANTINE, today, protected=()):
+    rotate_folder(plan, index, MONTHLY, YEARLY, QUARANTINE, today, 365, FDOY, protected)
+
+
+def cleanup_quarantine(plan, index, QUARANTINE, quarantine_max_age):
     if QUARANTINE:
-        logger.info('* Cleanup quarantine ... (max age: %d)' % quarantine_max_age)
-        files = collect_dated_files(QUARANTINE, quarantine_max_age)
-        for file in files:
-            file.destroy(QUARANTINE, dry_run)
+        _, expired = index.select(QUARANTINE, quarantine_max_age, 0)
+        plan.delete(expired, QUARANTINE)
+
+
+def apply_retention_policies(plan, index, folders, quarantine, today, policies, protected=()):
+    """
+    Retain the files selected by the retention policies, in a single pass over
+    the daily, weekly, monthly and yearly folders; everything else goes to quarantine.
 
+    Each retained file is placed in the folder of the finest rule which retains it
+    (es: "weekly" for a file no longer retained as daily, but still as weekly),
+    but never moved back to a finer folder.
+    """
+    ranks = dict([(folder, rank) for rank, folder in enumerate(folders)])
+    targets = {
+        'last': folders[0],
+        'daily': folders[0],
+        'weekly': folders[1],
+        'monthly': folders[2],
+        'yearly': folders[3],
+    }
+    files = []
+    for folder in folders:
+        files.extend([(folder, file_obj) for file_obj in index.files.get(folder, [])])
+    retained = policies.select([file_obj for folder, file_obj in files])
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    updated = dict([(folder, []) for folder in folders])
+    for folder, file_obj in files:
+        reason = retained.get(file_obj)
+        if debug:
+            logger.debug('%s [retained: %s]' % (file_obj, reason or '-'))
+        if reason is not None:
+            target = targets[reason]
+            if ranks[target] <= ranks[folder]:
+                target = folder
+            else:
+                plan.move([file_obj], folder, target)
+            updated[target].append(file_obj)
+        elif file_obj.filename in protected:
+            logger.info('File "%s" kept in "%s": required by incremental archives' % (file_obj.filename, folder))
+            updated[folder].append(file_obj)
+        else:
+            plan.quarantine([file_obj], folder, quarantine, today)
+    index.files.update(updated)
+
+
+def build_rotation_plan(index, daily, weekly, monthly, yearly, quarantine, quarantine_max_age, today, policies=None):
+    """
+    Compute all moves, quarantines and deletions in advance, from the index alone;
+    files are retained either by the given retention policies or by the fixed
+    age rules (see rotate_daily(), rotate_weekly() and rotate_monthly())
+    """
+    plan = RotationPlan()
+
+    # Level-0 archives are never discarded while some level-1 archive depends on them
+    protected = index.chain_bases()
+
+    if policies is not None:
+        logger.info('* Applying retention policies ...')
+        apply_retention_policies(plan, index, [daily, weekly, monthly, yearly, ], quarantine, today, policies, protected)
+    else:
+        logger.info('* Planning daily files ...')
+        rotate_daily(plan, index, daily, weekly, quarantine, today, protected)
+        logger.info('* Planning weekly files ...')
+        rotate_weekly(plan, index, weekly, monthly, quarantine, today, protected)
+        logger.info('* Planning monthly files ...')
+        rotate_monthly(plan, index, monthly, yearly, quarantine, today, protected)
+    if quarantine:
+        logger.info('* Planning quarantine cleanup ... (max age: %d)' % quarantine_max_age)
+        cleanup_quarantine(plan, index, quarantine, quarantine_max_age)
+    return plan
+
+
+def enforce_quota(plan, index, folders, quarantine, max_total_size, protected=()):
+    """
+    After planning, evict files until the total size of the backup folders is within
+    max_total_size: quarantined files first (the oldest first), then the oldest backups,
+    skipping level-0 archives required by incremental archives and the most recent
+    file of each backup source.
+
+    Hard-linked files (see "skip_unchanged") are counted once, and free space
+    only when all their links are evicted.
+    """
+    # files surviving the plan: still in the backup folders, already in quarantine,
+    # or being moved to quarantine
+    quarantined = sorted(index.files.get(quarantine, []), key=lambda f: (f.filedate, f.filename)) if quarantine else []
+    quarantining = sorted(
+        [file_obj for file_obj, action in plan.pending.items() if action.kind == 'quarantine'],
+        key=lambda f: (f.filedate, f.filename),
+    )
+    backups = []
+    for folder in folders:
+        backups.extend([(folder, file_obj) for file_obj in index.files.get(folder, [])])
+
+    links = {}
+    usage = index.undated_size
+    for file_obj in quarantined + quarantining + [file_obj for folder, file_obj in backups]:
+        if file_obj.inode not in links:
+            usage += file_obj.size
+        links[file_obj.inode] = links.get(file_obj.inode, 0) + 1
+
+    logger.info('* Quota: %s used of %s' % (utils.sizeof_fmt(usage), utils.sizeof_fmt(max_total_size)))
+    if usage <= max_total_size:
+        return
+
+    # the most recent file of each series is never evicted
+    latest = {}
+    for folder, file_obj in backups:
+        name = series_name(file_obj.filename)
+        if name not in latest or (file_obj.filedate, file_obj.filename) > (latest[name].filedate, latest[name].filename):
+            latest[name] = file_obj
+    candidates = [(quarantine, file_obj) for file_obj in quarantined + quarantining]
+    candidates += sorted(
+        [(folder, file_obj) for folder, file_obj in backups
+            if file_obj.filename not in protected and latest[series_name(file_obj.filename)] is not file_obj],
+        key=lambda item: (item[1].filedate, item[1].filename),
+    )
+
+    evicted = set()
+    evicted_size = 0
+    for folder, file_obj in candidates:
+        if usage <= max_total_size:
+            break
+        plan.add('delete', file_obj, folder)
+        evicted.add(file_obj)
+        links[file_obj.inode] -= 1
+        if links[file_obj.inode] == 0:
+            usage -= file_obj.size
+            evicted_size += file_obj.size
+    for folder in index.files:
+        index.files[folder] = [f for f in index.files[folder] if f not in evicted]
+
+    logger.info('* Quota: %d file(s) evicted (%s)' % (len(evicted), utils.sizeof_fmt(evicted_size)))
+    if usage > max_total_size:
+        logger.warning('Unable to meet quota: %s used of %s' % (utils.sizeof_fmt(usage), utils.sizeof_fmt(max_total_size)))
+
+
+def execute_rotation_plan(plan, dry_run, sidecars=(), manifests=None):
+    """
+    Execute the plan one batch at a time (same kind, source and target folder);
+    when dry_run is set, print the plan instead.
+    Files listed in sidecars (see RotationIndex) follow their backup file,
+    and so do their entries in the folder manifests, when given.
+    Returns the number of failed actions.
+    """
+    errors = 0
+    for (kind, source_folder, target_folder), actions in plan.batches():
+        if target_folder is None:
+            logger.info('%s: %d file(s) from "%s"' % (kind, len(actions), source_folder))
+        else:
+            logger.info('%s: %d file(s) from "%s" to "%s"' % (kind, len(actions), source_folder, target_folder))
+        for action in actions:
+            if dry_run:
+                dry_run_message(str(action))
+                continue
+            logger.debug(action)
+            try:
+                action.execute(os.path.join(action.source_folder, action.filename + SIDECAR_EXTENSION) in sidecars)
+            except Exception as e:
+                logger.error(str(e), exc_info=True)
+                errors += 1
+                continue
+            if manifests is not None:
+                if kind == 'delete':
+                    manifests.delete(source_folder, action.filename)
+                else:
+                    manifests.move(source_folder, action.filename, target_folder, action.target_filename)
+    if manifests is not None and not dry_run:
+        manifests.save()
+    return errors
 
-def rotate_all(target_folder, daily, weekly, monthly, yearly, quarantine, quarantine_max_age, dry_run):
+
+def rotate_all(target_folder, daily, weekly, monthly, yearly, quarantine, quarantine_max_age, dry_run,
+               date_formats=None, policies=None, max_total_size=None):
 
     # remember cwd
     original_cwd = os.getcwd()
@@ -217,18 +509,20 @@ def rotate_all(target_folder, daily, weekly, monthly, yearly, quarantine, quaran
         # Create working folders
         if os.path.exists(daily):
             for folder in [weekly, monthly, yearly, quarantine, ]:
-                if not os.path.exists(folder):
+                if folder and not os.path.exists(folder):
                     logger.info('Creating folder "%s"' % folder)
                     os.makedirs(folder)
         else:
             raise Exception('Daily folder "%s" not found in "%s"' % (daily, target_folder))
 
-        # Rotate files
-        errors += rotate_daily(daily, weekly, quarantine, dry_run)
-        errors += rotate_weekly(weekly, monthly, quarantine, dry_run)
-        errors += rotate_monthly(monthly, yearly, quarantine, dry_run)
-
-        cleanup_quarantine(quarantine, quarantine_max_age, dry_run)
+        # Scan the tree once, then plan and execute all actions
+        today = datetime.date.today()
+        index = RotationIndex([daily, weekly, monthly, yearly, quarantine, ], today, get_date_parser(date_formats),
+            with_sizes=bool(max_total_size))
+        plan = build_rotation_plan(index, daily, weekly, monthly, yearly, quarantine, quarantine_max_age, today, policies)
+        if max_total_size:
+            enforce_quota(plan, index, [daily, weekly, monthly, yearly, ], quarantine, max_total_size, index.chain_bases())
+        errors += execute_rotation_plan(plan, dry_run, index.sidecars, Manifests())
 
     except Exception as e:
         logger.error(str(e), exc_info=True)
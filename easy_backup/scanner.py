@@ -0,0 +1,194 @@
+import os
+import re
+import stat
+import logging
+
+logger = logging.getLogger("easy_backup")
+
+WILDCARDS = re.compile(r'[*?\[]')
+
+
+class ScanEntry(object):
+
+    __slots__ = ['path', 'name', 'is_dir', 'size', 'mtime_ns', 'mode', ]
+
+    def __init__(self, path, name, is_dir, size, mtime_ns, mode):
+        # path is relative to the scan root's parent folder (es: "www/static/app.css")
+        self.path = path
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.mode = mode
+
+
+def translate_pattern(pattern):
+    """
+    Translate a glob pattern into a regular expression;
+    "*" and "?" never match "/", while "**" matches any sequence of characters
+    """
+    i, n = 0, len(pattern)
+    regex = ''
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if i < n and pattern[i] == '*':
+                i += 1
+                regex += '.*'
+            else:
+                regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            j = pattern.find(']', i + 1 if i < n and pattern[i] in '!^' else i)
+            if j < 0:
+                regex += '\\['
+            else:
+                chars = pattern[i:j]
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                regex += '[%s]' % chars.replace('\\', '\\\\')
+                i = j + 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+class ExcludeMatcher(object):
+    """
+    Matches paths against a set of exclude patterns, precompiled once:
+
+    - patterns containing a "/" are matched against the absolute path (es: "/home/baduser/public/media")
+    - other patterns are matched against the file or folder name, at any depth (es: "node_modules", "*.pyc")
+
+    Literal patterns are looked up in sets; patterns with wildcards are combined into
+    a single regular expression for each kind.
+    """
+
+    def __init__(self, patterns):
+        self.paths = set()
+        self.names = set()
+        path_regexes = []
+        name_regexes = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if pattern != os.sep:
+                pattern = pattern.rstrip(os.sep)
+            if not pattern:
+                continue
+            literal = WILDCARDS.search(pattern) is None
+            if os.sep in pattern:
+                if literal:
+                    self.paths.add(pattern)
+                else:
+                    path_regexes.append(translate_pattern(pattern))
+            else:
+                if literal:
+                    self.names.add(pattern)
+                else:
+                    name_regexes.append(translate_pattern(pattern))
+        self.path_regex = re.compile('(?:%s)\\Z' % '|'.join(path_regexes)) if path_regexes else None
+        self.name_regex = re.compile('(?:%s)\\Z' % '|'.join(name_regexes)) if name_regexes else None
+
+    def __bool__(self):
+        return bool(self.paths or self.names or self.path_regex or self.name_regex)
+    __nonzero__ = __bool__
+
+    def match(self, path, name=None):
+        if path != os.sep:
+            path = path.rstrip(os.sep)
+        if name is None:
+            name = os.path.basename(path)
+        return (
+            name in self.names or
+            path in self.paths or
+            (self.name_regex is not None and self.name_regex.match(name) is not None) or
+            (self.path_regex is not None and self.path_regex.match(path) is not None)
+        )
+
+
+class FolderScan(object):
+    """
+    Result of scan_folder():
+    - entries: the list of ScanEntry, folder itself included
+    - excluded: the paths of excluded files and subfolders
+    - total_size: the total size of all files, in bytes
+    all paths being relative to folder's parent
+    """
+
+    def __init__(self, folder, entries, excluded):
+        self.folder = folder
+        self.entries = entries
+        self.excluded = excluded
+        self.total_size = sum([entry.size for entry in entries])
+
+    def write_list(self, filepath, directories_only=False):
+        """
+        Write the (null-terminated) list of paths, as expected by "tar --null -T"
+        """
+        with open(filepath, 'wb') as f:
+            for entry in self.entries:
+                if entry.is_dir or not directories_only:
+                    f.write(entry.path.encode('utf-8', 'surrogateescape') + b'\0')
+
+    def write_excluded(self, filepath):
+        with open(filepath, 'wb') as f:
+            for path in self.excluded:
+                f.write(path.encode('utf-8', 'surrogateescape') + b'\0')
+
+
+def scan_folder(folder, matcher):
+    """
+    Walk folder once with os.scandir(), skipping excluded subtrees without reading them.
+
+    Symbolic links are followed (as "tar -h" does), but each folder is visited only once
+    along any path, to avoid loops.
+    """
+    folder = os.path.abspath(folder)
+    parent_folder = os.path.dirname(folder)
+    prefix_length = len(parent_folder.rstrip(os.sep)) + 1
+
+    entries = []
+    excluded = []
+    st = os.stat(folder)
+    entries.append(ScanEntry(folder[prefix_length:], os.path.basename(folder), True, 0, st.st_mtime_ns, st.st_mode))
+
+    stack = [(folder, frozenset([(st.st_dev, st.st_ino)]))]
+    while stack:
+        path, ancestors = stack.pop()
+        try:
+            iterator = os.scandir(path)
+        except OSError as e:
+            logger.warning('Unable to scan "%s": %s' % (path, str(e)))
+            continue
+        subfolders = []
+        with iterator:
+            for entry in iterator:
+                if matcher and matcher.match(entry.path, entry.name):
+                    logger.debug('Excluded: "%s"' % entry.path)
+                    excluded.append(entry.path[prefix_length:])
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # dangling symbolic link
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        logger.warning('Unable to stat "%s": %s' % (entry.path, str(e)))
+                        continue
+                is_dir = stat.S_ISDIR(st.st_mode)
+                entries.append(ScanEntry(
+                    entry.path[prefix_length:], entry.name, is_dir,
+                    0 if is_dir else st.st_size, st.st_mtime_ns, st.st_mode,
+                ))
+                if is_dir:
+                    key = (st.st_dev, st.st_ino)
+                    if key in ancestors:
+                        logger.warning('Symbolic link loop: "%s"' % entry.path)
+                        continue
+                    subfolders.append((entry.path, ancestors | frozenset([key])))
+        # depth-first, in directory order
+        stack.extend(reversed(subfolders))
+    return FolderScan(folder, entries, excluded)
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import threading
+import traceback
+import contextvars
+import concurrent.futures
+
+from .configuration import get_config
+from .utils import ERRORS_LIST, MAINTENANCE_ERRORS_LIST, MaintenanceError
+from .metrics import JobMetrics, METRICS, measure
+
+logger = logging.getLogger("easy_backup")
+
+# submit_after(): the job is started after all other jobs
+ALL = '*'
+
+# Concurrency limits of shared resources: resource -> (section, item)
+RESOURCE_LIMITS = {
+    'cpu': ('general', 'max_cpu_jobs'),
+    'disk': ('general', 'max_disk_jobs'),
+    'postgresql server': ('postgresql', 'max_server_jobs'),
+    'mysql server': ('mysql', 'max_server_jobs'),
+}
+
+
+class Job(object):
+
+    def __init__(self, section, name, func, args, kwargs, after=None, resources=None):
+        self.section = section
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # jobs, section names or ALL
+        self.after = after or []
+        # the section, and the resources used by the job
+        self.resources = resources or [section, ]
+        self.result = None
+        self.completed = False
+        self.metrics = JobMetrics(section, name)
+
+    def __str__(self):
+        return '%s: %s' % (self.section, self.name)
+
+    def is_async(self):
+        return asyncio.iscoroutinefunction(self.func)
+
+    def run(self):
+        self.result = self.func(*self.args, **self.kwargs)
+
+
+class Scheduler(object):
+    """
+    Run backup jobs as a graph of tasks, on an asyncio event loop.
+
+    Jobs are either coroutine functions (es: commands run as asyncio subprocesses
+    by process.run_async()), executed on the event loop, or plain functions,
+    executed on a pool of worker threads.
+
+    Jobs are started in submission order, as soon as:
+    - the jobs and sections they depend on (see submit_after()) have been completed
+      (successfully or not)
+    - fewer than max_workers jobs are running (jobs of sections with a pool of their own
+      are limited by the pool size only)
+    - neither the job's section nor any resource used by the jobs of that section
+      (es: "cpu", "disk", a database server) has reached its own concurrency limit
+
+    Jobs may submit further jobs while the scheduler is running; follow-up callbacks,
+    registered for a section, are called after each successful job of that section
+    (es: to submit a verification job for the file it produced).
+
+    When a journal (see journal.py) is given, the state of each job is recorded
+    there, and jobs already completed by an interrupted run are skipped.
+
+    Failures are collected in ERRORS_LIST, or in MAINTENANCE_ERRORS_LIST
+    when the job raises a MaintenanceError.
+    """
+
+    def __init__(self, max_workers=1, limits=None, metrics=None, journal=None, resources=None, journaled=None, pools=None):
+        self.max_workers = max(1, max_workers)
+        # section or resource -> max number of concurrent jobs (0: no limit)
+        self.limits = dict(limits or {})
+        # section -> size of its own pool (es: {"maintenance": 1})
+        self.pools = pools or {}
+        self.limits.update(self.pools)
+        # section -> resources used by its jobs
+        self.resources = resources or {}
+        # optional metrics.Metrics collecting the metrics of all jobs
+        self.metrics = metrics
+        self.journal = journal
+        # sections whose jobs are recorded in the journal (default: all)
+        self.journaled = journaled
+        self.pending = []
+        self.running = []
+        self.tasks = set()
+        self.follow_ups = {}
+        # protects pending and running, since jobs can be submitted by worker threads
+        self.lock = threading.Lock()
+        self.loop = None
+        self.wakeup = None
+        self.executor = None
+
+    def submit(self, section, name, func, *args, **kwargs):
+        return self.add_job(self.create_job(section, name, func, args, kwargs))
+
+    def submit_first(self, section, name, func, *args, **kwargs):
+        """
+        Same as submit(), but the job is started before the pending ones
+        """
+        return self.add_job(self.create_job(section, name, func, args, kwargs), first=True)
+
+    def submit_after(self, after, section, name, func, *args, **kwargs):
+        """
+        Same as submit(), but the job is started only when all items in after have been completed:
+        - a job
+        - a section name: all jobs of that section (including those submitted in the meantime)
+        - ALL: all other jobs
+        """
+        return self.add_job(self.create_job(section, name, func, args, kwargs, after))
+
+    def create_job(self, section, name, func, args, kwargs, after=None):
+        job = Job(section, name, func, args, kwargs, after, [section, ] + self.resources.get(section, []))
+        if self.metrics is not None:
+            self.metrics.add(job.metrics)
+        if self.is_journaled(job):
+            self.journal.add(str(job))
+        return job
+
+    def add_job(self, job, first=False):
+        with self.lock:
+            if first:
+                self.pending.insert(0, job)
+            else:
+                self.pending.append(job)
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.wakeup.set)
+        return job
+
+    def is_journaled(self, job):
+        return self.journal is not None and (self.journaled is None or job.section in self.journaled)
+
+    def follow(self, sections, callback):
+        """
+        Call callback(job) after each successful job of the given sections
+        """
+        for section in sections:
+            self.follow_ups.setdefault(section, []).append(callback)
+
+    def is_ready(self, job):
+        # called with the lock held
+        others = [other for other in self.pending + self.running if other is not job]
+        for item in job.after:
+            if isinstance(item, Job):
+                if not item.completed:
+                    return False
+            elif item == ALL:
+                if [other for other in others if ALL not in other.after]:
+                    return False
+            elif [other for other in others if other.section == item]:
+                return False
+        return True
+
+    def can_start(self, job):
+        # called with the lock held
+        if job.section not in self.pools:
+            if len([other for other in self.running if other.section not in self.pools]) >= self.max_workers:
+                return False
+        for resource in job.resources:
+            limit = self.limits.get(resource, 0)
+            if limit > 0 and len([other for other in self.running if resource in other.resources]) >= limit:
+                return False
+        return self.is_ready(job)
+
+    def start_jobs(self):
+        """
+        Start all pending jobs which can be started right now
+        """
+        with self.lock:
+            for job in list(self.pending):
+                if self.can_start(job):
+                    self.pending.remove(job)
+                    self.running.append(job)
+                    task = self.loop.create_task(self.execute(job))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+            return len(self.running) > 0
+
+    def abandon_jobs(self):
+        """
+        Fail the pending jobs which can never be started (es: circular dependencies)
+        """
+        with self.lock:
+            jobs, self.pending = self.pending, []
+        for job in jobs:
+            message = 'Job "%s" not started: unsatisfiable dependencies' % job
+            logger.error(message)
+            ERRORS_LIST.append({
+                'message': message,
+                'traceback': '',
+            })
+
+    async def execute(self, job):
+        logger.debug('Job started: "%s"' % job)
+        try:
+            if self.is_journaled(job) and self.journal.is_done(str(job)):
+                # completed by the interrupted run; follow-ups are run again,
+                # and skipped in turn if they had been completed too
+                logger.info('Job "%s" already completed: skipped' % job)
+                job.result = self.journal.output(str(job))
+            else:
+                if self.is_journaled(job):
+                    self.journal.update(str(job), 'running')
+                with measure(job.metrics):
+                    if job.is_async():
+                        job.result = await job.func(*job.args, **job.kwargs)
+                    else:
+                        # the worker thread sees the job metrics (see metrics.measure())
+                        await self.loop.run_in_executor(self.executor, contextvars.copy_context().run, job.run)
+                if self.is_journaled(job):
+                    self.journal.update(str(job), 'done', job.result)
+            for callback in self.follow_ups.get(job.section, []):
+                callback(job)
+        except Exception as e:
+            if self.is_journaled(job):
+                self.journal.update(str(job), 'failed')
+            logger.error('Job "%s" failed: %s' % (job, str(e)))
+            errors = MAINTENANCE_ERRORS_LIST if isinstance(e, MaintenanceError) else ERRORS_LIST
+            errors.append({
+                'message': str(e),
+                'traceback': traceback.format_exc(),
+            })
+        finally:
+            job.completed = True
+            with self.lock:
+                self.running.remove(job)
+            self.wakeup.set()
+        logger.debug('Job completed: "%s"' % job)
+
+    async def dispatch(self):
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            if not self.start_jobs():
+                if self.pending:
+                    self.abandon_jobs()
+                break
+            await self.wakeup.wait()
+
+    def run(self):
+        """
+        Execute all submitted jobs, and wait for completion
+        """
+        # pool jobs don't wait for backup workers, synchronous ones included
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers + sum(self.pools.values()),
+            thread_name_prefix='worker',
+        )
+        try:
+            asyncio.run(self.dispatch())
+        finally:
+            with self.lock:
+                self.loop = None
+            self.executor.shutdown(wait=False)
+
+
+def build_scheduler(sections, journal=None, resources=None, pools=None):
+    """
+    Create a scheduler as specified in the config file:
+    - [general] max_workers: the total number of concurrent jobs
+    - [<section>] max_workers: the number of concurrent jobs for each section
+    - the concurrency limit of each resource (see RESOURCE_LIMITS)
+    Jobs of the given sections, and of the sections with a pool of their own (pools),
+    are recorded in the journal (if any); resources maps each section to the resources
+    used by its jobs
+    """
+    config = get_config()
+    limits = {}
+    for section in sections:
+        limits[section] = config.get_item_as_int(section, 'max_workers', 0)
+    for resource, (section, item) in RESOURCE_LIMITS.items():
+        limits[resource] = config.get_item_as_int(section, item, 0)
+    return Scheduler(
+        max_workers=config.get_item_as_int('general', 'max_workers', 1),
+        limits=limits,
+        metrics=METRICS,
+        journal=journal,
+        resources=resources,
+        journaled=sections + list((pools or {}).keys()),
+        pools=pools,
+    )
@@ -0,0 +1,316 @@
+"""
+Run history and trends.
+
+The metrics of each backup run (see metrics.py) are recorded in a SQLite database
+(<target_root>/easy_backup.sqlite3); "easy_backup stats" shows, for each job,
+the recent durations and sizes, the growth rate of its output, and the slowest jobs.
+
+Before notifying, the jobs of the current run are compared with the moving average
+of their previous runs: a sharp deviation of duration or output size is reported
+as a warning (es: a bloated database, or a truncated dump).
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import logging
+import sqlite3
+import datetime
+import threading
+
+from .args import get_args
+from .configuration import get_config
+from .metrics import format_table
+from . import utils
+
+logger = logging.getLogger("easy_backup")
+
+DATABASE_FILENAME = 'easy_backup.sqlite3'
+
+# number of previous successful runs in the moving average, and the minimum required
+MOVING_AVERAGE_RUNS = 10
+MOVING_AVERAGE_MIN_RUNS = 3
+# a value deviates when it is more than DEVIATION_FACTOR times the average, or less
+# than the average divided by DEVIATION_FACTOR
+DEVIATION_FACTOR = 2.0
+# durations shorter than this are too noisy to be compared
+MIN_DURATION = 10.0
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        hostname TEXT,
+        started REAL NOT NULL,
+        completed REAL NOT NULL,
+        duration REAL NOT NULL,
+        errors INTEGER NOT NULL,
+        output_bytes INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        run_id INTEGER NOT NULL REFERENCES runs(id),
+        section TEXT NOT NULL,
+        name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        started REAL NOT NULL,
+        duration REAL NOT NULL,
+        input_bytes INTEGER,
+        output_bytes INTEGER,
+        exit_code INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS runs_started ON runs (started)",
+    "CREATE INDEX IF NOT EXISTS jobs_job_started ON jobs (section, name, started)",
+    "CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run_id)",
+]
+
+
+class StatsDatabase(object):
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def record_run(self, report):
+        """
+        Save a run, as returned by metrics.Metrics.report()
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (hostname, started, completed, duration, errors, output_bytes) VALUES (?, ?, ?, ?, ?, ?)",
+                (report['hostname'], report['started'], report['completed'], report['duration'],
+                 report['errors'], report['output_bytes']),
+            )
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO jobs (run_id, section, name, status, started, duration, input_bytes, output_bytes, exit_code) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, job['section'], job['name'], job['status'], job['started'], job['duration'],
+                  job['input_bytes'], job['output_bytes'], job['exit_code']) for job in report['jobs']],
+            )
+        return run_id
+
+    def history(self, section, name, limit, before=None):
+        """
+        The most recent successful runs of a job: list of (started, duration, output_bytes)
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT started, duration, output_bytes FROM jobs "
+                "WHERE section = ? AND name = ? AND started < ? AND status = 'ok' "
+                "ORDER BY started DESC LIMIT ?",
+                (section, name, before if before is not None else time.time(), limit),
+            ).fetchall()
+
+    def history_since(self, section, name, since):
+        """
+        All successful runs of a job since the given time, from the most recent:
+        list of (started, duration, output_bytes)
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT started, duration, output_bytes FROM jobs "
+                "WHERE section = ? AND name = ? AND started >= ? AND status = 'ok' "
+                "ORDER BY started DESC",
+                (section, name, since),
+            ).fetchall()
+
+    def jobs_since(self, since):
+        """
+        All job names run since the given time: list of (section, name)
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT DISTINCT jobs.section, jobs.name FROM runs JOIN jobs ON jobs.run_id = runs.id "
+                "WHERE runs.started >= ? ORDER BY jobs.section, jobs.name",
+                (since, ),
+            ).fetchall()
+
+    def runs_since(self, since):
+        """
+        list of (started, duration, errors, output_bytes)
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT started, duration, errors, output_bytes FROM runs WHERE started >= ? ORDER BY started",
+                (since, ),
+            ).fetchall()
+
+
+def get_database_filepath():
+    return os.path.join(utils.get_target_folder(include_target_subfolder=False), DATABASE_FILENAME)
+
+
+def stats_enabled():
+    return get_config().get_item_as_bool('general', 'stats', default=True)
+
+
+def average(values):
+    values = [value for value in values if value is not None]
+    return float(sum(values)) / len(values) if values else None
+
+
+def deviates(value, mean):
+    if value is None or not mean:
+        return False
+    return value > mean * DEVIATION_FACTOR or value < mean / DEVIATION_FACTOR
+
+
+def find_deviations(database, jobs):
+    """
+    Compare the given jobs (metrics.JobMetrics) with the moving average of their
+    previous successful runs; returns a list of warning messages
+    """
+    warnings = []
+    for job in jobs:
+        if job.status != 'ok':
+            continue
+        history = database.history(job.section, job.name, MOVING_AVERAGE_RUNS, before=job.started)
+        if len(history) < MOVING_AVERAGE_MIN_RUNS:
+            continue
+        mean_duration = average([row[1] for row in history])
+        mean_size = average([row[2] for row in history])
+        if deviates(job.duration, mean_duration) and max(job.duration, mean_duration) >= MIN_DURATION:
+            warnings.append('"%s: %s" took %.1fs (average: %.1fs)' % (job.section, job.name, job.duration, mean_duration))
+        if deviates(job.output_bytes, mean_size):
+            warnings.append('"%s: %s" output is %s (average: %s)' % (
+                job.section, job.name, utils.sizeof_fmt(job.output_bytes), utils.sizeof_fmt(mean_size)))
+    return warnings
+
+
+def check_deviations(metrics):
+    """
+    Log (and return) the warnings about the jobs of the current run
+    """
+    filepath = get_database_filepath()
+    if not stats_enabled() or not os.path.exists(filepath):
+        return []
+    try:
+        database = StatsDatabase(filepath)
+        try:
+            warnings = find_deviations(database, metrics.completed_jobs())
+        finally:
+            database.close()
+    except sqlite3.Error as e:
+        logger.error('Unable to read "%s": %s' % (filepath, str(e)))
+        return []
+    for warning in warnings:
+        logger.warning(warning)
+    return warnings
+
+
+def record_run(report):
+    """
+    Save the metrics of the current run in the database
+    """
+    if not stats_enabled():
+        return
+    filepath = get_database_filepath()
+    if get_args().dry_run:
+        sys.stderr.write("\x1b[1;37;40m" + 'Recording run in "%s"' % filepath + "\x1b[0m\n")
+        return
+    database = StatsDatabase(filepath)
+    try:
+        database.record_run(report)
+    finally:
+        database.close()
+
+
+def format_time(value):
+    return datetime.datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M')
+
+
+def growth_rate(history):
+    """
+    Output growth in bytes per day, from the oldest to the most recent sample
+    (history sorted from the most recent)
+    """
+    samples = [(started, size) for started, duration, size in history if size is not None]
+    if len(samples) < 2:
+        return None
+    (last_time, last_size), (first_time, first_size) = samples[0], samples[-1]
+    days = (last_time - first_time) / 86400.0
+    if days <= 0:
+        return None
+    return (last_size - first_size) / days
+
+
+def format_stats(database, days, top=10):
+    """
+    Text report about the runs of the last days
+    """
+    since = time.time() - days * 86400
+    lines = []
+
+    runs = database.runs_since(since)
+    lines.append('Runs in the last %d days: %d' % (days, len(runs)))
+    if runs:
+        lines.append('Last run: %s, %.1fs, %s, %d error(s)' % (
+            format_time(runs[-1][0]), runs[-1][1], utils.sizeof_fmt(runs[-1][3] or 0), runs[-1][2]))
+        lines.append('Average duration: %.1fs; runs with errors: %d' % (
+            average([run[1] for run in runs]), len([run for run in runs if run[2]])))
+    lines.append('')
+
+    rows = [('job', 'runs', 'last', 'avg', 'max', 'output', 'growth/day', ), ]
+    slowest = []
+    warnings = []
+    for section, name in database.jobs_since(since):
+        history = database.history_since(section, name, since)
+        if not history:
+            continue
+        durations = [row[1] for row in history]
+        rate = growth_rate(history)
+        rows.append((
+            '%s: %s' % (section, name),
+            str(len(history)),
+            '%.1fs' % durations[0],
+            '%.1fs' % average(durations),
+            '%.1fs' % max(durations),
+            utils.sizeof_fmt(history[0][2]) if history[0][2] is not None else '-',
+            ('%s%s' % ('-' if rate < 0 else '+', utils.sizeof_fmt(abs(rate)))) if rate is not None else '-',
+        ))
+        slowest.append((average(durations), section, name))
+        # the most recent run, compared with the previous ones
+        warnings += find_deviations(database, [HistoricalJob(section, name, *history[0])])
+    if len(rows) > 1:
+        lines.append(format_table(rows))
+        lines.append('')
+        lines.append('Slowest jobs (average duration):')
+        for mean, section, name in sorted(slowest, reverse=True)[:top]:
+            lines.append('  %8.1fs  %s: %s' % (mean, section, name))
+    if warnings:
+        lines.append('')
+        lines.append('Deviations from the moving average (last run):')
+        lines += ['  ' + warning for warning in warnings]
+    return '\n'.join(lines)
+
+
+class HistoricalJob(object):
+    """
+    The most recent run of a job, as read from the database, compared by find_deviations()
+    """
+
+    def __init__(self, section, name, started, duration, output_bytes):
+        self.section = section
+        self.name = name
+        self.status = 'ok'
+        self.started = started
+        self.duration = duration
+        self.output_bytes = output_bytes
+
+
+def show_stats(days):
+    filepath = get_database_filepath()
+    if not os.path.exists(filepath):
+        raise Exception('No run history found ("%s")' % filepath)
+    database = StatsDatabase(filepath)
+    try:
+        print(format_stats(database, days))
+    finally:
+        database.close()
@@ -0,0 +1,142 @@
+"""
+Throttling.
+
+- cpu_nice and io_priority (from the "general" section) are applied to the easy_backup
+  process itself at startup, hence are inherited by all jobs and all the commands they run
+- max_write_mb_per_s (from the job's section, or from the "general" section) limits
+  the rate at which each job writes into the target folder: in-process writers use a
+  RateLimiter, while shell pipelines get an additional stage (see main())
+  which copies stdin to stdout at the given rate
+"""
+import os
+import sys
+import time
+import logging
+import threading
+
+from .configuration import get_config
+from .args import get_args
+from . import utils
+from . import process
+
+logger = logging.getLogger("easy_backup")
+
+READ_SIZE = 1024 * 1024
+
+# ionice scheduling classes
+IO_CLASSES = {
+    'best-effort': 2,
+    'idle': 3,
+}
+
+
+class RateLimiter(object):
+    """
+    Token bucket: consume(n) blocks as needed so that, on average, no more than
+    rate bytes per second are consumed; bursts are limited to one second of data
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_max_write_rate(section):
+    """
+    Returns the write rate limit for section in bytes per second, or 0 (no limit)
+    """
+    config = get_config()
+    value = config.get_item(section, 'max_write_mb_per_s', default=config.get_item('general', 'max_write_mb_per_s', default=''))
+    try:
+        rate = float(value) if value else 0
+    except ValueError:
+        raise Exception('Invalid "max_write_mb_per_s" value "%s" in section "%s"' % (value, section))
+    return int(rate * 1024 * 1024)
+
+
+def get_rate_limiter(section):
+    """
+    Returns a RateLimiter for in-process writers, or None when not required
+    """
+    rate = get_max_write_rate(section)
+    return RateLimiter(rate) if rate > 0 else None
+
+
+def limit_command(section):
+    """
+    Returns the command (a list of arguments) to be appended to a pipeline
+    ("... | <command> > target") to limit its write rate, or None when not required
+    """
+    rate = get_max_write_rate(section)
+    if rate <= 0:
+        return None
+    return [sys.executable, '-c', 'from easy_backup.throttle import main; main()', rate]
+
+
+def parse_io_priority(value):
+    """
+    "idle", "best-effort" or "best-effort:N" (N = 0 (highest) to 7 (lowest));
+    returns the ionice arguments
+    """
+    io_class, _, level = value.lower().partition(':')
+    if io_class not in IO_CLASSES or (level and (io_class != 'best-effort' or level not in '01234567')):
+        raise Exception('Invalid "io_priority" value "%s"; valid values are: idle, best-effort, best-effort:0 .. best-effort:7' % value)
+    arguments = ['-c', str(IO_CLASSES[io_class]), ]
+    if level:
+        arguments += ['-n', level]
+    return arguments
+
+
+def apply_process_priority():
+    """
+    Apply cpu_nice and io_priority to the current process; this must be done
+    before starting any thread, so that all threads and child processes inherit them
+    """
+    config = get_config()
+
+    nice = config.get_item('general', 'cpu_nice')
+    if nice:
+        logger.info('CPU nice: %s' % nice)
+        if not get_args().dry_run:
+            os.nice(int(nice))
+
+    io_priority = config.get_item('general', 'io_priority')
+    if io_priority:
+        arguments = parse_io_priority(io_priority)
+        logger.info('I/O priority: %s' % io_priority)
+        if not utils.find_executable('ionice'):
+            logger.warning('"ionice" not found; "io_priority" ignored')
+        else:
+            process.run([['ionice', ] + arguments + ['-p', os.getpid()], ])
+
+
+def main():
+    """
+    Copy stdin to stdout, at no more than sys.argv[1] bytes per second
+    """
+    limiter = RateLimiter(int(sys.argv[1]))
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    while True:
+        data = os.read(stdin.fileno(), READ_SIZE)
+        if not data:
+            break
+        limiter.consume(len(data))
+        stdout.write(data)
+    stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,19 +5,42 @@ import logging
 import datetime
 import time
 import socket
+import shutil
 import platform
 import traceback
-from .args import get_args
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
 from .configuration import get_config
 
 logger = logging.getLogger("easy_backup")
 
 ERRORS_LIST = []
+# failures of maintenance jobs (es: vacuum), reported separately
+MAINTENANCE_ERRORS_LIST = []
 
 
-def run_command(command, force=False, fail_silently=True):
+class MaintenanceError(Exception):
+    """
+    Failure of a maintenance job: collected in MAINTENANCE_ERRORS_LIST instead of ERRORS_LIST
+    """
+    pass
+
+
+def run_command(command, force=False, fail_silently=True, timeout=None):
+    """
+    Run a command line with the shell (see process.run()); unless fail_silently
+    is False, failures are collected in ERRORS_LIST
+    """
+    # imported here, since process depends on this module
+    from . import process
     try:
-        do_run_command(command, force=force)
+        process.run(process.shell(command), timeout=timeout, force=force, label=command)
     except Exception as e:
         if fail_silently:
             ERRORS_LIST.append({
@@ -29,20 +52,23 @@ def run_command(command, force=False, fail_silently=True):
     return
 
 
-def do_run_command(command, force=False):
-    #interactive = not args.quiet
-    if get_args().dry_run and not force:
-        sys.stderr.write("\x1b[1;37;40m" + command + "\x1b[0m\n")
-    else:
-        # if interactive and not query_yes_no("Proceed ?"):
-        #     raise Exception("Interrupted by user")
-        logger.debug('Run command: "' + command + '"')
-        rc = os.system(command)
-        if rc != 0:
-            message = 'COMMAND FAILED: "' + command + '"'
-            logger.error(message)
-            raise Exception(message)
-    return
+def shell_arguments(command):
+    """
+    Arguments to run command with the shell; bash is preferred, since with
+    "pipefail" a pipeline fails when any of its stages fails (es: "pg_dump db | gzip"),
+    and not only when the last one does
+    """
+    shell = find_executable('bash')
+    if shell:
+        return [shell, '-o', 'pipefail', '-c', command]
+    return ['/bin/sh', '-c', command]
+
+
+def command_line(arguments):
+    """
+    Join a list of arguments into a command string suitable for the shell
+    """
+    return ' '.join([quote(str(argument)) for argument in arguments])
 
 
 def setup_logger(logger, verbosity):
@@ -77,16 +103,18 @@ def get_version():
 
 
 def mount(fail_silently):
+    from .process import get_timeout
     command = get_config().get_item('general', 'mount_command')
     if command:
-        return run_command(command, force=True, fail_silently=fail_silently)
+        return run_command(command, force=True, fail_silently=fail_silently, timeout=get_timeout('general'))
     return True
 
 
 def umount(fail_silently):
+    from .process import get_timeout
     command = get_config().get_item('general', 'umount_command')
     if command:
-        return run_command(command, force=True, fail_silently=fail_silently)
+        return run_command(command, force=True, fail_silently=fail_silently, timeout=get_timeout('general'))
     return True
 
 
@@ -113,7 +141,11 @@ def timestamp_to_string(timestamp):
 def assure_path_exists(path):
     if not os.path.isdir(path):
         logger.info('Creating path "%s"' % path)
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # might have been created in the meantime by a concurrent job
+            pass
         if not os.path.isdir(path):
             logger.error('Unable to create path "%s"' % path)
             return False
@@ -136,16 +168,107 @@ def get_target_folder(include_target_subfolder):
     return folder
 
 
-def output_filepath(target_folder, timestamp, filename):
+def output_filepath(target_folder, timestamp, filename, compressor=None, archive=False):
     """
     Returns <target_folder>/TIMESTAMP__filename
+
+    When a compressor is given, the matching file extension is appended
+    (for example: ".gz" or ".zst"; ".tgz" or ".tar.zst" for archives)
     """
+    if compressor is not None:
+        filename += compressor.archive_extension if archive else compressor.extension
     return os.path.join(
         target_folder,
         '%s__%s' % (timestamp_to_string(timestamp), filename),
     )
 
 
+def get_backup_folders():
+    """
+    Returns the list of folders which may contain backup files
+    """
+    config = get_config()
+    target_root = get_target_folder(include_target_subfolder=False)
+    folders = [get_target_folder(include_target_subfolder=True), ]
+    if config.has_section('rotation'):
+        for item in ['daily', 'weekly', 'monthly', 'yearly', ]:
+            subfolder = config.get_item('rotation', item)
+            if subfolder:
+                folder = os.path.join(target_root, subfolder)
+                if folder not in folders:
+                    folders.append(folder)
+    return folders
+
+
+def find_backup_file(filename):
+    """
+    Search the given file in all backup folders (it might have been rotated);
+    returns the full path, or None if not found
+    """
+    for folder in get_backup_folders():
+        filepath = os.path.join(folder, filename)
+        if os.path.exists(filepath):
+            return filepath
+    return None
+
+
+def get_path_size(path):
+    """
+    Returns the size of a file, or the total size of the files contained in a folder
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total_size = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            total_size += os.path.getsize(os.path.join(root, filename))
+    return total_size
+
+
+def remove_path(path):
+    """
+    Remove a file or a folder, if it exists
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def fsync_path(path):
+    """
+    Flush a file, or all files and folders of a tree, to disk
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                fsync_path(os.path.join(root, filename))
+            fsync_folder(root)
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_folder(folder):
+    """
+    Flush a folder to disk, so that renames and removals of its entries are durable
+    """
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # not supported on some platforms and file systems
+        pass
+    finally:
+        os.close(fd)
+
+
 def sizeof_fmt(num, suffix='B'):
     """Readable file size
     :param num: Bytes value
@@ -161,21 +284,42 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+def parse_size(value):
+    """
+    Parse a size with an optional unit suffix (k, M, G, T; powers of 1024), es: "500G";
+    returns bytes
+    """
+    text = value.strip().upper().rstrip('B')
+    multiplier = 1
+    for i, unit in enumerate(['K', 'M', 'G', 'T', 'P']):
+        if text.endswith(unit):
+            multiplier = 1024 ** (i + 1)
+            text = text[:-1].strip()
+            break
+    try:
+        return int(float(text) * multiplier)
+    except ValueError:
+        raise Exception('Invalid size "%s"' % value)
+
+
 def dump_backup_files(target_folder, daily, weekly, monthly, yearly, quarantine):
+    # imported here, since verify depends on this module
+    from .verify import list_backup_files
 
     def list_files(root, file_prefix, buffer):
         """
-        - list files in "root" folder
+        - list backup files in "root" folder (skipping folder manifests, sidecars,
+          temporary and partial files)
         - appand the sorted list of files into buffer[]
         - returns (num_files, total_size_in_bytes)
         """
-        files = sorted(os.listdir(root))
+        files = list_backup_files(root)
         n = len(files)
         total_size_in_bytes = 0
         for i, file in enumerate(files):
             #prefix = file_prefix + ("├── " if (i < n - 1) else "└── ")
             prefix = file_prefix + "+-- "
-            file_size = os.path.getsize(os.path.join(root, file))
+            file_size = get_path_size(os.path.join(root, file))
             total_size_in_bytes += file_size
             line = "%s%s (%s)" % (prefix, file, sizeof_fmt(file_size))
             buffer.append(line)
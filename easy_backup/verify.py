@@ -0,0 +1,370 @@
+"""
+Integrity verification of new backup files.
+
+Each file is read only once: while computing its sha256, the stream is
+decompressed (gzip in-process, zstd with an external process) and, for archives,
+the tar index is read to the end. PostgreSQL custom-format dumps are also
+checked with "pg_restore --list", which only reads the table of contents;
+chunk store manifests are checked against the chunk store.
+
+On success, the checksum is saved in a sidecar file (es: "2018-03-01_01-00-00__etc.tgz.sha256"),
+in the format used by "sha256sum", which is kept together with its backup file
+during rotation.
+
+"easy_backup verify" checks historical backups against the folder manifests
+(see manifest.py): files are hashed by a pool of workers, and, in quick mode,
+files whose size and mtime are unchanged since the last verification are skipped.
+"""
+import os
+import sys
+import json
+import zlib
+import datetime
+import hashlib
+import logging
+import tarfile
+import threading
+
+from .args import get_args
+from .configuration import get_config
+from .scheduler import Scheduler
+from .manifest import Manifests, MANIFEST_FILENAME, hash_path, stat_path
+from .journal import PARTIAL_EXTENSION
+from .process import Pipeline, ProcessError, PIPE, get_timeout, check_result
+from . import process
+from . import utils
+from .utils import ERRORS_LIST
+
+logger = logging.getLogger("easy_backup")
+
+READ_SIZE = 1024 * 1024
+SIDECAR_EXTENSION = '.sha256'
+
+
+class VerificationError(Exception):
+    pass
+
+
+class HashingReader(object):
+    """
+    Read a file, updating the sha256 and counting bytes
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size if size > 0 else READ_SIZE)
+        self.digest.update(data)
+        self.size += len(data)
+        return data
+
+
+class GzipReader(object):
+    """
+    Decompress a gzip stream (possibly made of several members, as produced by pigz
+    or by concatenating files); a truncated stream raises VerificationError
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = b''
+        self.eof = False
+        self.started = False
+
+    def fill(self, size):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.raw.read(READ_SIZE)
+            if not data:
+                if self.started and not self.decompressor.eof:
+                    raise VerificationError('truncated gzip stream')
+                self.eof = True
+                break
+            while data:
+                if self.decompressor.eof:
+                    # next member; trailing zeros are tolerated, as gzip does
+                    if not data.strip(b'\0'):
+                        break
+                    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.started = True
+                try:
+                    self.buffer += self.decompressor.decompress(data)
+                except zlib.error as e:
+                    raise VerificationError('invalid gzip stream: %s' % str(e))
+                data = self.decompressor.unused_data if self.decompressor.eof else b''
+
+    def read(self, size=-1):
+        self.fill(size if size > 0 else READ_SIZE)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class ProcessReader(object):
+    """
+    Decompress with an external program (see process.Pipeline, within the "verify" timeout):
+    raw data is fed to its stdin by a separate thread, and the decompressed stream
+    is read from its stdout
+    """
+
+    def __init__(self, raw, command):
+        self.raw = raw
+        self.pipeline = Pipeline([command, ], timeout=get_timeout('verify')).start(stdin=PIPE, stdout=PIPE)
+        self.error = None
+        self.thread = threading.Thread(target=self.feed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self):
+        try:
+            while True:
+                data = self.raw.read(READ_SIZE)
+                if not data:
+                    break
+                self.pipeline.stdin.write(data)
+        except Exception as e:
+            # a broken pipe means the decompressor failed; reported by close()
+            self.error = e
+        finally:
+            try:
+                self.pipeline.stdin.close()
+            except Exception:
+                pass
+
+    def read(self, size=-1):
+        return self.pipeline.stdout.read(size if size > 0 else READ_SIZE)
+
+    def close(self):
+        # drain, so that the feeder thread can complete
+        while self.pipeline.stdout.read(READ_SIZE):
+            pass
+        self.thread.join()
+        result = check_result(self.pipeline.wait(), False)
+        if not result.ok:
+            raise VerificationError(str(ProcessError(result)))
+        if self.error is not None:
+            raise self.error
+
+
+def drain(stream):
+    while stream.read(READ_SIZE):
+        pass
+
+
+def check_tar(stream):
+    """
+    Read the tar index (and data) to the end; returns the number of members
+    """
+    members = 0
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            for member in archive:
+                members += 1
+    except tarfile.TarError as e:
+        raise VerificationError('invalid tar archive: %s' % str(e))
+    drain(stream)
+    return members
+
+
+def check_pg_restore(filepath):
+    """
+    List the contents of a PostgreSQL custom or directory format dump
+    """
+    if not utils.find_executable('pg_restore'):
+        logger.debug('"pg_restore" not found; skipping table of contents check')
+        return
+    result = process.run([['pg_restore', '--list', filepath], ], output=os.devnull, timeout=get_timeout('verify'), check=False)
+    if result is not None and not result.ok:
+        raise VerificationError(str(ProcessError(result)))
+
+
+def check_manifest(filepath):
+    """
+    Check that all chunks listed in a chunk store manifest are available
+    """
+    from .chunkstore import ChunkStore, get_chunk_store_folder
+    with open(filepath) as f:
+        try:
+            manifest = json.load(f)
+        except ValueError as e:
+            raise VerificationError('invalid manifest: %s' % str(e))
+    store = ChunkStore(get_chunk_store_folder())
+    missing = [chunk_id for chunk_id, size in manifest['chunks'] if not os.path.exists(store.chunk_path(chunk_id))]
+    if missing:
+        raise VerificationError('%d missing chunks (es: %s)' % (len(missing), missing[0]))
+
+
+def verify_stream(filepath, reader):
+    """
+    Verify the contents of filepath, according to its extension
+    """
+    filename = os.path.basename(filepath)
+    if filename.endswith('.tgz') or filename.endswith('.tar.gz'):
+        check_tar(GzipReader(reader))
+    elif filename.endswith('.tar.zst'):
+        stream = ProcessReader(reader, ['zstd', '-d', '-c', '-q'])
+        try:
+            check_tar(stream)
+        finally:
+            stream.close()
+    elif filename.endswith('.gz'):
+        drain(GzipReader(reader))
+    elif filename.endswith('.zst'):
+        stream = ProcessReader(reader, ['zstd', '-t', '-q'])
+        stream.close()
+    elif filename.endswith('.dump'):
+        if reader.read(5) != b'PGDMP':
+            raise VerificationError('not a PostgreSQL custom format dump')
+        drain(reader)
+        check_pg_restore(filepath)
+    else:
+        drain(reader)
+        if filename.endswith('.chunks'):
+            check_manifest(filepath)
+
+
+def sidecar_path(filepath):
+    return filepath + SIDECAR_EXTENSION
+
+
+def write_sidecar(filepath, checksum):
+    sidecar = sidecar_path(filepath)
+    tmp_file = sidecar + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write('%s  %s\n' % (checksum, os.path.basename(filepath)))
+    os.rename(tmp_file, sidecar)
+
+
+def copy_sidecar(source, target):
+    """
+    Write the sidecar file of target with the checksum of source (es: when linking
+    an unchanged backup), if available
+    """
+    try:
+        with open(sidecar_path(source)) as f:
+            checksum = f.read().split()[0]
+    except (IOError, OSError, IndexError):
+        return
+    write_sidecar(target, checksum)
+
+
+def verify_backup(filepath):
+    """
+    Verify a new backup file, and save its checksum in the sidecar file
+    """
+    if get_args().dry_run:
+        sys.stderr.write("\x1b[1;37;40m" + 'Verifying "%s"' % filepath + "\x1b[0m\n")
+        return
+    logger.info('Verifying "%s"' % os.path.basename(filepath))
+    try:
+        if os.path.isdir(filepath):
+            # PostgreSQL directory format
+            check_pg_restore(filepath)
+            return
+        with open(filepath, 'rb') as f:
+            reader = HashingReader(f)
+            verify_stream(filepath, reader)
+    except VerificationError as e:
+        raise Exception('VERIFICATION FAILED: "%s": %s' % (filepath, str(e)))
+    checksum = reader.digest.hexdigest()
+    write_sidecar(filepath, checksum)
+    logger.debug('sha256 %s  %s (%s)' % (checksum, os.path.basename(filepath), utils.sizeof_fmt(reader.size)))
+
+
+def read_sidecar(filepath):
+    """
+    Returns the checksum saved in the sidecar file of filepath, if any
+    """
+    try:
+        with open(sidecar_path(filepath)) as f:
+            return f.read().split()[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+def check_manifest_entry(manifest, filename, quick):
+    """
+    Hash a backup file and compare it with its manifest entry; new files are added
+    to the manifest, after checking the sidecar checksum when available.
+    Returns "added", "verified" or "skipped"
+    """
+    filepath = os.path.join(manifest.folder, filename)
+    size, mtime = stat_path(filepath)
+    entry = manifest.get(filename)
+    if quick and entry is not None and entry['size'] == size and entry['mtime'] == mtime:
+        return 'skipped'
+
+    algorithms = set([manifest.algorithm, ])
+    expected_sha256 = read_sidecar(filepath) if entry is None else None
+    if expected_sha256 is not None:
+        algorithms.add('sha256')
+    digests = hash_path(filepath, algorithms)
+
+    if entry is None:
+        if expected_sha256 is not None and digests['sha256'] != expected_sha256:
+            raise Exception('VERIFICATION FAILED: "%s": sha256 differs from "%s"' % (
+                filepath, os.path.basename(sidecar_path(filepath))))
+        result = 'added'
+    else:
+        if digests[manifest.algorithm] != entry['hash']:
+            raise Exception('VERIFICATION FAILED: "%s": %s differs from the manifest (last verified: %s)' % (
+                filepath, manifest.algorithm, utils.timestamp_to_string(datetime.datetime.fromtimestamp(entry['verified']))))
+        result = 'verified'
+    manifest.update(filename, size, mtime, digests[manifest.algorithm])
+    logger.debug('%s: "%s" (%s)' % (result, filepath, utils.sizeof_fmt(size)))
+    return result
+
+
+def list_backup_files(folder):
+    """
+    Backup files in folder, skipping manifests, sidecars, temporary and partial files
+    """
+    filenames = os.listdir(folder)
+    listed = set(filenames)
+    return sorted([
+        filename for filename in filenames
+        if not filename.startswith('.') and
+        not filename.endswith('.tmp') and
+        not filename.endswith(PARTIAL_EXTENSION) and
+        not (filename.endswith(SIDECAR_EXTENSION) and filename[:-len(SIDECAR_EXTENSION)] in listed)
+    ])
+
+
+def verify_backup_folders(quick=False):
+    """
+    Check all files in the backup folders against the folder manifests, using
+    "max_workers" (from the "verify" section) parallel workers;
+    failures are collected in ERRORS_LIST
+    """
+    manifests = Manifests()
+    scheduler = Scheduler(max_workers=get_config().get_item_as_int('verify', 'max_workers', 1))
+    jobs = []
+    for folder in utils.get_backup_folders():
+        if not os.path.isdir(folder):
+            continue
+        manifest = manifests.get(folder)
+        filenames = list_backup_files(folder)
+        for filename in set(manifest.entries.keys()) - set(filenames):
+            message = 'Missing file "%s" (listed in "%s")' % (filename, os.path.join(folder, MANIFEST_FILENAME))
+            logger.error(message)
+            ERRORS_LIST.append({'message': message, 'traceback': ''})
+            manifest.pop(filename)
+        logger.info('Verifying %d file(s) in "%s"%s' % (len(filenames), folder, ' (quick)' if quick else ''))
+        for filename in filenames:
+            jobs.append(scheduler.submit('verify', filename, check_manifest_entry, manifest, filename, quick))
+    scheduler.run()
+
+    results = {}
+    for job in jobs:
+        results[job.result or 'failed'] = results.get(job.result or 'failed', 0) + 1
+    logger.info('Verification completed: %s' % ', '.join(
+        ['%d %s' % (results.get(key, 0), key) for key in ['verified', 'added', 'skipped', 'failed', ]]))
+
+    if get_args().dry_run:
+        sys.stderr.write("\x1b[1;37;40m" + 'Manifests not updated (dry run)' + "\x1b[0m\n")
+    else:
+        manifests.save()
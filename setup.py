@@ -22,8 +22,13 @@ setup(name='easy_backup',
       classifiers=[
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Database :: Database Engines/Servers',
       ],
       keywords='backup database',
@@ -33,6 +38,7 @@ setup(name='easy_backup',
       license='MIT',
       scripts=['bin/easy_backup'],
       packages=['easy_backup'],
+      python_requires='>=3.7',
       # install_requires=[
       #     'markdown',
       # ],
@@ -0,0 +1,50 @@
+"""
+Helpers shared by the tests: easy_backup setup with local stand-ins
+(a temporary target folder, no mount command, no database server).
+"""
+import argparse
+
+from easy_backup.args import set_args
+from easy_backup.configuration import get_config
+
+BASE_CONFIG = """
+[general]
+mount_command=
+umount_command=
+target_root=%(target_root)s
+target_subfolder=daily
+max_workers=1
+skip_unchanged=False
+check_free_space=False
+stats=False
+
+[data_folders]
+enabled=False
+
+[postgresql]
+enabled=False
+
+[mysql]
+enabled=False
+
+[verify]
+enabled=False
+
+[rotation]
+enabled=False
+"""
+
+
+def configure(target_root='/nonexistent', dry_run=False):
+    """
+    Replace the global configuration (and arguments) of easy_backup;
+    further items can be added with config.set()
+    """
+    set_args(argparse.Namespace(dry_run=dry_run, verbosity=0, command='backup'))
+    config = get_config()
+    for section in config.sections():
+        config.remove_section(section)
+    config.read_string(BASE_CONFIG % {
+        'target_root': target_root,
+    })
+    return config
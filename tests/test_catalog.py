@@ -0,0 +1,188 @@
+import unittest
+from unittest import mock
+
+from easy_backup import catalog
+from easy_backup.process import ProcessError
+
+from .common import configure
+
+
+def fingerprint_row(track_counts='on', changes='42', stats_reset='2018-03-01 00:00:00+00',
+                    relfilenodes='a' * 32, sequences='b' * 32):
+    return [track_counts, changes, stats_reset, '2018-03-01 00:00:00+00', relfilenodes, sequences, 'c' * 32, 'd' * 32, ]
+
+
+class PostgresqlFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def fingerprint(self, row):
+        with mock.patch.object(catalog, 'query_postgresql', return_value=[row, ]) as query:
+            fingerprint = catalog.postgresql_fingerprint('demo')
+        query.assert_called_once_with(catalog.POSTGRESQL_FINGERPRINT_QUERY, len(row), database='demo')
+        return fingerprint
+
+    def test_unchanged(self):
+        self.assertIsNotNone(self.fingerprint(fingerprint_row()))
+        self.assertEqual(self.fingerprint(fingerprint_row()), self.fingerprint(fingerprint_row()))
+
+    def test_truncate(self):
+        # TRUNCATE doesn't update the counters, but assigns a new relfilenode
+        before = self.fingerprint(fingerprint_row())
+        after = self.fingerprint(fingerprint_row(relfilenodes='e' * 32))
+        self.assertNotEqual(before, after)
+
+    def test_sequences(self):
+        before = self.fingerprint(fingerprint_row())
+        after = self.fingerprint(fingerprint_row(sequences='e' * 32))
+        self.assertNotEqual(before, after)
+
+    def test_stats_reset(self):
+        before = self.fingerprint(fingerprint_row())
+        after = self.fingerprint(fingerprint_row(changes='0', stats_reset='2018-03-02 00:00:00+00'))
+        self.assertNotEqual(before, after)
+
+    def test_track_counts_off(self):
+        self.assertIsNone(self.fingerprint(fingerprint_row(track_counts='off')))
+
+    def test_counters_lost(self):
+        self.assertIsNone(self.fingerprint(fingerprint_row(changes='0', stats_reset='')))
+
+    def test_query(self):
+        query = catalog.POSTGRESQL_FINGERPRINT_QUERY
+        self.assertIn("current_setting('track_counts')", query)
+        self.assertIn('relfilenode', query)
+        self.assertIn('pg_sequences', query)
+
+
+def databases(items):
+    return [(database.name, database.size, database.last_modified, database.changes) for database in items]
+
+
+class PostgresqlQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        configure().set('postgresql', 'root_user', 'postgres')
+
+    def query(self, output, columns, database=None):
+        with mock.patch.object(catalog, 'run_query', return_value=output) as run_query:
+            rows = catalog.query_postgresql('SELECT 1', columns, database=database)
+        return rows, run_query.call_args[0]
+
+    def test_command(self):
+        rows, (command, section) = self.query('1\x00', 1, database='my db')
+        self.assertEqual(section, 'postgresql')
+        self.assertEqual(command[:4], ['sudo', '-u', 'postgres', 'psql', ])
+        # zero bytes as field and record separators
+        self.assertIn('-z', command)
+        self.assertIn('-0', command)
+        self.assertEqual(command[-4:], ['-d', 'my db', '-c', 'SELECT 1', ])
+
+    def test_parse(self):
+        cases = [
+            ('', 2, []),
+            ('a\x00001\x00', 2, [['a', '001', ], ]),
+            # records are terminated by zero bytes too
+            ('a\x00001\x00b\x00002\x00', 2, [['a', '001', ], ['b', '002', ], ]),
+            # spaces, tabs, newlines and separator-like text within values
+            ('my db\x00a|b\x00new\nline\x00\ttab \x00', 2, [['my db', 'a|b', ], ['new\nline', '\ttab ', ], ]),
+            # empty values
+            ('\x00\x00x\x00\x00', 2, [['', '', ], ['x', '', ], ]),
+        ]
+        for output, columns, expected in cases:
+            with self.subTest(output=output):
+                self.assertEqual(self.query(output, columns)[0], expected)
+
+    def test_column_count(self):
+        for output in ['a\x00b\x00c\x00', 'a\x00']:
+            with self.subTest(output=output):
+                with self.assertRaises(Exception) as context:
+                    self.query(output, 2)
+                self.assertIn('Unexpected query output', str(context.exception))
+
+    def test_list_databases(self):
+        output = 'demo\x001024\x0012\x00my db\x002048\x000\x00new\nline\x004096\x003\x00'
+        with mock.patch.object(catalog, 'run_query', return_value=output):
+            items = catalog.list_postgresql_databases()
+        self.assertEqual(databases(items), [
+            ('demo', 1024, None, 12),
+            ('my db', 2048, None, 0),
+            ('new\nline', 4096, None, 3),
+        ])
+
+    def test_no_databases(self):
+        with mock.patch.object(catalog, 'run_query', return_value=''):
+            self.assertEqual(catalog.list_postgresql_databases(), [])
+
+
+class MysqlQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        config = configure()
+        config.set('mysql', 'root_user', 'root')
+        config.set('mysql', 'root_password', 'secret')
+
+    def test_unescape(self):
+        cases = [
+            ('plain', 'plain'),
+            ('NULL', None),
+            ('null', 'null'),
+            ('a\\tb', 'a\tb'),
+            ('a\\nb', 'a\nb'),
+            ('a\\\\b', 'a\\b'),
+            ('\\0\\b\\r', '\0\b\r'),
+            # unknown escapes stand for the character itself
+            ('\\x', 'x'),
+            # trailing backslash
+            ('a\\', 'a\\'),
+        ]
+        for value, expected in cases:
+            with self.subTest(value=value):
+                self.assertEqual(catalog.mysql_unescape(value), expected)
+
+    def test_query(self):
+        output = 'a\\tb\t1\tNULL\nmy db\t2\t2018-03-01 00:00:00\n'
+        with mock.patch.object(catalog, 'run_query', return_value=output) as run_query:
+            rows = catalog.query_mysql('SELECT 1')
+        command, section = run_query.call_args[0]
+        self.assertEqual(section, 'mysql')
+        self.assertEqual(command[0], 'mysql')
+        self.assertIn('--password=secret', command)
+        self.assertEqual(command[-4:], ['-N', '-B', '-e', 'SELECT 1', ])
+        self.assertEqual(rows, [['a\tb', '1', None, ], ['my db', '2', '2018-03-01 00:00:00', ], ])
+
+    def test_list_databases(self):
+        output = 'demo\t1024\t2018-03-01 00:00:00\nempty\t0\tNULL\nnew\\nline\t4096\tNULL\n'
+        with mock.patch.object(catalog, 'run_query', return_value=output):
+            items = catalog.list_mysql_databases()
+        self.assertEqual(databases(items), [
+            ('demo', 1024, '2018-03-01 00:00:00', None),
+            ('empty', 0, None, None),
+            ('new\nline', 4096, None, None),
+        ])
+
+
+class RunQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = configure(dry_run=True)
+
+    def test_output(self):
+        # queries are run in dry-run mode too
+        self.assertEqual(catalog.run_query(['printf', 'demo\\0'], 'postgresql'), 'demo\0')
+
+    def test_failure(self):
+        with self.assertRaises(ProcessError) as context:
+            catalog.run_query(['sh', '-c', 'echo "no such database" >&2; exit 2'], 'postgresql')
+        self.assertIn('no such database', str(context.exception))
+
+    def test_timeout(self):
+        self.config.set('mysql', 'timeout', '0.2')
+        with self.assertRaises(ProcessError) as context:
+            catalog.run_query(['sleep', '30'], 'mysql')
+        self.assertTrue(context.exception.result.timed_out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import io
+import os
+import zlib
+import random
+import tempfile
+import unittest
+
+from easy_backup.chunkstore import ChunkStore, Chunker
+
+from .common import configure
+
+
+def make_data(seed, lines=2000):
+    rnd = random.Random(seed)
+    return b''.join(('%d,%s\n' % (i, ' '.join(str(rnd.randint(0, 10 ** 6)) for j in range(8)))).encode('ascii')
+                    for i in range(lines))
+
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manifests = os.path.join(self.tmp.name, 'daily')
+        os.makedirs(self.manifests)
+        self.store = ChunkStore(os.path.join(self.tmp.name, 'chunks'), min_size=1024, avg_size=4096, max_size=16384)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def manifest_file(self, name):
+        return os.path.join(self.manifests, '2018-03-01_00-00-00__%s.chunks' % name)
+
+    def store_data(self, name, data):
+        return self.store.store_stream(io.BytesIO(data), self.manifest_file(name), name)
+
+    def restore_data(self, name):
+        output = io.BytesIO()
+        self.store.restore(self.manifest_file(name), output)
+        return output.getvalue()
+
+    def chunk_files(self):
+        return sorted(filename for folder, subfolders, filenames in os.walk(self.store.folder) for filename in filenames)
+
+    def test_round_trip(self):
+        data = make_data(0) + b'no final newline'
+        manifest = self.store_data('demo', data)
+        self.assertGreater(len(manifest['chunks']), 1)
+        self.assertEqual(manifest['size'], len(data))
+        self.assertEqual(self.restore_data('demo'), data)
+
+    def test_empty(self):
+        self.store_data('empty', b'')
+        self.assertEqual(self.restore_data('empty'), b'')
+
+    def test_deduplication(self):
+        data = make_data(0)
+        first = self.store_data('first', data)
+        chunks = self.chunk_files()
+        # an insertion changes the chunks around it only
+        second = self.store_data('second', data[:len(data) // 2] + b'inserted line\n' + data[len(data) // 2:])
+        self.assertEqual(self.restore_data('first'), data)
+        new_chunks = set(self.chunk_files()) - set(chunks)
+        self.assertLess(len(new_chunks), len(second['chunks']))
+        self.assertLessEqual(len(new_chunks), 3)
+        self.assertTrue(set(chunk_id for chunk_id, size in first['chunks']) <= set(self.chunk_files()))
+
+    def test_garbage_collection(self):
+        shared = make_data(0)
+        kept = self.store_data('kept', shared)
+        removed = self.store_data('removed', shared + make_data(1))
+        os.unlink(self.manifest_file('removed'))
+        self.store.collect_garbage([self.manifests, ], False)
+        # chunks still referenced by another manifest are kept
+        kept_chunks = set(chunk_id for chunk_id, size in kept['chunks'])
+        removed_chunks = set(chunk_id for chunk_id, size in removed['chunks'])
+        self.assertTrue(kept_chunks & removed_chunks)
+        self.assertEqual(set(self.chunk_files()), kept_chunks)
+        self.assertEqual(self.restore_data('kept'), shared)
+
+    def test_garbage_collection_dry_run(self):
+        self.store_data('removed', make_data(0))
+        chunks = self.chunk_files()
+        os.unlink(self.manifest_file('removed'))
+        self.store.collect_garbage([self.manifests, ], True)
+        self.assertEqual(self.chunk_files(), chunks)
+
+    def test_corrupted_chunk(self):
+        manifest = self.store_data('demo', make_data(0))
+        with open(self.store.chunk_path(manifest['chunks'][0][0]), 'wb') as f:
+            f.write(zlib.compress(b'something else'))
+        with self.assertRaises(Exception):
+            self.restore_data('demo')
+
+
+class ChunkerTest(unittest.TestCase):
+
+    def test_sizes(self):
+        chunker = Chunker(1024, 4096, 16384)
+        data = make_data(0) + b'x' * 40000
+        chunks = []
+        for i in range(0, len(data), 1000):
+            chunks += chunker.feed(data[i:i + 1000])
+        chunks += chunker.finish()
+        self.assertEqual(b''.join(chunks), data)
+        self.assertTrue(all(1024 <= len(chunk) <= 16384 for chunk in chunks[:-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
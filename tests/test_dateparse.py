@@ -0,0 +1,129 @@
+import datetime
+import unittest
+
+from easy_backup.dateparse import (
+    BUILTIN_DATE_FORMATS, DEFAULT_DATE_FORMATS, FilenameDateParser, compile_date_format, get_date_parser,
+    parse_date_formats,
+)
+
+# (format, filename, expected date)
+FORMAT_CASES = [
+    ('quarantine', '2018-03-22_____2018-03-01_01-00-00__etc.tgz', datetime.date(2018, 3, 22)),
+    ('date', '2018-03-24_01.02.57_nexterbox3.media.tar.gz', datetime.date(2018, 3, 24)),
+    ('date', '2018-03-24_01-02-57__postgresql.demo.gz', datetime.date(2018, 3, 24)),
+    ('iso', '2018-03-24T01:02:57_db.sql.gz', datetime.date(2018, 3, 24)),
+    ('iso_basic', '20180324T010257_db.sql.gz', datetime.date(2018, 3, 24)),
+    ('gitlab', '1521766816_2018_03_23_10.5.6-ee_gitlab_backup.tar', datetime.date(2018, 3, 23)),
+    ('epoch', '1521766816_db.sql.gz', datetime.date.fromtimestamp(1521766816)),
+]
+
+# (filename, expected date) with the default formats
+DEFAULT_CASES = [
+    ('2018-03-22_____2018-03-01_01-00-00__etc.tgz', datetime.date(2018, 3, 22)),
+    ('2018-03-01_01-00-00__etc.tgz', datetime.date(2018, 3, 1)),
+    ('2018-03-24T01:02:57_db.sql.gz', datetime.date(2018, 3, 24)),
+    ('20180324T010257_db.sql.gz', datetime.date(2018, 3, 24)),
+    ('1521766816_2018_03_23_10.5.6-ee_gitlab_backup.tar', datetime.date(2018, 3, 23)),
+    # invalid dates
+    ('2018-02-30_01-00-00__etc.tgz', None),
+    ('2018-13-45_01-00-00__etc.tgz', None),
+    ('20180230T010257_db.sql.gz', None),
+    # not a date, or not at the beginning
+    ('etc.tgz', None),
+    ('backup_2018-03-01.tgz', None),
+    ('18-03-01_etc.tgz', None),
+    # epoch is not a default format
+    ('1521766816_db.sql.gz', None),
+]
+
+# (filename, expected date) with the epoch format: 9 or 10 digits, not followed by a digit
+EPOCH_CASES = [
+    ('100000000_db.sql.gz', datetime.date.fromtimestamp(100000000)),
+    ('999999999_db.sql.gz', datetime.date.fromtimestamp(999999999)),
+    ('1000000000_db.sql.gz', datetime.date.fromtimestamp(1000000000)),
+    ('9999999999_db.sql.gz', datetime.date.fromtimestamp(9999999999)),
+    ('99999999_db.sql.gz', None),
+    ('10000000000_db.sql.gz', None),
+    ('1521766816', datetime.date.fromtimestamp(1521766816)),
+]
+
+# (format, error message)
+INVALID_FORMATS = [
+    ('', 'valid values are a pattern or any of: date, epoch, gitlab, iso, iso_basic, quarantine'),
+    ('unknown', 'valid values are a pattern or any of'),
+    ('%Y-%m-%x', 'unknown directive "%x"'),
+    ('%Y-%m-%d_%Y', 'repeated "%Y"'),
+    ('%s_%s', 'repeated "%s"'),
+    ('%Y-%m', 'either "%s" or "%Y", "%m" and "%d" are required'),
+    ('%H-%M-%S', 'either "%s" or "%Y", "%m" and "%d" are required'),
+]
+
+
+class FilenameDateParserTest(unittest.TestCase):
+
+    def test_builtin_formats(self):
+        self.assertEqual(set([case[0] for case in FORMAT_CASES]), set(BUILTIN_DATE_FORMATS.keys()))
+        for date_format, filename, expected in FORMAT_CASES:
+            with self.subTest(date_format=date_format, filename=filename):
+                self.assertEqual(FilenameDateParser([date_format, ]).parse(filename), expected)
+
+    def test_default_formats(self):
+        parser = FilenameDateParser()
+        for filename, expected in DEFAULT_CASES:
+            with self.subTest(filename=filename):
+                self.assertEqual(parser.parse(filename), expected)
+
+    def test_epoch(self):
+        parser = FilenameDateParser(['epoch', ])
+        for filename, expected in EPOCH_CASES:
+            with self.subTest(filename=filename):
+                self.assertEqual(parser.parse(filename), expected)
+
+    def test_patterns(self):
+        parser = FilenameDateParser(['backup-%d.%m.%Y', '%*-%Y%m%d', '100%%_%Y-%m-%d', ])
+        self.assertEqual(parser.parse('backup-24.03.2018.tgz'), datetime.date(2018, 3, 24))
+        self.assertEqual(parser.parse('host-20180324.tgz'), datetime.date(2018, 3, 24))
+        self.assertEqual(parser.parse('100%_2018-03-24.tgz'), datetime.date(2018, 3, 24))
+        # "." is not a wildcard
+        self.assertIsNone(parser.parse('backup-24x03x2018.tgz'))
+
+    def test_fallback(self):
+        # an invalid date matched by a format does not prevent the next ones from matching
+        parser = FilenameDateParser(['%*_%Y-%m-%d', 'date', ])
+        self.assertEqual(parser.parse('2018-03-24_2018-02-30.tgz'), datetime.date(2018, 3, 24))
+        self.assertEqual(parser.parse('host_2018-02-28.tgz'), datetime.date(2018, 2, 28))
+
+    def test_cache(self):
+        parser = FilenameDateParser()
+        self.assertIsNone(parser.parse('etc.tgz'))
+        self.assertEqual(parser.parse('2018-03-01_etc.tgz'), datetime.date(2018, 3, 1))
+        self.assertEqual(parser.cache, {'etc.tgz': None, '2018-03-01_etc.tgz': datetime.date(2018, 3, 1), })
+
+
+class CompileDateFormatTest(unittest.TestCase):
+
+    def test_invalid(self):
+        for date_format, message in INVALID_FORMATS:
+            with self.subTest(date_format=date_format):
+                with self.assertRaises(Exception) as context:
+                    compile_date_format(date_format)
+                self.assertIn(message, str(context.exception))
+
+    def test_parser(self):
+        with self.assertRaises(Exception):
+            FilenameDateParser(['date', '%Y', ])
+
+    def test_get_date_parser(self):
+        self.assertIs(get_date_parser(), get_date_parser(DEFAULT_DATE_FORMATS))
+        self.assertIs(get_date_parser(['epoch', 'date', ]), get_date_parser(('epoch', 'date', )))
+        self.assertIsNot(get_date_parser(['epoch', 'date', ]), get_date_parser(['date', 'epoch', ]))
+
+    def test_parse_date_formats(self):
+        self.assertEqual(parse_date_formats('epoch, date,,%Y%m%d '), ['epoch', 'date', '%Y%m%d', ])
+        self.assertEqual(parse_date_formats(''), DEFAULT_DATE_FORMATS)
+        self.assertEqual(parse_date_formats(' , '), DEFAULT_DATE_FORMATS)
+        self.assertEqual(parse_date_formats(None), DEFAULT_DATE_FORMATS)
+
+
+if __name__ == '__main__':
+    unittest.main()
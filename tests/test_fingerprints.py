@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from easy_backup import fingerprints
+from easy_backup.fingerprints import get_fingerprint, reuse_previous_backup, save_fingerprint
+from easy_backup.journal import PARTIAL_EXTENSION
+from easy_backup.verify import write_sidecar, read_sidecar
+
+from .common import configure
+
+PREVIOUS = '2018-03-01_01-00-00__postgresql.demo.gz'
+TARGET = '2018-03-02_01-00-00__postgresql.demo.gz'
+
+
+def copy_only(source, target):
+    raise OSError('hard links not supported')
+
+
+class GetFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = configure()
+
+    def test_enabled(self):
+        cases = [
+            # general, section, enabled
+            ('False', None, False),
+            ('True', None, True),
+            ('y', None, True),
+            ('1', 'n', False),
+            ('False', 'True', True),
+        ]
+        for general, section, enabled in cases:
+            with self.subTest(general=general, section=section):
+                self.config.set('general', 'skip_unchanged', general)
+                if section is None:
+                    self.config.remove_option('postgresql', 'skip_unchanged')
+                else:
+                    self.config.set('postgresql', 'skip_unchanged', section)
+                self.assertEqual(get_fingerprint('postgresql', lambda: 'fp'), 'fp' if enabled else None)
+
+    def test_invalid(self):
+        # unknown values are rejected, instead of disabling the feature
+        self.config.set('postgresql', 'skip_unchanged', 'yes')
+        with self.assertRaises(Exception):
+            get_fingerprint('postgresql', lambda: 'fp')
+
+    def test_unavailable(self):
+        self.config.set('general', 'skip_unchanged', 'True')
+
+        def compute():
+            raise Exception('no statistics')
+
+        self.assertIsNone(get_fingerprint('postgresql', compute))
+
+
+class ReusePreviousBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        configure(self.tmp.name)
+        fingerprints.cache_singleton = None
+        self.folder = os.path.join(self.tmp.name, 'daily')
+        os.makedirs(self.folder)
+        self.target_file = os.path.join(self.folder, TARGET)
+
+    def tearDown(self):
+        fingerprints.cache_singleton = None
+        self.tmp.cleanup()
+
+    def make_previous(self, directory=False):
+        previous_file = os.path.join(self.folder, PREVIOUS)
+        if directory:
+            os.makedirs(os.path.join(previous_file, 'blobs'))
+            for filename in ['toc.dat', os.path.join('blobs', '1.dat'), ]:
+                with open(os.path.join(previous_file, filename), 'wb') as f:
+                    f.write(b'data')
+        else:
+            with open(previous_file, 'wb') as f:
+                f.write(b'data')
+            write_sidecar(previous_file, 'abc')
+        save_fingerprint('fp1', previous_file)
+        return previous_file
+
+    def test_link(self):
+        previous_file = self.make_previous()
+        self.assertTrue(reuse_previous_backup('fp1', self.target_file))
+        self.assertTrue(os.path.samefile(previous_file, self.target_file))
+        self.assertEqual(read_sidecar(self.target_file), 'abc')
+        self.assertFalse(os.path.exists(self.target_file + PARTIAL_EXTENSION))
+        # the cache refers to the new file
+        self.assertEqual(fingerprints.get_fingerprint_cache().lookup('postgresql.demo.gz', 'fp1'), TARGET)
+
+    def test_changed(self):
+        self.make_previous()
+        self.assertFalse(reuse_previous_backup('fp2', self.target_file))
+        self.assertFalse(reuse_previous_backup(None, self.target_file))
+        self.assertFalse(os.path.exists(self.target_file))
+
+    def test_copy(self):
+        self.make_previous()
+        with mock.patch('os.link', copy_only):
+            self.assertTrue(reuse_previous_backup('fp1', self.target_file))
+        with open(self.target_file, 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+        self.assertFalse(os.path.exists(self.target_file + PARTIAL_EXTENSION))
+
+    def test_directory(self):
+        self.make_previous(directory=True)
+        self.assertTrue(reuse_previous_backup('fp1', self.target_file))
+        self.assertTrue(os.path.isfile(os.path.join(self.target_file, 'blobs', '1.dat')))
+        self.assertFalse(os.path.exists(self.target_file + PARTIAL_EXTENSION))
+
+    def test_interrupted_copy(self):
+        # a failed copy never leaves a file under the final name
+        self.make_previous(directory=True)
+        copied = []
+
+        def failing_copy(source, target):
+            if copied:
+                raise IOError('No space left on device')
+            copied.append(target)
+            shutil.copyfile(source, target)
+
+        with mock.patch('os.link', copy_only), mock.patch('shutil.copy2', failing_copy):
+            with self.assertRaises(Exception):
+                reuse_previous_backup('fp1', self.target_file)
+        self.assertTrue(copied[0].startswith(self.target_file + PARTIAL_EXTENSION))
+        self.assertEqual(os.listdir(self.folder), [PREVIOUS, ])
+        self.assertEqual(fingerprints.get_fingerprint_cache().lookup('postgresql.demo.gz', 'fp1'), PREVIOUS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import sys
+import signal
+import datetime
+import tempfile
+import subprocess
+import unittest
+
+from easy_backup.scheduler import Scheduler
+from easy_backup.journal import (
+    start_journal, resume_journal, partial_output, cleanup_orphans, get_journal_filepath, PARTIAL_EXTENSION,
+)
+from easy_backup.utils import ERRORS_LIST
+from easy_backup import utils
+
+from .common import configure
+
+TIMESTAMP = datetime.datetime(2018, 3, 1, 1, 0, 0)
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_output(target_file, calls, interrupt=False):
+    calls.append(os.path.basename(target_file))
+    with partial_output(target_file) as partial_file:
+        with open(partial_file, 'wb') as f:
+            f.write(b'data')
+            f.flush()
+            if interrupt:
+                # the run is killed while writing
+                os.kill(os.getpid(), signal.SIGKILL)
+    return target_file
+
+
+def run_backup(journal, calls, interrupt=False):
+    """
+    A backup run: removal of orphaned files, then two dumps
+    """
+    target_folder = utils.get_target_folder(include_target_subfolder=True)
+    scheduler = Scheduler(max_workers=1, journal=journal, journaled=['dumps', ])
+    cleanup = scheduler.submit('general', 'cleanup', cleanup_orphans)
+    for name in ['one', 'two', ]:
+        target_file = os.path.join(target_folder, '%s__%s.gz' % (utils.timestamp_to_string(journal.timestamp), name))
+        scheduler.submit_after([cleanup, ], 'dumps', name, write_output, target_file, calls, interrupt and name == 'two')
+    scheduler.run()
+
+
+def interrupted_run(target_root):
+    configure(target_root)
+    run_backup(start_journal(TIMESTAMP), [], interrupt=True)
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.target_folder = os.path.join(self.tmp.name, 'daily')
+        os.makedirs(self.target_folder)
+        configure(self.tmp.name)
+        del ERRORS_LIST[:]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        del ERRORS_LIST[:]
+
+    def test_resume(self):
+        process = subprocess.run(
+            [sys.executable, '-c', 'from tests.test_journal import interrupted_run; interrupted_run(%r)' % self.tmp.name],
+            cwd=ROOT_FOLDER,
+        )
+        self.assertEqual(process.returncode, -signal.SIGKILL)
+        # the interrupted run left the journal, a complete output and a partial one
+        self.assertEqual(sorted(os.listdir(self.target_folder)), [
+            '2018-03-01_01-00-00__one.gz',
+            '2018-03-01_01-00-00__two.gz' + PARTIAL_EXTENSION,
+        ])
+        with open(os.path.join(self.tmp.name, 'fingerprints.json.tmp'), 'w'):
+            pass
+
+        journal = resume_journal()
+        # the original timestamp is reused
+        self.assertEqual(journal.timestamp, TIMESTAMP)
+        self.assertEqual(journal.unfinished(), ['dumps: two', ])
+        self.assertEqual(journal.jobs['dumps: two']['state'], 'running')
+
+        calls = []
+        run_backup(journal, calls)
+        # completed jobs are skipped, and orphaned files removed
+        self.assertEqual(calls, ['2018-03-01_01-00-00__two.gz', ])
+        self.assertEqual(ERRORS_LIST, [])
+        self.assertEqual(sorted(os.listdir(self.target_folder)), [
+            '2018-03-01_01-00-00__one.gz',
+            '2018-03-01_01-00-00__two.gz',
+        ])
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['daily', 'easy_backup.journal.json', ])
+        self.assertEqual(journal.unfinished(), [])
+
+        # the journal is removed when all jobs have been completed
+        self.assertTrue(journal.finish())
+        self.assertFalse(os.path.exists(get_journal_filepath()))
+        with self.assertRaises(Exception):
+            resume_journal()
+
+    def test_missing_output(self):
+        # jobs whose output has been removed in the meantime are run again
+        calls = []
+        run_backup(start_journal(TIMESTAMP), calls)
+        os.unlink(os.path.join(self.target_folder, '2018-03-01_01-00-00__one.gz'))
+        journal = resume_journal()
+        self.assertEqual(journal.unfinished(), [])
+        run_backup(journal, calls)
+        self.assertEqual(calls, ['2018-03-01_01-00-00__one.gz', '2018-03-01_01-00-00__two.gz', '2018-03-01_01-00-00__one.gz', ])
+
+    def test_failed(self):
+        # failed jobs keep the journal, and leave no partial output
+        journal = start_journal(TIMESTAMP)
+        scheduler = Scheduler(max_workers=1, journal=journal)
+        target_file = os.path.join(self.target_folder, 'broken.gz')
+
+        def broken():
+            with partial_output(target_file) as partial_file:
+                with open(partial_file, 'wb') as f:
+                    f.write(b'data')
+                raise Exception('disk full')
+
+        scheduler.submit('dumps', 'broken', broken)
+        scheduler.run()
+        self.assertEqual(os.listdir(self.target_folder), [])
+        self.assertFalse(journal.finish())
+        self.assertEqual(resume_journal().unfinished(), ['dumps: broken', ])
+
+    def test_start_replaces(self):
+        journal = start_journal(TIMESTAMP)
+        journal.add('dumps: one')
+        journal = start_journal(TIMESTAMP + datetime.timedelta(days=1))
+        self.assertEqual(resume_journal().jobs, {})
+        self.assertEqual(resume_journal().timestamp, journal.timestamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
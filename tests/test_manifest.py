@@ -0,0 +1,216 @@
+import os
+import json
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+from easy_backup.manifest import Manifests, FolderManifest, MANIFEST_FILENAME, HASH_ALGORITHM, hash_path
+from easy_backup.rotate_files import RotationAction, RotationPlan, execute_rotation_plan, rotate_all
+from easy_backup.verify import check_manifest_entry, verify_backup_folders, write_sidecar, read_sidecar, sidecar_path
+from easy_backup.utils import ERRORS_LIST
+
+from .common import configure
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.tmp = tempfile.TemporaryDirectory()
+        # rotate_all() checks that cwd matches target_folder
+        self.root = os.path.realpath(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def folder(self, name):
+        folder = os.path.join(self.root, name)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        return folder
+
+    def write(self, folder, filename, data=b'backup data'):
+        filepath = os.path.join(folder, filename)
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        return filepath
+
+    def saved_entries(self, folder):
+        with open(os.path.join(folder, MANIFEST_FILENAME)) as f:
+            return json.load(f)['files']
+
+
+class CheckManifestEntryTest(ManifestTestCase):
+
+    def test_added_and_verified(self):
+        folder = self.folder('daily')
+        filepath = self.write(folder, 'dump.sql')
+        manifest = FolderManifest(folder)
+        self.assertEqual(check_manifest_entry(manifest, 'dump.sql', False), 'added')
+        entry = manifest.get('dump.sql')
+        self.assertEqual(entry['hash'], hash_path(filepath, [HASH_ALGORITHM, ])[HASH_ALGORITHM])
+        self.assertEqual(entry['size'], len(b'backup data'))
+
+        manifest.save()
+        manifest = FolderManifest(folder)
+        self.assertEqual(check_manifest_entry(manifest, 'dump.sql', False), 'verified')
+        self.assertEqual(check_manifest_entry(manifest, 'dump.sql', True), 'skipped')
+
+    def test_sidecar(self):
+        folder = self.folder('daily')
+        filepath = self.write(folder, 'dump.sql')
+        write_sidecar(filepath, hash_path(filepath, ['sha256', ])['sha256'])
+        self.assertEqual(check_manifest_entry(FolderManifest(folder), 'dump.sql', False), 'added')
+
+        write_sidecar(filepath, '0' * 64)
+        manifest = FolderManifest(folder)
+        with self.assertRaises(Exception) as context:
+            check_manifest_entry(manifest, 'dump.sql', False)
+        self.assertIn('sha256 differs', str(context.exception))
+        self.assertIsNone(manifest.get('dump.sql'))
+
+    def test_modified(self):
+        folder = self.folder('daily')
+        filepath = self.write(folder, 'dump.sql')
+        manifest = FolderManifest(folder)
+        check_manifest_entry(manifest, 'dump.sql', False)
+        st = os.stat(filepath)
+
+        # same size and mtime: only a full check notices
+        self.write(folder, 'dump.sql', b'BACKUP DATA')
+        os.utime(filepath, (st.st_atime, st.st_mtime))
+        self.assertEqual(check_manifest_entry(manifest, 'dump.sql', True), 'skipped')
+        with self.assertRaises(Exception) as context:
+            check_manifest_entry(manifest, 'dump.sql', False)
+        self.assertIn('differs from the manifest', str(context.exception))
+
+        # a different mtime is never skipped
+        os.utime(filepath, (st.st_atime, st.st_mtime - 3600))
+        with self.assertRaises(Exception):
+            check_manifest_entry(manifest, 'dump.sql', True)
+
+
+class VerifyBackupFoldersTest(ManifestTestCase):
+
+    def setUp(self):
+        super(VerifyBackupFoldersTest, self).setUp()
+        configure(target_root=self.root)
+        del ERRORS_LIST[:]
+
+    def tearDown(self):
+        del ERRORS_LIST[:]
+        super(VerifyBackupFoldersTest, self).tearDown()
+
+    def test_missing(self):
+        folder = self.folder('daily')
+        self.write(folder, 'first.sql')
+        filepath = self.write(folder, 'second.sql')
+        self.write(folder, '.hidden')
+        self.write(folder, 'third.sql.partial')
+        verify_backup_folders()
+        self.assertEqual(sorted(self.saved_entries(folder).keys()), ['first.sql', 'second.sql', ])
+        self.assertEqual(ERRORS_LIST, [])
+
+        os.unlink(filepath)
+        verify_backup_folders(quick=True)
+        self.assertEqual(len(ERRORS_LIST), 1)
+        self.assertIn('Missing file "second.sql"', ERRORS_LIST[0]['message'])
+        self.assertEqual(sorted(self.saved_entries(folder).keys()), ['first.sql', ])
+
+    def test_dry_run(self):
+        configure(target_root=self.root, dry_run=True)
+        folder = self.folder('daily')
+        self.write(folder, 'first.sql')
+        with mock.patch('sys.stderr'):
+            verify_backup_folders()
+        self.assertFalse(os.path.exists(os.path.join(folder, MANIFEST_FILENAME)))
+
+
+class RotationTest(ManifestTestCase):
+
+    def verify(self, folder):
+        manifest = FolderManifest(folder)
+        for filename in sorted(os.listdir(folder)):
+            if filename != MANIFEST_FILENAME and not filename.endswith('.sha256'):
+                check_manifest_entry(manifest, filename, False)
+        manifest.save()
+
+    def test_execute(self):
+        daily = self.folder('daily')
+        weekly = self.folder('weekly')
+        quarantine = self.folder('quarantine')
+        for filename in ['moved.gz', 'quarantined.gz', 'deleted.gz', ]:
+            filepath = self.write(daily, filename, filename.encode('utf-8'))
+            write_sidecar(filepath, hash_path(filepath, ['sha256', ])['sha256'])
+        self.verify(daily)
+        entries = self.saved_entries(daily)
+        sidecars = set([sidecar_path(os.path.join(daily, filename)) for filename in entries])
+
+        plan = RotationPlan()
+        plan.actions = [
+            RotationAction('move', 'moved.gz', daily, weekly),
+            RotationAction('quarantine', 'quarantined.gz', daily, quarantine, '2021-01-01_____quarantined.gz'),
+            RotationAction('delete', 'deleted.gz', daily),
+        ]
+        self.assertEqual(execute_rotation_plan(plan, False, sidecars, Manifests()), 0)
+
+        self.assertEqual(self.saved_entries(daily), {})
+        self.assertEqual(self.saved_entries(weekly), {'moved.gz': entries['moved.gz'], })
+        self.assertEqual(self.saved_entries(quarantine), {'2021-01-01_____quarantined.gz': entries['quarantined.gz'], })
+        self.assertIsNotNone(read_sidecar(os.path.join(weekly, 'moved.gz')))
+        self.assertIsNotNone(read_sidecar(os.path.join(quarantine, '2021-01-01_____quarantined.gz')))
+        self.assertEqual(os.listdir(daily), [MANIFEST_FILENAME, ])
+
+        # the entries still match the files
+        for folder in [weekly, quarantine, ]:
+            manifest = FolderManifest(folder)
+            for filename in manifest.entries:
+                self.assertEqual(check_manifest_entry(manifest, filename, False), 'verified')
+
+    def test_dry_run(self):
+        daily = self.folder('daily')
+        weekly = self.folder('weekly')
+        self.write(daily, 'moved.gz')
+        self.verify(daily)
+        plan = RotationPlan()
+        plan.actions = [RotationAction('move', 'moved.gz', daily, weekly), ]
+        with mock.patch('easy_backup.rotate_files.dry_run_message'):
+            execute_rotation_plan(plan, True, (), Manifests())
+        self.assertEqual(list(self.saved_entries(daily).keys()), ['moved.gz', ])
+        self.assertFalse(os.path.exists(os.path.join(weekly, MANIFEST_FILENAME)))
+
+    def test_rotate_all(self):
+        today = datetime.date.today()
+        # a Monday (promoted to weekly) and a Wednesday (quarantined), neither the 1st of the month
+        monday = today - datetime.timedelta(days=14 + today.weekday())
+        if monday.day == 1:
+            monday -= datetime.timedelta(days=7)
+        wednesday = today - datetime.timedelta(days=(today.weekday() - 2) % 7 + 7)
+        if wednesday.day == 1:
+            wednesday -= datetime.timedelta(days=7)
+        promoted = '%s_01-00-00__postgresql.demo.gz' % monday.strftime('%Y-%m-%d')
+        discarded = '%s_01-00-00__postgresql.demo.gz' % wednesday.strftime('%Y-%m-%d')
+        recent = '%s_01-00-00__postgresql.demo.gz' % today.strftime('%Y-%m-%d')
+
+        daily = self.folder('daily')
+        for filename in [promoted, discarded, recent, ]:
+            filepath = self.write(daily, filename, filename.encode('utf-8'))
+            write_sidecar(filepath, hash_path(filepath, ['sha256', ])['sha256'])
+        self.verify(daily)
+        entries = self.saved_entries(daily)
+
+        with mock.patch('easy_backup.rotate_files.logger'):
+            errors = rotate_all(self.root, 'daily', 'weekly', 'monthly', 'yearly', 'quarantine', 30, False)
+        self.assertEqual(errors, 0)
+
+        quarantined = '%s_____%s' % (today.strftime('%Y-%m-%d'), discarded)
+        self.assertEqual(self.saved_entries(daily), {recent: entries[recent], })
+        self.assertEqual(self.saved_entries(os.path.join(self.root, 'weekly')), {promoted: entries[promoted], })
+        self.assertEqual(self.saved_entries(os.path.join(self.root, 'quarantine')), {quarantined: entries[discarded], })
+        self.assertIsNotNone(read_sidecar(os.path.join(self.root, 'weekly', promoted)))
+        self.assertIsNotNone(read_sidecar(os.path.join(self.root, 'quarantine', quarantined)))
+
+
+if __name__ == '__main__':
+    unittest.main()
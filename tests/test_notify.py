@@ -0,0 +1,82 @@
+import os
+import subprocess
+import unittest
+
+from easy_backup.notify import format_command, escape
+
+INJECTED = '/tmp/easy_backup_injected'
+
+# values which the shell would expand, if not properly escaped
+VALUES = [
+    'plain text',
+    '$(touch %s) $HOME ${HOME}' % INJECTED,
+    '`touch %s`' % INJECTED,
+    'double " quote, single \' quote',
+    'back\\slash \\" \\\' \\\\ \\n \\',
+    "it's \"all\" $(`together`)\n\ton two lines",
+    '',
+]
+
+# placeholders: double quoted, single quoted, bare
+TEMPLATES = [
+    'printf %s "{x}"',
+    "printf %s '{x}'",
+    'printf %s {x}',
+    'printf %s "prefix {x} suffix"',
+    'printf %s \'prefix\'"{x}"\'{x}\'{x}',
+]
+
+
+def shell_output(command):
+    return subprocess.check_output(['sh', '-c', command]).decode('utf-8')
+
+
+def expected_output(template, value):
+    return {
+        'printf %s "prefix {x} suffix"': 'prefix %s suffix' % value,
+        'printf %s \'prefix\'"{x}"\'{x}\'{x}': 'prefix' + value * 3,
+    }.get(template, value)
+
+
+class FormatCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists(INJECTED):
+            os.unlink(INJECTED)
+
+    def test_shell(self):
+        for template in TEMPLATES:
+            for value in VALUES:
+                with self.subTest(template=template, value=value):
+                    command = format_command(template, x=value)
+                    self.assertEqual(shell_output(command), expected_output(template, value))
+        self.assertFalse(os.path.exists(INJECTED))
+
+    def test_quotes_in_command(self):
+        # quotes and escapes of the command itself are preserved
+        cases = [
+            ('printf %s "a \\"{x}\\" b"', 'a "v$1" b'),
+            ("printf %s 'it'\\''s {x}'", "it's v$1"),
+            ('printf %s "{x}" \'{y}\' {x}', 'v$1unusedv$1'),
+        ]
+        for template, expected in cases:
+            with self.subTest(template=template):
+                self.assertEqual(shell_output(format_command(template, x='v$1', y='unused')), expected)
+
+    def test_unknown_placeholders(self):
+        self.assertEqual(format_command('echo "{x}" {other} {', x='$a'), 'echo "\\$a" {other} {')
+
+    def test_escape(self):
+        cases = [
+            ('a"b$c`d\\e', '"', 'a\\"b\\$c\\`d\\\\e'),
+            ("it's", "'", "it'\\''s"),
+            ("it's", None, "'it'\"'\"'s'"),
+            ('plain', None, 'plain'),
+        ]
+        for text, quote, expected in cases:
+            with self.subTest(text=text, quote=quote):
+                self.assertEqual(escape(text, quote), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
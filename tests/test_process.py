@@ -0,0 +1,148 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from easy_backup import process
+from easy_backup.process import Pipeline, ProcessError, PIPE, STDERR_TAIL_SIZE
+
+from .common import configure
+
+SH = ['sh', '-c', ]
+# ignores SIGTERM, without children holding its pipes
+IGNORE_TERM = [sys.executable, '-c', 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print("", flush=True); time.sleep(30)', ]
+KILL_DELAY = 0.5
+
+
+def run_async(*args, **kwargs):
+    return asyncio.run(process.run_async(*args, **kwargs))
+
+
+class RunTest(unittest.TestCase):
+    """
+    The same checks for the blocking and the asyncio runner
+    """
+
+    runner = staticmethod(process.run)
+
+    def setUp(self):
+        configure()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_capture(self):
+        result = self.runner([['printf', 'a b\\0c'], ], capture=True)
+        self.assertEqual(result.stdout, b'a b\0c')
+        self.assertEqual(result.returncodes, [0, ])
+        self.assertTrue(result.ok)
+
+    def test_pipeline(self):
+        result = self.runner([['printf', 'b\\na\\n'], ['sort'], ['tr', 'ab', 'AB'], ], capture=True)
+        self.assertEqual(result.stdout, b'A\nB\n')
+        self.assertEqual(result.returncodes, [0, 0, 0, ])
+
+    def test_output(self):
+        output = os.path.join(self.tmp.name, 'output.txt')
+        result = self.runner([['printf', 'hello'], ['cat'], ], output=output)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'hello')
+        self.assertEqual(result.output_bytes, 5)
+        self.assertIsNotNone(result.duration)
+
+    def test_pipefail(self):
+        # any failing stage fails the pipeline, as with "set -o pipefail"
+        with self.assertRaises(ProcessError) as context:
+            self.runner([SH + ['exit 3'], ['cat'], ])
+        self.assertEqual(context.exception.result.returncodes, [3, 0, ])
+        self.assertEqual(context.exception.result.returncode, 3)
+        self.assertIn('exit codes: 3, 0', str(context.exception))
+
+        result = self.runner([['cat', '/dev/null'], SH + ['cat; exit 4'], ], check=False)
+        self.assertEqual(result.returncodes, [0, 4, ])
+        self.assertFalse(result.ok)
+
+    def test_stderr_tail(self):
+        script = 'i=0; while [ $i -lt 2000 ]; do echo "line $i" >&2; i=$((i+1)); done; exit 1'
+        with self.assertRaises(ProcessError) as context:
+            self.runner([['true'], SH + [script], ])
+        stderr = context.exception.result.stderr
+        # only the last bytes of each stage are kept, prefixed by the program name
+        self.assertTrue(stderr.startswith('[sh] '))
+        self.assertTrue(stderr.endswith('line 1999'))
+        self.assertLessEqual(len(stderr), STDERR_TAIL_SIZE + len('[sh] '))
+        self.assertIn(stderr, str(context.exception))
+
+    def test_stderr_on_success(self):
+        result = self.runner([SH + ['echo warning >&2'], ])
+        self.assertEqual(result.stderr, '[sh] warning')
+
+    def test_timeout(self):
+        with self.assertRaises(ProcessError) as context:
+            self.runner([['sleep', '30'], ['cat'], ], timeout=0.2)
+        result = context.exception.result
+        self.assertTrue(result.timed_out)
+        self.assertIn('timed out', str(context.exception))
+        self.assertEqual(result.returncodes[0], -15)
+        self.assertLess(result.duration, 5)
+
+    def test_kill(self):
+        # stages ignoring SIGTERM are killed after KILL_DELAY
+        with mock.patch.object(process, 'KILL_DELAY', KILL_DELAY):
+            with self.assertRaises(ProcessError) as context:
+                self.runner([IGNORE_TERM, ], timeout=0.5, capture=True)
+        result = context.exception.result
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncodes, [-9, ])
+        self.assertGreaterEqual(result.duration, 0.5 + KILL_DELAY)
+        self.assertLess(result.duration, 5)
+
+    def test_not_found(self):
+        with self.assertRaises(Exception) as context:
+            self.runner([['true'], ['easy-backup-no-such-command'], ])
+        self.assertIn('COMMAND FAILED', str(context.exception))
+
+    def test_dry_run(self):
+        configure(dry_run=True)
+        output = os.path.join(self.tmp.name, 'output.txt')
+        with mock.patch('sys.stderr'):
+            self.assertIsNone(self.runner([['touch', output], ]))
+        self.assertFalse(os.path.exists(output))
+        self.assertTrue(self.runner([['touch', output], ], force=True).ok)
+        self.assertTrue(os.path.exists(output))
+
+
+class RunAsyncTest(RunTest):
+
+    runner = staticmethod(run_async)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def test_stdin(self):
+        pipeline = Pipeline([['tr', 'a-z', 'A-Z'], ['cat'], ]).start(stdin=PIPE, stdout=PIPE)
+        pipeline.stdin.write(b'hello')
+        pipeline.stdin.close()
+        self.assertEqual(pipeline.stdout.read(), b'HELLO')
+        self.assertTrue(pipeline.wait().ok)
+
+    def test_kill(self):
+        pipeline = Pipeline([['sleep', '30'], ['cat'], ]).start(stdout=PIPE)
+        pipeline.kill()
+        result = pipeline.wait()
+        self.assertEqual(result.returncodes[0], -9)
+        self.assertFalse(result.ok)
+
+    def test_format_pipeline(self):
+        self.assertEqual(process.format_pipeline([['pg_dump', 'my db'], ['gzip'], ], '/tmp/a b.gz'),
+                         "pg_dump 'my db' | gzip > '/tmp/a b.gz'")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import datetime
+import tempfile
+import unittest
+
+from easy_backup.rotate_files import RotationIndex, RotationPlan, enforce_quota
+from easy_backup.dateparse import get_date_parser
+
+TODAY = datetime.date(2019, 1, 5)
+FILE_SIZE = 100
+README_SIZE = 50
+
+
+class QuotaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.daily = os.path.join(self.tmp.name, 'daily')
+        self.weekly = os.path.join(self.tmp.name, 'weekly')
+        self.quarantine = os.path.join(self.tmp.name, 'quarantine')
+        for folder in [self.daily, self.weekly, self.quarantine, ]:
+            os.makedirs(folder)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_file(self, folder, filename, size=FILE_SIZE):
+        with open(os.path.join(folder, filename), 'wb') as f:
+            f.write(b'x' * size)
+
+    def evict(self, max_total_size, quarantining=(), protected=()):
+        """
+        Plan the quota enforcement on a fresh index, after quarantining the given
+        files of the daily folder; returns the names of the evicted files
+        """
+        index = RotationIndex([self.daily, self.weekly, self.quarantine, ], TODAY, get_date_parser(), with_sizes=True)
+        plan = RotationPlan()
+        files = [file_obj for file_obj in index.files[self.daily] if file_obj.filename in quarantining]
+        index.files[self.daily] = [file_obj for file_obj in index.files[self.daily] if file_obj not in files]
+        plan.quarantine(files, self.daily, self.quarantine, TODAY)
+        enforce_quota(plan, index, [self.daily, self.weekly, ], self.quarantine, max_total_size, protected)
+        return set(action.filename for action in plan.actions if action.kind == 'delete')
+
+    def test_order(self):
+        self.make_file(self.quarantine, '2019-01-03_____2018-12-01_01-00-00__postgresql.demo.gz')
+        self.make_file(self.quarantine, '2019-01-02_____2018-11-01_01-00-00__postgresql.demo.gz')
+        self.make_file(self.weekly, '2018-12-17_01-00-00__mysql.demo.gz')
+        self.make_file(self.weekly, '2018-12-24_01-00-00__postgresql.demo.gz')
+        for filename in [
+            '2018-12-20_01-00-00__data.tar.gz',
+            '2018-12-21_01-00-00__data.tar.gz',
+            '2018-12-25_01-00-00__postgresql.demo.gz',
+            '2018-12-31_01-00-00__mysql.demo.gz',
+            '2019-01-01_01-00-00__postgresql.demo.gz',
+            '2019-01-02_01-00-00__postgresql.demo.gz',
+        ]:
+            self.make_file(self.daily, filename)
+        self.make_file(self.daily, 'README.txt', README_SIZE)
+        total_size = 10 * FILE_SIZE + README_SIZE
+
+        # quarantined files (the oldest first), files being quarantined, then the oldest backups,
+        # except the most recent file of each series and protected files
+        expected = [
+            '2019-01-02_____2018-11-01_01-00-00__postgresql.demo.gz',
+            '2019-01-03_____2018-12-01_01-00-00__postgresql.demo.gz',
+            '2018-12-25_01-00-00__postgresql.demo.gz',
+            '2018-12-17_01-00-00__mysql.demo.gz',
+            '2018-12-24_01-00-00__postgresql.demo.gz',
+            '2019-01-01_01-00-00__postgresql.demo.gz',
+        ]
+        quarantining = ['2018-12-25_01-00-00__postgresql.demo.gz', ]
+        protected = ['2018-12-20_01-00-00__data.tar.gz', ]
+        for count in range(len(expected) + 1):
+            with self.subTest(count=count):
+                evicted = self.evict(total_size - count * FILE_SIZE, quarantining, protected)
+                self.assertEqual(evicted, set(expected[:count]))
+        # the quota can't be met
+        self.assertEqual(self.evict(0, quarantining, protected), set(expected))
+
+    def test_hard_links(self):
+        self.make_file(self.daily, '2019-01-01_01-00-00__postgresql.demo.gz')
+        os.link(os.path.join(self.daily, '2019-01-01_01-00-00__postgresql.demo.gz'),
+                os.path.join(self.weekly, '2019-01-02_01-00-00__postgresql.demo.gz'))
+        self.make_file(self.daily, '2019-01-03_01-00-00__postgresql.demo.gz')
+
+        # linked files are counted once
+        self.assertEqual(self.evict(2 * FILE_SIZE), set())
+        # and free space only when all their links are evicted
+        self.assertEqual(self.evict(2 * FILE_SIZE - 1), set([
+            '2019-01-01_01-00-00__postgresql.demo.gz',
+            '2019-01-02_01-00-00__postgresql.demo.gz',
+        ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import datetime
+import unittest
+
+from easy_backup.retention import RetentionPolicy, RetentionPolicies, parse_counts, series_name
+from easy_backup.rotate_files import DatedFile
+from easy_backup.dateparse import get_date_parser
+
+TODAY = datetime.date(2021, 1, 1)
+
+# (description, counts, filenames' timestamps, retained timestamps -> rule)
+SELECT_CASES = [
+    (
+        'daily, across month and year boundaries; one file per day',
+        {'daily': 3},
+        ['2019-01-02_01-00-00', '2019-01-01_23-00-00', '2019-01-01_01-00-00', '2018-12-31_01-00-00', '2018-12-30_01-00-00', ],
+        {'2019-01-02_01-00-00': 'last', '2019-01-01_23-00-00': 'daily', '2018-12-31_01-00-00': 'daily', },
+    ),
+    (
+        'daily: days having backups, not calendar days',
+        {'daily': 2},
+        ['2019-03-01_01-00-00', '2019-02-01_01-00-00', '2019-01-01_01-00-00', ],
+        {'2019-03-01_01-00-00': 'last', '2019-02-01_01-00-00': 'daily', },
+    ),
+    (
+        'weekly: ISO weeks, across the year boundary (2018-12-31 is in week 1 of 2019)',
+        {'weekly': 2},
+        ['2019-01-02_01-00-00', '2018-12-31_01-00-00', '2018-12-30_01-00-00', '2018-12-24_01-00-00', '2018-12-23_01-00-00', ],
+        {'2019-01-02_01-00-00': 'last', '2018-12-30_01-00-00': 'weekly', },
+    ),
+    (
+        'monthly: the last day of each month',
+        {'daily': 1, 'monthly': 3},
+        ['2018-03-01_01-00-00', '2018-02-28_01-00-00', '2018-02-01_01-00-00', '2018-01-31_01-00-00', '2017-12-31_01-00-00', ],
+        {'2018-03-01_01-00-00': 'last', '2018-02-28_01-00-00': 'monthly', '2018-01-31_01-00-00': 'monthly', },
+    ),
+    (
+        'yearly, from a leap day',
+        {'monthly': 1, 'yearly': 2},
+        ['2020-02-29_01-00-00', '2020-01-01_01-00-00', '2019-12-31_01-00-00', '2019-01-01_01-00-00', '2018-12-31_01-00-00', ],
+        {'2020-02-29_01-00-00': 'last', '2019-12-31_01-00-00': 'yearly', },
+    ),
+    (
+        'the finest rule is reported; rules are counted independently',
+        {'last': 1, 'daily': 2, 'weekly': 3},
+        ['2019-01-07_01-00-00', '2019-01-06_01-00-00', '2019-01-05_01-00-00', '2018-12-30_01-00-00', '2018-12-29_01-00-00', ],
+        {'2019-01-07_01-00-00': 'last', '2019-01-06_01-00-00': 'daily', '2018-12-30_01-00-00': 'weekly', },
+    ),
+    (
+        'keep_last counts files, not periods',
+        {'last': 3},
+        ['2019-01-01_03-00-00', '2019-01-01_02-00-00', '2019-01-01_01-00-00', '2018-12-31_01-00-00', ],
+        {'2019-01-01_03-00-00': 'last', '2019-01-01_02-00-00': 'last', '2019-01-01_01-00-00': 'last', },
+    ),
+    (
+        'the most recent file is always retained',
+        {},
+        ['2019-01-02_01-00-00', '2019-01-01_01-00-00', ],
+        {'2019-01-02_01-00-00': 'last', },
+    ),
+]
+
+
+def make_files(timestamps, name='postgresql.demo1.gz'):
+    parser = get_date_parser()
+    return [DatedFile('%s__%s' % (timestamp, name), TODAY, parser) for timestamp in timestamps]
+
+
+def by_timestamp(retained):
+    return dict([(file_obj.filename.split('__')[0], rule) for file_obj, rule in retained.items()])
+
+
+class RetentionPolicyTest(unittest.TestCase):
+
+    def test_select(self):
+        for description, counts, timestamps, expected in SELECT_CASES:
+            with self.subTest(description):
+                retained = RetentionPolicy(counts).select(make_files(timestamps))
+                self.assertEqual(by_timestamp(retained), expected)
+
+    def test_select_unsorted(self):
+        # RetentionPolicies sorts each series from the most recent
+        for description, counts, timestamps, expected in SELECT_CASES:
+            with self.subTest(description):
+                retained = RetentionPolicies(RetentionPolicy(counts)).select(make_files(sorted(timestamps)))
+                self.assertEqual(by_timestamp(retained), expected)
+
+    def test_series(self):
+        policies = RetentionPolicies(
+            RetentionPolicy({'daily': 1}),
+            [('postgresql.', RetentionPolicy({'daily': 2})), ('postgresql.demo2', RetentionPolicy({'daily': 3})), ],
+        )
+        timestamps = ['2019-01-03_01-00-00', '2019-01-02_01-00-00', '2019-01-01_01-00-00', ]
+        files = make_files(timestamps, 'mysql.demo.gz') + make_files(timestamps, 'postgresql.demo1.gz') + \
+            make_files(timestamps, 'postgresql.demo2.gz')
+        retained = policies.select(files)
+        counts = {}
+        for file_obj in retained:
+            name = series_name(file_obj.filename)
+            counts[name] = counts.get(name, 0) + 1
+        self.assertEqual(counts, {'mysql.demo.gz': 1, 'postgresql.demo1.gz': 2, 'postgresql.demo2.gz': 3, })
+
+    def test_parse_counts(self):
+        self.assertEqual(parse_counts('keep_daily=30, keep_weekly = 4,', 'test'), {'daily': 30, 'weekly': 4, })
+        with self.assertRaises(Exception):
+            parse_counts('keep_hourly=1', 'test')
+        with self.assertRaises(Exception):
+            parse_counts('keep_daily=many', 'test')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from easy_backup import scanner
+from easy_backup.scanner import ExcludeMatcher, scan_folder, translate_pattern
+
+# (patterns, path, excluded)
+MATCH_CASES = [
+    # name-only patterns match at any depth
+    (['node_modules'], '/srv/www/node_modules', True),
+    (['node_modules'], '/srv/www/app/lib/node_modules', True),
+    (['node_modules'], '/srv/www/node_modules_old', False),
+    (['*.pyc'], '/srv/www/app/module.pyc', True),
+    (['*.pyc'], '/srv/www/app.pyc/module.py', False),
+    (['cache?'], '/srv/cache1', True),
+    (['cache[0-9]'], '/srv/cachex', False),
+    (['cache[!0-9]'], '/srv/cachex', True),
+    # patterns with a "/" are anchored to the absolute path
+    (['/srv/www/media'], '/srv/www/media', True),
+    (['/srv/www/media/'], '/srv/www/media', True),
+    (['/srv/www/media'], '/srv/other/srv/www/media', False),
+    (['/srv/www/media'], '/srv/www/media2', False),
+    (['/srv/*/media'], '/srv/www/media', True),
+    (['/srv/*/media'], '/srv/www/app/media', False),
+    (['/srv/**/media'], '/srv/www/app/media', True),
+    (['/srv/www/*.log'], '/srv/www/logs/error.log', False),
+    # several patterns
+    (['*.tmp', 'node_modules', '/srv/www/media'], '/srv/www/a.tmp', True),
+    (['*.tmp', 'node_modules', '/srv/www/media'], '/srv/www/a.txt', False),
+    ([' ', ''], '/srv/www', False),
+]
+
+
+class ExcludeMatcherTest(unittest.TestCase):
+
+    def test_match(self):
+        for patterns, path, excluded in MATCH_CASES:
+            with self.subTest(patterns=patterns, path=path):
+                self.assertEqual(ExcludeMatcher(patterns).match(path), excluded)
+
+    def test_empty(self):
+        self.assertFalse(ExcludeMatcher([]))
+        self.assertFalse(ExcludeMatcher(['', ' ']))
+        self.assertTrue(ExcludeMatcher(['node_modules']))
+
+    def test_translate(self):
+        cases = [
+            ('*.py', '[^/]*\\.py'),
+            ('a?c', 'a[^/]c'),
+            ('**/x', '.*/x'),
+            ('[!a]', '[^a]'),
+            ('[', '\\['),
+        ]
+        for pattern, expected in cases:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(translate_pattern(pattern), expected)
+
+
+class ScanFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'www')
+        for filename in [
+            'index.html',
+            'node_modules/x.js',
+            'app/module.py',
+            'app/module.pyc',
+            'app/node_modules/deep/y.js',
+            'app/media/image.png',
+            'media/video.mp4',
+        ]:
+            filepath = os.path.join(self.root, filename)
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            with open(filepath, 'wb') as f:
+                f.write(b'12345')
+        os.symlink(os.path.join(self.root, 'app'), os.path.join(self.root, 'app_link'))
+        os.symlink(self.root, os.path.join(self.root, 'app', 'loop'))
+        os.symlink(os.path.join(self.root, 'missing'), os.path.join(self.root, 'dangling'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def scan(self, patterns):
+        scanned = []
+        scandir = os.scandir
+
+        def recording_scandir(path):
+            scanned.append(os.path.relpath(path, self.tmp.name))
+            return scandir(path)
+
+        with mock.patch.object(scanner.os, 'scandir', recording_scandir):
+            scan = scan_folder(self.root, ExcludeMatcher(patterns))
+        return scan, scanned
+
+    def test_exclude(self):
+        scan, scanned = self.scan(['node_modules', '*.pyc', os.path.join(self.root, 'app', 'media'), ])
+        paths = [entry.path for entry in scan.entries]
+        self.assertEqual(sorted(scan.excluded), [
+            'www/app/media',
+            'www/app/module.pyc',
+            'www/app/node_modules',
+            'www/app_link/module.pyc',
+            'www/app_link/node_modules',
+            'www/node_modules',
+        ])
+        # excluded subtrees are never read
+        self.assertEqual([path for path in scanned if 'node_modules' in path or path.endswith('app/media')], [])
+        for path in ['www', 'www/index.html', 'www/app/module.py', 'www/media/video.mp4',
+                     # absolute patterns don't match the same folder through a symbolic link
+                     'www/app_link/media/image.png', ]:
+            self.assertIn(path, paths)
+
+    def test_symlinks(self):
+        scan, scanned = self.scan([])
+        entries = dict([(entry.path, entry) for entry in scan.entries])
+        # symbolic links to folders are followed
+        self.assertTrue(entries['www/app_link'].is_dir)
+        self.assertEqual(entries['www/app_link/module.py'].size, 5)
+        # loops are detected: the link is listed, but not followed
+        self.assertTrue(entries['www/app/loop'].is_dir)
+        self.assertNotIn('www/app/loop/index.html', entries)
+        self.assertIn('www/app_link/loop', entries)
+        self.assertNotIn('www/app_link/loop/index.html', entries)
+        # dangling links are listed as such
+        self.assertIn('www/dangling', entries)
+        self.assertFalse(entries['www/dangling'].is_dir)
+
+    def test_total_size(self):
+        scan, scanned = self.scan(['app_link', 'loop', ])
+        files = [entry for entry in scan.entries if not entry.is_dir and entry.path != 'www/dangling']
+        self.assertEqual(len(files), 7)
+        self.assertEqual(scan.total_size, 7 * 5 + len(os.readlink(os.path.join(self.root, 'dangling'))))
+
+    def test_write_list(self):
+        scan, scanned = self.scan(['app_link', 'loop', 'dangling', ])
+        filepath = os.path.join(self.tmp.name, 'list')
+        scan.write_list(filepath, directories_only=True)
+        with open(filepath, 'rb') as f:
+            paths = f.read().split(b'\0')
+        self.assertEqual(paths[-1], b'')
+        self.assertEqual(sorted(paths[:-1]), [b'www', b'www/app', b'www/app/media', b'www/app/node_modules',
+                                              b'www/app/node_modules/deep', b'www/media', b'www/node_modules', ])
+
+
+if __name__ == '__main__':
+    unittest.main()
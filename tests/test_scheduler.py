@@ -0,0 +1,348 @@
+import os
+import asyncio
+import datetime
+import tempfile
+import threading
+import unittest
+
+from easy_backup.scheduler import Scheduler, ALL
+from easy_backup.journal import RunJournal
+from easy_backup.utils import ERRORS_LIST, MAINTENANCE_ERRORS_LIST, MaintenanceError
+
+from .common import configure
+
+# how long a job waits for another one, before giving up
+WAIT_TIMEOUT = 5
+
+
+class Recorder(object):
+    """
+    Dummy jobs, recording the order in which they start and end,
+    and the maximum number of jobs running at the same time
+    """
+
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def started(self, name):
+        with self.lock:
+            self.events.append('start %s' % name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def ended(self, name):
+        with self.lock:
+            self.events.append('end %s' % name)
+            self.running -= 1
+
+    def sync_job(self, name, delay=0.0, result=None):
+        self.started(name)
+        threading.Event().wait(delay)
+        self.ended(name)
+        return result
+
+    async def async_job(self, name, delay=0.0, result=None):
+        self.started(name)
+        await asyncio.sleep(delay)
+        self.ended(name)
+        return result
+
+    def failing_job(self, name, error=Exception):
+        self.started(name)
+        self.ended(name)
+        raise error('%s failed' % name)
+
+    def index(self, event):
+        return self.events.index(event)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        del ERRORS_LIST[:]
+        self.recorder = Recorder()
+
+    def tearDown(self):
+        del ERRORS_LIST[:]
+
+    def test_sync_and_async_jobs(self):
+        scheduler = Scheduler(max_workers=2)
+        one = scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one', result='one.gz')
+        two = scheduler.submit('dumps', 'two', self.recorder.async_job, 'two', result='two.gz')
+        scheduler.run()
+        self.assertEqual((one.result, two.result), ('one.gz', 'two.gz'))
+        self.assertTrue(one.completed and two.completed)
+        self.assertEqual(ERRORS_LIST, [])
+
+    def test_all(self):
+        scheduler = Scheduler(max_workers=4)
+        last = scheduler.submit_after([ALL, ], 'notification', 'last', self.recorder.sync_job, 'last')
+        scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one', 0.05)
+        scheduler.submit('dumps', 'two', self.recorder.async_job, 'two', 0.05)
+        with scheduler.lock:
+            self.assertFalse(scheduler.is_ready(last))
+        scheduler.run()
+        self.assertEqual(self.recorder.events[-2:], ['start last', 'end last'])
+
+    def test_all_jobs_submitted_while_running(self):
+        scheduler = Scheduler(max_workers=4)
+
+        def submitting_job():
+            self.recorder.sync_job('first', 0.05)
+            scheduler.submit('verify', 'second', self.recorder.sync_job, 'second', 0.05)
+
+        scheduler.submit('dumps', 'first', submitting_job)
+        scheduler.submit_after([ALL, ], 'notification', 'last', self.recorder.async_job, 'last')
+        scheduler.run()
+        self.assertLess(self.recorder.index('end second'), self.recorder.index('start last'))
+
+    def test_all_jobs_wait_for_each_other_only_once(self):
+        # jobs after ALL don't wait for each other
+        scheduler = Scheduler(max_workers=4)
+        scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one')
+        scheduler.submit_after([ALL, ], 'cleanup', 'cleanup', self.recorder.sync_job, 'cleanup')
+        scheduler.submit_after([ALL, ], 'notification', 'last', self.recorder.sync_job, 'last')
+        scheduler.run()
+        self.assertEqual(ERRORS_LIST, [])
+        self.assertEqual(self.recorder.events[:2], ['start one', 'end one'])
+
+    def test_section(self):
+        scheduler = Scheduler(max_workers=4)
+        scheduler.submit('dumps', 'one', self.recorder.async_job, 'one', 0.05)
+        scheduler.submit('dumps', 'two', self.recorder.sync_job, 'two', 0.1)
+        scheduler.submit('archives', 'other', self.recorder.sync_job, 'other')
+        vacuum = scheduler.submit_after(['dumps', ], 'maintenance', 'vacuum', self.recorder.sync_job, 'vacuum')
+        with scheduler.lock:
+            self.assertFalse(scheduler.is_ready(vacuum))
+        scheduler.run()
+        self.assertLess(self.recorder.index('end one'), self.recorder.index('start vacuum'))
+        self.assertLess(self.recorder.index('end two'), self.recorder.index('start vacuum'))
+        # jobs of other sections are not waited for
+        self.assertLess(self.recorder.index('start other'), self.recorder.index('end two'))
+
+    def test_section_jobs_submitted_while_running(self):
+        scheduler = Scheduler(max_workers=4)
+
+        def submitting_job():
+            self.recorder.sync_job('first', 0.05)
+            scheduler.submit('dumps', 'second', self.recorder.sync_job, 'second', 0.05)
+
+        scheduler.submit('dumps', 'first', submitting_job)
+        scheduler.submit_after(['dumps', ], 'maintenance', 'vacuum', self.recorder.async_job, 'vacuum')
+        scheduler.run()
+        self.assertLess(self.recorder.index('end second'), self.recorder.index('start vacuum'))
+
+    def test_job(self):
+        scheduler = Scheduler(max_workers=4)
+        one = scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one', 0.05)
+        scheduler.submit('dumps', 'two', self.recorder.sync_job, 'two', 0.2)
+        scheduler.submit_after([one, ], 'verify', 'verify one', self.recorder.sync_job, 'verify one')
+        scheduler.run()
+        self.assertLess(self.recorder.index('end one'), self.recorder.index('start verify one'))
+        self.assertLess(self.recorder.index('start verify one'), self.recorder.index('end two'))
+
+    def test_failed_dependency(self):
+        # dependencies are satisfied by failed jobs too; follow-ups are not called
+        scheduler = Scheduler(max_workers=2)
+        followed = []
+        scheduler.follow(['dumps', ], followed.append)
+        scheduler.submit('dumps', 'broken', self.recorder.failing_job, 'broken')
+        scheduler.submit_after(['dumps', ], 'notification', 'last', self.recorder.sync_job, 'last')
+        scheduler.run()
+        self.assertEqual(self.recorder.events, ['start broken', 'end broken', 'start last', 'end last'])
+        self.assertEqual(followed, [])
+        self.assertEqual([error['message'] for error in ERRORS_LIST], ['broken failed'])
+
+    def test_follow_ups(self):
+        scheduler = Scheduler(max_workers=2)
+
+        def submit_verify(job):
+            scheduler.submit_after([job, ], 'verify', 'verify %s' % job.name, self.recorder.async_job, 'verify %s' % job.result)
+
+        scheduler.follow(['dumps', ], submit_verify)
+        scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one', result='one.gz')
+        scheduler.submit_after([ALL, ], 'notification', 'last', self.recorder.sync_job, 'last')
+        scheduler.run()
+        self.assertEqual(self.recorder.events, ['start one', 'end one', 'start verify one.gz', 'end verify one.gz', 'start last', 'end last'])
+
+    def test_max_workers(self):
+        scheduler = Scheduler(max_workers=2)
+        for i in range(3):
+            scheduler.submit('dumps', 'sync %d' % i, self.recorder.sync_job, 'sync %d' % i, 0.05)
+            scheduler.submit('dumps', 'async %d' % i, self.recorder.async_job, 'async %d' % i, 0.05)
+        scheduler.run()
+        self.assertEqual(self.recorder.max_running, 2)
+
+    def test_pool(self):
+        scheduler = Scheduler(max_workers=1, pools={'maintenance': 1})
+        dump = scheduler.create_job('dumps', 'one', self.recorder.sync_job, ('one', ), {})
+        other_dump = scheduler.create_job('dumps', 'two', self.recorder.sync_job, ('two', ), {})
+        vacuum = scheduler.create_job('maintenance', 'vacuum one', self.recorder.sync_job, ('vacuum one', ), {})
+        other_vacuum = scheduler.create_job('maintenance', 'vacuum two', self.recorder.sync_job, ('vacuum two', ), {})
+        scheduler.running = [dump, ]
+        with scheduler.lock:
+            self.assertFalse(scheduler.can_start(other_dump))
+            self.assertTrue(scheduler.can_start(vacuum))
+        scheduler.running = [vacuum, ]
+        with scheduler.lock:
+            # pool jobs don't take backup workers, but are limited by the pool size
+            self.assertTrue(scheduler.can_start(dump))
+            self.assertFalse(scheduler.can_start(other_vacuum))
+
+    def test_pool_running(self):
+        # the backup job waits for the pool job: with a single backup worker,
+        # both can only be completed if the pool job runs alongside it
+        scheduler = Scheduler(max_workers=1, pools={'maintenance': 1})
+        vacuum_started = threading.Event()
+
+        def dump_job():
+            self.recorder.started('dump')
+            if not vacuum_started.wait(WAIT_TIMEOUT):
+                raise Exception('vacuum not started')
+            self.recorder.ended('dump')
+
+        async def vacuum_job():
+            self.recorder.started('vacuum')
+            vacuum_started.set()
+            self.recorder.ended('vacuum')
+
+        scheduler.submit('dumps', 'dump', dump_job)
+        scheduler.submit('maintenance', 'vacuum', vacuum_job)
+        scheduler.run()
+        self.assertEqual(ERRORS_LIST, [])
+        self.assertLess(self.recorder.index('start vacuum'), self.recorder.index('end dump'))
+
+    def test_sync_pool_running(self):
+        # same as above, with a synchronous pool job, which needs a worker thread of its own
+        scheduler = Scheduler(max_workers=1, pools={'maintenance': 1})
+        vacuum_started = threading.Event()
+
+        def dump_job():
+            self.recorder.started('dump')
+            if not vacuum_started.wait(WAIT_TIMEOUT):
+                raise Exception('vacuum not started')
+            self.recorder.ended('dump')
+
+        def vacuum_job():
+            self.recorder.started('vacuum')
+            vacuum_started.set()
+            self.recorder.ended('vacuum')
+
+        scheduler.submit('dumps', 'dump', dump_job)
+        scheduler.submit('maintenance', 'vacuum', vacuum_job)
+        scheduler.run()
+        self.assertEqual(ERRORS_LIST, [])
+        self.assertLess(self.recorder.index('start vacuum'), self.recorder.index('end dump'))
+
+    def test_resource_limits(self):
+        scheduler = Scheduler(max_workers=4, limits={'cpu': 1, 'dumps': 2},
+                              resources={'archives': ['cpu', ], 'verify': ['cpu', ]})
+        for i in range(2):
+            scheduler.submit('archives', 'archive %d' % i, self.recorder.sync_job, 'archive %d' % i, 0.05)
+            scheduler.submit('verify', 'verify %d' % i, self.recorder.async_job, 'verify %d' % i, 0.05)
+        scheduler.run()
+        self.assertEqual(self.recorder.max_running, 1)
+
+    def test_section_limits(self):
+        scheduler = Scheduler(max_workers=4, limits={'dumps': 2})
+        for i in range(4):
+            scheduler.submit('dumps', 'dump %d' % i, self.recorder.async_job, 'dump %d' % i, 0.05)
+        archive = scheduler.create_job('archives', 'other', self.recorder.sync_job, ('other', ), {})
+        dump = scheduler.create_job('dumps', 'other', self.recorder.sync_job, ('other', ), {})
+        with scheduler.lock:
+            scheduler.running = list(scheduler.pending[:2])
+            self.assertFalse(scheduler.can_start(dump))
+            self.assertTrue(scheduler.can_start(archive))
+            scheduler.running = []
+        scheduler.run()
+        self.assertEqual(self.recorder.max_running, 2)
+
+    def test_abandon_jobs(self):
+        scheduler = Scheduler(max_workers=2)
+        scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one')
+        scheduler.submit_after(['verify', ], 'archives', 'archive', self.recorder.sync_job, 'archive')
+        scheduler.submit_after(['archives', ], 'verify', 'verify', self.recorder.async_job, 'verify')
+        scheduler.run()
+        self.assertEqual(self.recorder.events, ['start one', 'end one'])
+        self.assertEqual(scheduler.pending, [])
+        self.assertEqual(sorted([error['message'] for error in ERRORS_LIST]), [
+            'Job "archives: archive" not started: unsatisfiable dependencies',
+            'Job "verify: verify" not started: unsatisfiable dependencies',
+        ])
+
+
+class SchedulerJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        del ERRORS_LIST[:]
+        del MAINTENANCE_ERRORS_LIST[:]
+        self.recorder = Recorder()
+        self.folder = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.folder.name, 'one.gz')
+        self.journal = RunJournal(os.path.join(self.folder.name, 'easy_backup.journal.json'), datetime.datetime(2018, 3, 1))
+
+    def tearDown(self):
+        self.folder.cleanup()
+        del ERRORS_LIST[:]
+        del MAINTENANCE_ERRORS_LIST[:]
+
+    def test_skip_completed(self):
+        with open(self.output, 'w'):
+            pass
+        self.journal.update('dumps: one', 'done', self.output)
+        self.journal.update('dumps: two', 'failed')
+        scheduler = Scheduler(max_workers=2, journal=self.journal, journaled=['dumps', ])
+        followed = []
+        scheduler.follow(['dumps', ], lambda job: followed.append((job.name, job.result)))
+        one = scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one')
+        scheduler.submit('dumps', 'two', self.recorder.async_job, 'two', result='two.gz')
+        scheduler.submit('notification', 'last', self.recorder.sync_job, 'last')
+        scheduler.run()
+        self.assertNotIn('start one', self.recorder.events)
+        self.assertIn('start two', self.recorder.events)
+        self.assertTrue(one.completed)
+        # follow-ups of skipped jobs are called with the recorded output
+        self.assertEqual(sorted(followed), [('one', self.output), ('two', 'two.gz')])
+        self.assertEqual(self.journal.unfinished(), [])
+        # only the given sections are journaled
+        self.assertNotIn('notification: last', self.journal.jobs)
+
+    def test_missing_output(self):
+        # the output of the completed job has been removed meanwhile: the job is run again
+        self.journal.update('dumps: one', 'done', self.output)
+        scheduler = Scheduler(max_workers=1, journal=self.journal)
+        scheduler.submit('dumps', 'one', self.recorder.sync_job, 'one', result=self.output)
+        scheduler.run()
+        self.assertEqual(self.recorder.events, ['start one', 'end one'])
+
+    def test_failed(self):
+        scheduler = Scheduler(max_workers=1, journal=self.journal)
+        scheduler.submit('dumps', 'broken', self.recorder.failing_job, 'broken')
+        scheduler.run()
+        self.assertEqual(self.journal.jobs['dumps: broken']['state'], 'failed')
+        self.assertEqual(self.journal.unfinished(), ['dumps: broken'])
+
+    def test_maintenance_failed(self):
+        # maintenance failures are reported separately, but still recorded as failed
+        scheduler = Scheduler(max_workers=1, journal=self.journal, pools={'maintenance': 1})
+        scheduler.submit('maintenance', 'vacuum', self.recorder.failing_job, 'vacuum', MaintenanceError)
+        scheduler.run()
+        self.assertEqual(ERRORS_LIST, [])
+        self.assertEqual([error['message'] for error in MAINTENANCE_ERRORS_LIST], ['vacuum failed'])
+        self.assertEqual(self.journal.unfinished(), ['maintenance: vacuum'])
+
+        # and run again when resuming
+        scheduler = Scheduler(max_workers=1, journal=self.journal, pools={'maintenance': 1})
+        scheduler.submit('maintenance', 'vacuum', self.recorder.sync_job, 'vacuum')
+        scheduler.run()
+        self.assertEqual(self.recorder.events, ['start vacuum', 'end vacuum', 'start vacuum', 'end vacuum'])
+        self.assertEqual(self.journal.unfinished(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
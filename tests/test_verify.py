@@ -0,0 +1,134 @@
+import io
+import os
+import gzip
+import hashlib
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from easy_backup.verify import verify_backup, read_sidecar, copy_sidecar, sidecar_path
+from easy_backup import process
+from easy_backup import utils
+
+from .common import configure
+
+DATA = b''.join([b'line %d of a text-like dump\n' % i for i in range(20000)])
+
+
+def make_tar():
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode='w') as archive:
+        for i in range(3):
+            info = tarfile.TarInfo('folder/file%d.txt' % i)
+            info.size = len(DATA)
+            archive.addfile(info, io.BytesIO(DATA))
+    return output.getvalue()
+
+
+class VerifyBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, filename, data):
+        filepath = os.path.join(self.tmp.name, filename)
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        return filepath
+
+    def zstd(self, data):
+        filepath = self.write('input', data)
+        output = os.path.join(self.tmp.name, 'input.zst')
+        process.run([['zstd', '-q', '-c', filepath], ], output=output)
+        with open(output, 'rb') as f:
+            return f.read()
+
+    def assert_verified(self, filepath):
+        verify_backup(filepath)
+        with open(filepath, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual(read_sidecar(filepath), checksum)
+        # same format as sha256sum
+        with open(sidecar_path(filepath)) as f:
+            self.assertEqual(f.read(), '%s  %s\n' % (checksum, os.path.basename(filepath)))
+
+    def assert_failed(self, filepath, message):
+        with self.assertRaises(Exception) as context:
+            verify_backup(filepath)
+        self.assertIn('VERIFICATION FAILED', str(context.exception))
+        self.assertIn(message, str(context.exception))
+        self.assertFalse(os.path.exists(sidecar_path(filepath)))
+
+    def test_gzip(self):
+        self.assert_verified(self.write('dump.gz', gzip.compress(DATA)))
+
+    def test_gzip_members(self):
+        # as produced by pigz, or by concatenation; trailing zeros are tolerated
+        self.assert_verified(self.write('dump.gz', gzip.compress(DATA) + gzip.compress(DATA) + b'\0' * 10))
+
+    def test_gzip_truncated(self):
+        data = gzip.compress(DATA)
+        for size in [len(data) - 4, len(data) // 2, 20, ]:
+            with self.subTest(size=size):
+                self.assert_failed(self.write('dump.gz', data[:size]), 'truncated gzip stream')
+
+    def test_gzip_corrupted(self):
+        data = bytearray(gzip.compress(DATA))
+        data[len(data) // 2] ^= 0xff
+        self.assert_failed(self.write('dump.gz', bytes(data)), 'invalid gzip stream')
+
+    def test_tar_gzip(self):
+        self.assert_verified(self.write('folder.tar.gz', gzip.compress(make_tar())))
+        self.assert_verified(self.write('folder.tgz', gzip.compress(make_tar())))
+
+    def test_tar_gzip_truncated(self):
+        # a valid gzip stream, containing a truncated tar archive
+        self.assert_failed(self.write('folder.tar.gz', gzip.compress(make_tar()[:len(DATA)])), 'invalid tar archive')
+
+    @unittest.skipUnless(utils.find_executable('zstd'), 'zstd not available')
+    def test_zstd(self):
+        self.assert_verified(self.write('dump.zst', self.zstd(DATA)))
+        self.assert_verified(self.write('folder.tar.zst', self.zstd(make_tar())))
+
+    @unittest.skipUnless(utils.find_executable('zstd'), 'zstd not available')
+    def test_zstd_truncated(self):
+        data = self.zstd(DATA)
+        self.assert_failed(self.write('dump.zst', data[:len(data) // 2]), 'COMMAND FAILED')
+        data = self.zstd(make_tar())
+        self.assert_failed(self.write('folder.tar.zst', data[:len(data) // 2]), 'VERIFICATION FAILED')
+
+    def test_custom_dump(self):
+        with mock.patch('easy_backup.verify.utils.find_executable', return_value=None):
+            self.assert_verified(self.write('dump.dump', b'PGDMP' + DATA))
+            self.assert_failed(self.write('other.dump', DATA), 'not a PostgreSQL custom format dump')
+
+    def test_plain(self):
+        self.assert_verified(self.write('dump.sql', DATA))
+
+    def test_dry_run(self):
+        configure(dry_run=True)
+        filepath = self.write('dump.gz', b'not gzip')
+        with mock.patch('sys.stderr'):
+            verify_backup(filepath)
+        self.assertFalse(os.path.exists(sidecar_path(filepath)))
+
+    def test_copy_sidecar(self):
+        source = self.write('dump.gz', gzip.compress(DATA))
+        verify_backup(source)
+        target = self.write('dump2.gz', gzip.compress(DATA))
+        copy_sidecar(source, target)
+        self.assertEqual(read_sidecar(target), read_sidecar(source))
+        with open(sidecar_path(target)) as f:
+            self.assertTrue(f.read().endswith('  dump2.gz\n'))
+        # nothing to copy
+        copy_sidecar(os.path.join(self.tmp.name, 'missing.gz'), os.path.join(self.tmp.name, 'other.gz'))
+        self.assertIsNone(read_sidecar(os.path.join(self.tmp.name, 'other.gz')))
+
+
+if __name__ == '__main__':
+    unittest.main()